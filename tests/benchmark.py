@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    benchmark | time the python stages of building quizzes of increasing
+              | size using synthetic xml files
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+
+The benchmark generates quiz xml files, using webquiz_toolchain, with a given
+number of questions, choices per question, discussions, quiz index items and
+words of text, and builds the web page for each of them using MakeWebQuiz. TeX is not run, so only the python side of
+the build is timed: reading the xml file, each of the add_* methods, writing
+the quiz specifications and write_web_page. Each quiz is built --repeat times
+and the fastest time for each stage is recorded. The time taken to read quizzes
+with a single discussion of 1, 2, 4 and 8 megabytes is also recorded, which
+should grow linearly with the size of the discussion.
+
+With --end-to-end the quizzes are built as webquiz builds them, in a job
+directory, using the fake make4ht in webquiz_toolchain, so the image fixup
+and cleanup stages are timed too, but TeX is still not run.
+
+Each of the xml parsers in webquiz_xml is timed reading the synthetic quizzes,
+after checking that the parsers read the same quizzes from the examples in
+doc/examples that webquiz_latex can convert, from synthetic quizzes and from
+a quiz with html elements and entities in its text. With --validate only
+this check is made.
+
+The results are written to a json file so that runs can be compared across
+commits:
+    ./benchmark.py --output before.json
+    git checkout <commit>
+    ./benchmark.py --output after.json --compare before.json
+'''
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import shutil
+import tempfile
+import time
+
+# imports of webquiz code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webquiz'))
+import webquiz
+import webquiz_build
+import webquiz_latex
+import webquiz_makequiz
+import webquiz_timings
+import webquiz_toolchain
+import webquiz_util
+import webquiz_xml
+
+# ---------------------------------------------------------------------------------------
+def build_options(settings, driver):
+    r'''
+    Return the options used by MakeWebQuiz, for building the quizzes quietly
+    with the tex4ht `driver`
+    '''
+    options = argparse.Namespace(quiet=2, fast=False, image_optimisation='none', timings=False, profile=False,
+                                 cache=False, explain=False, debugging=False, tex4ht_driver=driver,
+                                 webquiz_layout=settings['webquiz_layout'],
+                                 scratch_dir=webquiz_util.scratch_directory(settings['scratch_dir']))
+    webquiz_build.set_run_options(options)
+    return options
+
+def build_quiz(quiz, options, settings):
+    r'''
+    Build the quiz described by the dictionary `quiz` in the current
+    directory and return its QuizTimer. With the fake driver the quiz is
+    built from benchmark.tex, and its fixture, in a job directory, as
+    webquiz does, and otherwise the xml file benchmark.xml is built
+    directly, so only the python stages are timed.
+    '''
+    if options.tex4ht_driver == 'fake':
+        with webquiz_build.job_directory('benchmark.tex', options) as job_file:
+            timer = options.timer
+            webquiz_build.make_quiz(job_file, options, settings, webquiz.metadata)
+    else:
+        with webquiz_timings.QuizTimer('benchmark.tex', options) as timer:
+            options.timer = timer
+            webquiz_makequiz.MakeWebQuiz('benchmark.xml', 'benchmark.xml', options, settings, webquiz.metadata)
+    return timer
+
+def time_quiz(quiz, options, settings, repeat):
+    r'''
+    Build the quiz described by the dictionary `quiz` `repeat` times and
+    return the fastest time for each stage, and in total, as a dictionary
+    '''
+    best = {}
+    with tempfile.TemporaryDirectory(prefix='webquiz-benchmark-') as build_dir:
+        cwd = os.getcwd()
+        os.chdir(build_dir)
+        try:
+            if options.tex4ht_driver == 'fake':
+                with open('benchmark.tex', 'w', encoding='utf8') as tex_file:
+                    tex_file.write('\\documentclass{webquiz}\n\\begin{document}\n\\end{document}\n')
+                with open('benchmark.fixture.json', 'w', encoding='utf8') as fixture:
+                    json.dump(quiz, fixture)
+            else:
+                with open('benchmark.xml', 'w', encoding='utf8') as xml_file:
+                    xml_file.write(webquiz_toolchain.generate_quiz(**dict(quiz, images=())))
+            for run in range(repeat):
+                timer = build_quiz(quiz, options, settings)
+                timer.seconds['total'] = timer.total
+                for (stage, seconds) in timer.seconds.items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+        finally:
+            os.chdir(cwd)
+    return best
+
+def time_long_discussion(megabytes, settings, repeat):
+    r'''
+    Return the fastest time, over `repeat` runs, to read a quiz with a single
+    discussion that has `megabytes` megabytes of text, in lines of about 80
+    characters, as TeX4ht writes them. The quiz is read using the sax parser,
+    whatever the xml_parser setting, because it gives each line to
+    QuizHandler separately, whereas the expat parser gives it the text in
+    large blocks. This checks that QuizHandler joins the chunks of text in
+    time that grows linearly with the size of the discussion.
+    '''
+    line = ' '.join(webquiz_toolchain.vocabulary[:12]) + '\n'
+    discussion = ('<discussion>\n<short_heading>Long</short_heading>\n<heading>Long</heading>\n{}\n</discussion>\n'
+                  .format(webquiz_toolchain.cdata(line * (megabytes * 2**20 // len(line)))))
+    xml = webquiz_toolchain.generate_quiz(questions=0, discussions=0).replace('</webquiz>', discussion + '</webquiz>')
+    best = None
+    with tempfile.TemporaryDirectory(prefix='webquiz-benchmark-') as build_dir:
+        xml_file = os.path.join(build_dir, 'discussion.xml')
+        with open(xml_file, 'w', encoding='utf8') as xml_out:
+            xml_out.write(xml)
+        for run in range(repeat):
+            start = time.perf_counter()
+            webquiz_xml.read_with_sax(xml_file, settings)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+    return best
+
+# a quiz with html elements, rather than CDATA, and entities in its text
+html_quiz = '''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE webquiz SYSTEM "webquiz.dtd">
+<webquiz debugging="false" hide_side_menu="DeFaUlT" language="DeFaUlT" one_page="DeFaUlT"
+         pst2pdf="false" random_order="DeFaUlT" theme="DeFaUlT" src="html.tex">
+<title>Html <span class="bold">elements</span> &amp; entities</title>
+<breadcrumb breadcrumbs="DeFaUlT"></breadcrumb>
+<unit_name url="" quizzes_url="DeFaUlT">Unit&#x00A0;name</unit_name>
+<unit_code>Unit code</unit_code>
+<department url="DeFaUlT">DeFaUlT</department>
+<institution url="DeFaUlT">DeFaUlT</institution>
+<discussion><short_heading>Short <b>heading</b></short_heading><heading>Heading</heading>
+<text><p class="noindent">Some &lt;text&gt; &nbsp; <i>with</i><br/> elements</p>
+<div><span>and nested</span> elements</div></text></discussion>
+<question><text><p>A question <math><mi>x</mi><mo>+</mo><mn>1</mn></math></p></text>
+<choice type="single" columns="2">
+<item correct="true" symbol="a"><text><p>One</p></text><feedback><text><b>Right</b></text></feedback></item>
+<item correct="false" symbol="b"><text>Two</text></item>
+</choice></question>
+<question><text>Another question</text><answer prompt="true" comparison="number"><text>3</text></answer>
+<when type="right"><text><p>Right</p></text></when><when type="wrong"><text>Wrong<br/></text></when></question>
+</webquiz>
+'''
+
+# the attributes of QuizHandler that are not part of the quiz
+handler_attributes = ['defaults', 'start_handlers', 'end_handlers', 'text_chunks', 'debug']
+
+def quiz_model(quiz):
+    r'''
+    Return the quiz read by webquiz_xml as nested dictionaries and lists, so
+    that the quizzes read by different xml parsers can be compared
+    '''
+    if isinstance(quiz, list):
+        return [quiz_model(item) for item in quiz]
+    if isinstance(quiz, dict):
+        return {key: quiz_model(val) for (key, val) in quiz.items()}
+    if hasattr(quiz, '__dict__'):
+        return {key: quiz_model(val) for (key, val) in vars(quiz).items()
+                if not key.startswith('_') and key not in handler_attributes}
+    return quiz
+
+def validation_corpus(build_dir):
+    r'''
+    Write the xml files that the xml parsers are checked on to `build_dir`
+    and return their names. These are the examples in doc/examples that
+    webquiz_latex can convert, synthetic quizzes and `html_quiz`.
+    '''
+    xml_files = []
+    examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doc', 'examples')
+    for tex_file in sorted(os.listdir(examples)):
+        if tex_file.endswith('.tex'):
+            quiz = os.path.join(build_dir, tex_file[:-4])
+            shutil.copy(os.path.join(examples, tex_file), quiz + '.tex')
+            try:
+                webquiz_latex.QuizConverter(quiz).write(quiz + '.xml')
+                xml_files.append(quiz + '.xml')
+            except webquiz_latex.NotInSubset:
+                pass
+
+    quizzes = dict(synthetic=dict(questions=30, discussions=3, images=['image.svg', 'image.png']),
+                   index=dict(questions=0, discussions=0, index_items=12))
+    for (name, quiz) in sorted(quizzes.items()):
+        xml_files.append(os.path.join(build_dir, name + '.xml'))
+        with open(xml_files[-1], 'w', encoding='utf8') as xml_file:
+            xml_file.write(webquiz_toolchain.generate_quiz(**quiz))
+    xml_files.append(os.path.join(build_dir, 'html.xml'))
+    with open(xml_files[-1], 'w', encoding='utf8') as xml_file:
+        xml_file.write(html_quiz)
+    return xml_files
+
+def validate_xml_parsers(parsers, settings):
+    r'''
+    Check that the xml `parsers` read the same quiz from each file in the
+    validation corpus and return the number of files that they read
+    differently
+    '''
+    differ = 0
+    with tempfile.TemporaryDirectory(prefix='webquiz-benchmark-') as build_dir:
+        xml_files = validation_corpus(build_dir)
+        for xml_file in xml_files:
+            models = {parser: quiz_model(webquiz_xml.xml_parsers[parser](xml_file, settings)) for parser in parsers}
+            different = [parser for parser in parsers[1:] if models[parser] != models[parsers[0]]]
+            if different:
+                differ += 1
+                print('  FAILED: {} read {} differently to {}'.format(
+                      ' and '.join(different), os.path.basename(xml_file), parsers[0]))
+    print('The xml parsers {} read the same quiz from {} of the {} files'.format(
+          ', '.join(parsers), len(xml_files) - differ, len(xml_files)))
+    return differ
+
+def time_xml_parsers(quiz, parsers, settings, repeat):
+    r'''
+    Return the fastest time, over `repeat` runs, for each of the xml
+    `parsers` to read the quiz described by the dictionary `quiz`
+    '''
+    best = {}
+    with tempfile.TemporaryDirectory(prefix='webquiz-benchmark-') as build_dir:
+        xml_file = os.path.join(build_dir, 'benchmark.xml')
+        with open(xml_file, 'w', encoding='utf8') as xml_out:
+            xml_out.write(webquiz_toolchain.generate_quiz(**dict(quiz, images=())))
+        for run in range(repeat):
+            for parser in parsers:
+                start = time.perf_counter()
+                webquiz_xml.xml_parsers[parser](xml_file, settings)
+                seconds = time.perf_counter() - start
+                best[parser] = min(seconds, best.get(parser, seconds))
+    return best
+
+def git_commit():
+    r'''
+    Return the current git commit, or '' if it is not known
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def compare(results, old_file):
+    r'''
+    Print the ratio of the times in `results` to those in the json file `old_file`
+    '''
+    with open(old_file, encoding='utf8') as old:
+        old_results = json.load(old)
+    if old_results.get('end_to_end', False) != results['end_to_end']:
+        print('WebQuiz warning: only one of the benchmarks {} and {} is end-to-end'.format(
+              results['commit'] or 'now', old_file))
+    old_runs = {(run['questions'], run['choices'], run['discussions'], run['index_items'], run['words']): run
+                for run in old_results['runs']}
+    print('\nCompared with {} (commit {}): new/old'.format(old_file, old_results.get('commit') or '?'))
+    for run in results['runs']:
+        old = old_runs.get((run['questions'], run['choices'], run['discussions'], run['index_items'], run['words']))
+        if old is None:
+            continue
+        print('  {:>6} questions: {}'.format(run['questions'], ', '.join(
+              '{} {:.2f}'.format(stage, run['stages'][stage]/old['stages'][stage])
+              for stage in ['read_xml_file', 'write_quiz_specifications', 'write_web_page', 'total']
+              if old['stages'].get(stage, 0) > 0 and stage in run['stages'])))
+    old_discussions = {run['megabytes']: run for run in old_results.get('discussions', [])}
+    for run in results['discussions']:
+        if old_discussions.get(run['megabytes'], {}).get('read_xml_file', 0) > 0:
+            print('  {:>6} MB discussion: read_xml_file {:.2f}'.format(
+                  run['megabytes'], run['read_xml_file']/old_discussions[run['megabytes']]['read_xml_file']))
+    old_parsers = {run['questions']: run['seconds'] for run in old_results.get('xml_parsers', [])}
+    for run in results['xml_parsers']:
+        old = old_parsers.get(run['questions'], {})
+        ratios = ['{} {:.2f}'.format(parser, seconds/old[parser])
+                  for (parser, seconds) in sorted(run['seconds'].items()) if old.get(parser, 0) > 0]
+        if ratios:
+            print('  {:>6} questions: {}'.format(run['questions'], ', '.join(ratios)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the python stages of building quizzes of increasing size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='the numbers of questions in the quizzes')
+    parser.add_argument('--choices', type=int, default=4, help='the number of choices in each question')
+    parser.add_argument('--discussions', type=int, default=2, help='the number of discussions in each quiz')
+    parser.add_argument('--index-items', type=int, default=0,
+                        help='also time a quiz index page with this many items')
+    parser.add_argument('--words', type=int, default=30, help='the number of words in each question')
+    parser.add_argument('--images', type=int, default=0,
+                        help='the number of images in each quiz, which needs --end-to-end')
+    parser.add_argument('--end-to-end', action='store_true', default=False,
+                        help='build the quizzes from fixtures using the fake make4ht, including the image '
+                             'fixup and cleanup stages')
+    parser.add_argument('--discussion-sizes', type=int, nargs='*', default=[1, 2, 4, 8],
+                        help='the sizes, in megabytes, of the long discussions that are read')
+    parser.add_argument('--xml-parsers', nargs='*', default=['sax', 'expat'],
+                        choices=sorted(webquiz_xml.xml_parsers),
+                        help='the xml parsers that are checked against each other and timed, the first of '
+                             'which is the reference')
+    parser.add_argument('--validate', action='store_true', default=False,
+                        help='only check that the xml parsers read the same quizzes')
+    parser.add_argument('--repeat', type=int, default=3, help='build each quiz this many times')
+    parser.add_argument('--output', default=None, help='the json file for the results')
+    parser.add_argument('--compare', metavar='JSON', default=None, help='compare with the results in JSON')
+    args = parser.parse_args()
+
+    # the webquiz files are found in the source tree, so TeX is not needed
+    webquiz_util.search_source_tree()
+    webquiz.metadata = webquiz.read_metadata()
+    settings = webquiz.WebQuizSettings()
+    settings.debugging = False
+    if settings['webquiz_url'] == '':
+        settings['webquiz_url'] = '/WebQuiz'
+    options = build_options(settings, 'fake' if args.end_to_end else 'make4ht')
+
+    differ = validate_xml_parsers(args.xml_parsers, settings) if len(args.xml_parsers) > 1 else 0
+    if args.validate:
+        sys.exit(1 if differ else 0)
+
+    images = args.images if args.end_to_end else 0
+    quizzes = [dict(questions=size, choices=args.choices, discussions=args.discussions, index_items=0,
+                    words=args.words, images=images) for size in args.sizes]
+    if args.index_items > 0:
+        quizzes.append(dict(questions=0, choices=0, discussions=0, index_items=args.index_items,
+                            words=args.words, images=0))
+
+    commit = git_commit()
+    results = dict(
+        webquiz=webquiz.metadata.version,
+        commit=commit,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        date=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        repeat=args.repeat,
+        end_to_end=args.end_to_end,
+        xml_parser=settings['xml_parser'],
+        runs=[]
+    )
+    for quiz in quizzes:
+        xml = webquiz_toolchain.generate_quiz(**dict(quiz, images=['image.svg']*quiz['images']))
+        stages = time_quiz(quiz, options, settings, args.repeat)
+        results['runs'].append(dict(quiz, xml_bytes=len(xml.encode('utf8')),
+                                    stages={stage: round(seconds, 6) for (stage, seconds) in stages.items()}))
+        print('{:>6} questions, {:>5} index items, {:>9} bytes: {:.4f}s ({})'.format(
+              quiz['questions'], quiz['index_items'], len(xml), stages['total'],
+              ', '.join('{} {:.4f}'.format(stage, seconds) for (stage, seconds) in stages.items()
+                        if stage not in ['total', 'other'])))
+
+    results['discussions'] = []
+    for megabytes in args.discussion_sizes:
+        seconds = time_long_discussion(megabytes, settings, args.repeat)
+        results['discussions'].append(dict(megabytes=megabytes, read_xml_file=round(seconds, 6)))
+        print('{:>6} MB discussion: read_xml_file with sax {:.4f}s, {:.4f}s per MB'.format(
+              megabytes, seconds, seconds/megabytes))
+    if len(args.discussion_sizes) > 1:
+        per_megabyte = [run['read_xml_file']/run['megabytes'] for run in results['discussions']]
+        print('Reading the {} MB discussion took {:.2f} times as long per MB as the {} MB one'.format(
+              args.discussion_sizes[-1], per_megabyte[-1]/max(per_megabyte[0], 1e-9), args.discussion_sizes[0]))
+
+    results['xml_parsers'] = []
+    for quiz in quizzes:
+        seconds = time_xml_parsers(quiz, args.xml_parsers, settings, args.repeat)
+        results['xml_parsers'].append(dict(questions=quiz['questions'], index_items=quiz['index_items'],
+                                           seconds={parser: round(best, 6) for (parser, best) in seconds.items()}))
+        print('{:>6} questions, {:>5} index items: {}'.format(quiz['questions'], quiz['index_items'],
+              ', '.join('{} {:.4f}s'.format(parser, seconds[parser]) for parser in args.xml_parsers)))
+
+    output = args.output or 'benchmark-{}.json'.format(commit or 'results')
+    with open(output, 'w', encoding='utf8') as json_file:
+        json.dump(results, json_file, indent=2)
+        json_file.write('\n')
+    print('Results written to {}'.format(output))
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    if differ:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -18,81 +18,63 @@ r'''
 
 import argparse
 import codecs
-import errno
-import glob
 import os
-import re
 import shutil
 import signal
 import subprocess
 import sys
 
-# imports of webquiz code
-import webquiz_makequiz
+# imports of webquiz code; the modules that are needed only for building
+# quizzes are imported when they are needed so that webquiz starts quickly
 import webquiz_templates
 import webquiz_util
 
+log = webquiz_util.webquiz_logger('main')
+
 #################################################################################
-# read in basic meta data such as author, version, ... and set debugging=False
-try:
-    metadata = webquiz_util.MetaData(webquiz_util.kpsewhich('webquiz.ini'), debugging=False)
-except subprocess.CalledProcessError:
-    # check to see if we are running from the zip file
-    ini_file = os.path.join(webquiz_util.webquiz_file(''), '..', 'latex', 'webquiz.ini')
+# basic meta data such as author, version, ..., which is set by read_metadata()
+metadata = None
+
+def read_metadata():
+    r'''
+    Read and return the basic meta data such as author, version, ... with debugging=False
+    '''
     try:
-        metadata = webquiz_util.MetaData(ini_file, debugging=False)
-    except (FileNotFoundError, subprocess.CalledProcessError):
-        print('webquiz installation error: unable to find webquiz.ini -> {}'.format(ini_file))
-        sys.exit(1)
+        return webquiz_util.MetaData(webquiz_util.kpsewhich('webquiz.ini'), debugging=False)
+    except subprocess.CalledProcessError:
+        # check to see if we are running from the zip file
+        ini_file = os.path.join(webquiz_util.webquiz_file(''), '..', 'latex', 'webquiz.ini')
+        try:
+            return webquiz_util.MetaData(ini_file, debugging=False)
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            print('webquiz installation error: unable to find webquiz.ini -> {}'.format(ini_file))
+            sys.exit(1)
 
 # ---------------------------------------------------------------------------------------
 def graceful_exit(sig, frame):
-    ''' exit gracefully on SIGINT and SIGTERM'''
+    ''' exit gracefully on SIGINT and SIGTERM, stopping any programs that are running'''
+    # the programs run in their own process groups, so they must be stopped
+    # explicitly, as must the worker processes, which then stop their programs
+    if 'webquiz_process' in sys.modules:
+        sys.modules['webquiz_process'].stop_all_commands()
+    if 'multiprocessing' in sys.modules:
+        for worker in sys.modules['multiprocessing'].active_children():
+            worker.terminate()
+
     if metadata:
-        webquiz_util.webquiz_error(False, 'program terminated (signal {}\n  {})'.format(sig, frame))
+        webquiz_util.print_error('program terminated (signal {}\n  {})'.format(sig, frame))
     else:
-        webquiz_util.webquiz_error(False, 'program terminated (signal {})'.format(sig))
+        webquiz_util.print_error('program terminated (signal {})'.format(sig))
+
+    # this is not a WebQuizError, so it cancels the whole run rather than
+    # just the quiz that is being built
+    raise webquiz_util.WebQuizCancelled(128 + sig)
 
 signal.signal(signal.SIGINT, graceful_exit)
 signal.signal(signal.SIGTERM, graceful_exit)
 
 
 #################################################################################
-def preprocess_with_pst2pdf(options, quiz_file):
-    r'''
-    Preprocess the latex file using pst2pdf. As we are preprocessing the file it
-    is not enough to have latex pass us a flag that tells us to use pst2pdf.
-    Instead, we have to extract the class file option from the tex file
-
-    INPUT: quiz_file should be the name of the quiz file, WITHOUT the .tex extension
-    '''
-    options.talk('Preprocessing {} with pst2pdsf'.format(quiz_file))
-    try:
-        # pst2pdf converts pspicture environments to svg images and makes a
-        # new latex file quiz_file+'-pdf' that includes these
-        cmd = 'pst2pdf --svg --imgdir={q_file} {q_file}.tex'.format(q_file=quiz_file)
-        options.run(cmd)
-    except OSError as err:
-        if err.errno == errno.ENOENT:
-            webquiz_util.webquiz_error(options.debugging, 'pst2pdf not found. You need to install pst2pdf to use the pst2pdf option', err)
-        else:
-            webquiz_util.webquiz_error(options.debugging, 'error running pst2pdf on {}'.format(quiz_file), err)
-
-    # match \includegraphics commands
-    fix_svg = re.compile(r'(\\includegraphics\[scale=1\])\{('+quiz_file+r'-fig-[0-9]*)\}')
-    # the svg images are in the quiz_file subdirectory but latex can't
-    # find them so we update the tex file to look in the right place
-    try:
-        with codecs.open(quiz_file + '-pdf.tex', 'r', encoding='utf8') as pst_file:
-            with codecs.open(quiz_file + '-pdf-fixed.tex', 'w', encoding='utf8') as pst_fixed:
-                for line in pst_file:
-                    pst_fixed.write(fix_svg.sub(r'\1{%s/\2.svg}' % quiz_file, line))
-    except OSError as err:
-        webquiz_util.webquiz_error(options.debugging,
-            'there was an problem running pst2pdf for {}'.format(quiz_file),
-            err
-        )
-
 class WebQuizSettings:
     r'''
     Class for initialising webquiz. This covers both reading and writing the
@@ -186,6 +168,44 @@ class WebQuizSettings:
             'advanced': True,
             'help': 'Build file for make4ht',
         },
+        tex4ht_driver={
+            'default': 'make4ht',
+            'advanced': True,
+            'help': 'Program that runs the LaTeX passes and TeX4ht',
+            'values': ['make4ht', 'webquiz', 'fake']
+        },
+        xml_parser={
+            'default': 'expat',
+            'advanced': True,
+            'help': 'Parser used to read the xml for the quizzes: expat or sax',
+            'values': ['expat', 'sax']
+        },
+        build_cache={
+            'default': 'false',
+            'advanced': True,
+            'help': 'Reuse the make4ht output for quizzes that have not changed',
+        },
+        image_cache_size={
+            'default': '500',
+            'advanced': True,
+            'help': 'Maximum size of the image cache in megabytes',
+        },
+        image_optimisation={
+            'default': 'lossless',
+            'advanced': True,
+            'help': 'Optimise the images: none, lossless or srcset',
+            'values': ['none', 'lossless', 'srcset']
+        },
+        cache_dir={
+            'default': '',
+            'advanced': True,
+            'help': 'Directory for the WebQuiz build cache',
+        },
+        scratch_dir={
+            'default': '',
+            'advanced': True,
+            'help': 'Directory where quizzes are built (default /dev/shm)',
+        },
         mathjax={
             'default':
             'https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.1/MathJax.js',
@@ -226,13 +246,20 @@ class WebQuizSettings:
 
         # define user and system rc file and load the ones that exist
 
-        self.system_rcfile = os.path.join(webquiz_util.kpsewhich('-var-value TEXMFLOCAL'),
-                                           'tex',
-                                           'latex',
-                                           'webquiz',
-                                           'webquizrc'
-        )
-        self.read_webquizrc(self.system_rcfile)
+        # the system rc file is in TEXMFLOCAL, which is not known when there
+        # is no TeX distribution, such as when testing with the fake make4ht
+        try:
+            texmflocal = webquiz_util.kpsewhich('-var-value TEXMFLOCAL')
+        except (subprocess.CalledProcessError, OSError):
+            texmflocal = ''
+        if texmflocal != '':
+            self.system_rcfile = os.path.join(texmflocal,
+                                               'tex',
+                                               'latex',
+                                               'webquiz',
+                                               'webquizrc'
+            )
+            self.read_webquizrc(self.system_rcfile)
 
         # the user rc file defaults to:
         #   ~/.dotfiles/config/webquizrc if .dotfiles/config exists
@@ -245,13 +272,30 @@ class WebQuizSettings:
         else:
             self.user_rcfile = os.path.join(os.path.expanduser('~'), '.webquizrc')
 
+        # without TEXMFLOCAL, the user rc file is the only rc file
+        if texmflocal == '':
+            self.system_rcfile = self.user_rcfile
+
         self.read_webquizrc(self.user_rcfile)
 
-    def webquiz_debug(self, msg):
+    def __getstate__(self):
         r'''
-            Customised debugging message for the MakeSettings module
+        The values of the settings are stored in the class attribute `settings`,
+        so we add them to the state when pickling. This is needed when the
+        quizzes are built in parallel by separate processes.
         '''
-        webquiz_util.webquiz_debug(self.debugging, 'main: '+msg)
+        state = self.__dict__.copy()
+        state['values'] = {key: self[key] for key in self.settings}
+        return state
+
+    def __setstate__(self, state):
+        r'''
+        Restore the values of the settings when unpickling
+        '''
+        values = state.pop('values')
+        self.__dict__.update(state)
+        for key in values:
+            self.settings[key]['value'] = values[key]
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -288,6 +332,7 @@ class WebQuizSettings:
         not exist then return without changing the current settings.
         '''
         if os.path.isfile(rcfile):
+            log.debug('reading the settings in %s', rcfile)
             try:
                 with codecs.open(rcfile, 'r', encoding='utf8') as webquizrc:
                     for line in webquizrc:
@@ -621,7 +666,19 @@ class WebQuizSettings:
                         print('setting not changed: {} is not a valid TeX engine'.format(setting))
                         setting = self['engine']
 
-                    elif key in ['hide_side_menu', 'random_order']:
+                    elif key == 'tex4ht_driver' and setting not in self.settings['tex4ht_driver']['values']:
+                        print('setting not changed: {} must be make4ht, webquiz or fake'.format(key))
+                        setting = self['tex4ht_driver']
+
+                    elif key == 'xml_parser' and setting not in self.settings['xml_parser']['values']:
+                        print('setting not changed: {} must be expat or sax'.format(key))
+                        setting = self['xml_parser']
+
+                    elif key == 'image_optimisation' and setting not in self.settings['image_optimisation']['values']:
+                        print('setting not changed: {} must be none, lossless or srcset'.format(key))
+                        setting = self['image_optimisation']
+
+                    elif key in ['build_cache', 'hide_side_menu', 'random_order']:
                         setting = setting.lower()
                         if setting not in ['true', 'false']:
                             print('setting not changed: {} must be True or False'.format(key))
@@ -785,9 +842,8 @@ class WebQuizSettings:
 
 # =====================================================
 if __name__ == '__main__':
+    metadata = read_metadata()
     try:
-        settings = WebQuizSettings()
-
         # parse the command line options
         parser = argparse.ArgumentParser(description=metadata.description)
 
@@ -811,6 +867,51 @@ if __name__ == '__main__':
             default=False,
             help='Use make4ht draft mode')
 
+        parser.add_argument(
+            '--time-limit',
+            action='store',
+            metavar='SECONDS',
+            type=int,
+            default=0,
+            help='Stop programs that run for more than SECONDS (default 0, for no limit)')
+
+        parser.add_argument(
+            '--cpu-limit',
+            action='store',
+            metavar='SECONDS',
+            type=int,
+            default=0,
+            help='Limit the CPU time of each program to SECONDS')
+
+        parser.add_argument(
+            '--memory-limit',
+            action='store',
+            metavar='MB',
+            type=int,
+            default=0,
+            help='Limit the memory of each program to MB megabytes')
+
+        parser.add_argument(
+            '--scratch-dir',
+            action='store',
+            metavar='DIR',
+            default=None,
+            help='Build the quizzes in scratch directories in DIR')
+
+        parser.add_argument(
+            '--fast',
+            action='store_true',
+            default=False,
+            help='Convert quizzes that use only text and mathematics without TeX4ht')
+
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='Build up to JOBS quizzes in parallel')
+
         parser.add_argument(
             '-s',
             '--shell-escape',
@@ -823,7 +924,7 @@ if __name__ == '__main__':
             '--latex',
             action='store_const',
             const='latex',
-            default=settings['engine'],
+            default=None,
             dest='engine',
             help='Use latex to compile document with make4ht (default)')
         engine.add_argument(
@@ -841,6 +942,122 @@ if __name__ == '__main__':
             dest='engine',
             help='Use xelatex to compile the quiz')
 
+        parser.add_argument(
+            '--driver',
+            action='store',
+            choices=WebQuizSettings.settings['tex4ht_driver']['values'],
+            default=None,
+            dest='tex4ht_driver',
+            help='Run the LaTeX passes and TeX4ht using make4ht or webquiz')
+
+        parser.add_argument(
+            '--optimise-images',
+            action='store',
+            choices=WebQuizSettings.settings['image_optimisation']['values'],
+            default=None,
+            dest='image_optimisation',
+            help='Minify the images and optionally make srcset images')
+
+        cache = parser.add_mutually_exclusive_group()
+        cache.add_argument(
+            '--cache',
+            action='store_true',
+            default=None,
+            dest='cache',
+            help='Reuse the make4ht output for quizzes that have not changed')
+        cache.add_argument(
+            '--no-cache',
+            action='store_false',
+            dest='cache',
+            help='Always run make4ht, ignoring the build cache')
+
+        parser.add_argument(
+            '--cache-stats',
+            action='store_true',
+            default=False,
+            help='Print statistics about the build and image caches')
+
+        parser.add_argument(
+            '-w',
+            '--watch',
+            action='store_true',
+            default=False,
+            help='Watch the quizzes and rebuild them when they change')
+
+        parser.add_argument(
+            '--tree',
+            action='store',
+            metavar='DIR',
+            default=None,
+            help='Build all of the quizzes in the directory tree DIR')
+
+        parser.add_argument(
+            '--manifest',
+            action='store',
+            metavar='FILE',
+            default=None,
+            help='Write the manifest for --tree to FILE')
+
+        parser.add_argument(
+            '--publish',
+            action='store_true',
+            default=False,
+            help='Publish the quizzes built by --tree as a new release')
+
+        parser.add_argument(
+            '--publish-to',
+            action='store',
+            metavar='DIR',
+            default=None,
+            help='Publish the quizzes to DIR instead of to webquiz_www/quizzes')
+
+        parser.add_argument(
+            '--keep-releases',
+            action='store',
+            metavar='N',
+            type=int,
+            default=5,
+            help='Keep the last N published releases (default 5)')
+
+        parser.add_argument(
+            '--rollback',
+            action='store',
+            metavar='COURSE',
+            default=None,
+            help='Switch the published quizzes for COURSE back to the previous release')
+
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            default=False,
+            help='Explain why each quiz was, or was not, rebuilt')
+
+        parser.add_argument(
+            '--timings',
+            action='store_true',
+            default=False,
+            help='Print the time taken by each stage of the build and write it to <quiz>-timings.json')
+
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            default=False,
+            help='Profile the python code for each quiz using cProfile and write the profile to <quiz>.prof')
+
+        server = parser.add_mutually_exclusive_group()
+        server.add_argument(
+            '--serve-socket',
+            action='store',
+            metavar='SOCKET',
+            default=None,
+            help='Run a build server that listens for quizzes on SOCKET')
+        server.add_argument(
+            '--submit',
+            action='store',
+            metavar='SOCKET',
+            default=None,
+            help='Build the quizzes using the build server listening on SOCKET')
+
         parser.add_argument(
             '-r',
             '--rcfile',
@@ -876,6 +1093,13 @@ if __name__ == '__main__':
             help=argparse.SUPPRESS
         )
 
+        parser.add_argument(
+            '--log-file',
+            action='store',
+            metavar='FILE',
+            default=None,
+            help='Write the debugging messages to FILE rather than to stderr')
+
         # options suppressed from the help message
         parser.add_argument(
             '-m',
@@ -883,7 +1107,7 @@ if __name__ == '__main__':
             action='store',
             type=str,
             dest='make4ht_options',
-            default=settings['make4ht'],
+            default=None,
             help=argparse.SUPPRESS
         )
 
@@ -892,7 +1116,7 @@ if __name__ == '__main__':
             action='store',
             type=str,
             dest='webquiz_layout',
-            default=settings['webquiz_layout'],
+            default=None,
             help=argparse.SUPPRESS
         )
 
@@ -935,10 +1159,16 @@ if __name__ == '__main__':
             help=argparse.SUPPRESS
         )
 
-        # parse the options
+        # parse the options; --help and --version exit here, before the
+        # settings are read
         options = parser.parse_args()
         options.prog = parser.prog
 
+        # log the debugging messages, to stderr or to the log file
+        webquiz_util.set_logging(options.debugging, options.log_file)
+
+        settings = WebQuizSettings()
+
         # set debugging mode from options
         settings.debugging = options.debugging
 
@@ -947,6 +1177,25 @@ if __name__ == '__main__':
             rcfile = os.path.expanduser(options.rcfile)
             settings.read_webquizrc(rcfile)
 
+        # the options whose defaults are given by the settings
+        if options.engine is None:
+            options.engine = settings['engine']
+        if options.cache is None:
+            options.cache = settings['build_cache'] == 'true'
+        if options.tex4ht_driver is None:
+            options.tex4ht_driver = settings['tex4ht_driver']
+        if options.tex4ht_driver == 'fake':
+            # the fake make4ht does not need TeX, so neither should finding the webquiz files
+            webquiz_util.search_source_tree()
+        if options.image_optimisation is None:
+            options.image_optimisation = settings['image_optimisation']
+        if options.make4ht_options is None:
+            options.make4ht_options = settings['make4ht']
+        if options.webquiz_layout is None:
+            options.webquiz_layout = settings['webquiz_layout']
+        options.scratch_dir = webquiz_util.scratch_directory(
+            settings['scratch_dir'] if options.scratch_dir is None else options.scratch_dir)
+
         if options.uninstall:
             # uninstall web files and exit
             settings.uninstall_webquiz()
@@ -978,11 +1227,45 @@ if __name__ == '__main__':
             settings.edit_settings()
             sys.exit()
 
+        # print the cache statistics and exit
+        if options.cache_stats:
+            import webquiz_cache
+            webquiz_cache.print_cache_statistics(settings)
+            sys.exit()
+
         # print short help and exit
         if options.shorthelp:
             parser.print_usage()
             sys.exit()
 
+        # run a build server until interrupted
+        if options.serve_socket is not None:
+            import webquiz_server
+            webquiz_server.BuildServer(options.serve_socket, options, settings, metadata).serve()
+            sys.exit()
+
+        # roll the published quizzes for a course back to the previous release
+        if options.rollback is not None:
+            import webquiz_publish
+            webquiz_publish.Publisher(options.rollback, options, settings).rollback()
+            sys.exit()
+
+        # build all of the quizzes in a directory tree, and then publish them
+        if options.tree is not None:
+            import webquiz_tree
+            builder = webquiz_tree.TreeBuilder(options, settings, metadata)
+            all_built = builder.build()
+            if options.publish:
+                if not all_built:
+                    webquiz_util.webquiz_error(options.debugging,
+                        'not publishing {} because some of the quizzes were not built'.format(options.tree))
+                import webquiz_publish
+                course = os.path.basename(os.path.abspath(options.tree))
+                webquiz_publish.Publisher(course, options, settings).publish(options.tree, builder.manifest)
+            sys.exit(0 if all_built else 1)
+        elif options.publish:
+            webquiz_util.webquiz_error(options.debugging, '--publish can only be used with --tree')
+
         # if no filename then exit
         if options.quiz_file==[]:
             if settings.have_initialised:
@@ -991,101 +1274,25 @@ if __name__ == '__main__':
                 parser.print_help()
                 sys.exit(1)
 
-        # import the local page formatter
-        mod_dir, mod_layout = os.path.split(options.webquiz_layout)
-        if mod_dir != '':
-            sys.path.insert(0, mod_dir)
-        options.write_web_page = __import__(mod_layout).write_web_page
-
-        # run() is a shorthand for executing system commands depending on the quietness
-        #       - we need to use shell=True because otherwise pst2pdf gives an error
-        # options.talk() is a shorthand for letting the user know what is happening
-        if options.quiet == 0:
-            options.run = lambda cmd: subprocess.call(cmd, shell=True)
-            options.talk = lambda msg: print(msg)
-        elif options.quiet == 1:
-            options.run  = lambda cmd: subprocess.call(cmd, shell=True, stdout=open(os.devnull, 'wb'))
-            options.talk = lambda msg: print(msg)
-        else:
-            options.run  = lambda cmd: subprocess.call(cmd, shell=True, stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
-            options.talk = lambda msg: None
+        # watch the quizzes and rebuild them when they change
+        if options.watch:
+            import webquiz_watch
+            webquiz_watch.QuizWatcher(options, settings, metadata).watch()
 
         # run through the list of quizzes and make them
-        for quiz_file in options.quiz_file:
-            if len(options.quiz_file) > 1 and options.quiet < 3:
-                print('Making web page for {}'.format(quiz_file))
-            # quiz_file is assumed to be a tex file if no extension is given
-            if not '.' in quiz_file:
-                quiz_file += '.tex'
-
-            if not os.path.isfile(quiz_file):
-                print('WebQuiz error: cannot read file {}'.format(quiz_file))
-
-            else:
-
-                # the quiz name and the quiz_file will be if pst2pdf is used
-                quiz_name = quiz_file
-                if options.quiet < 2:
-                    print('WebQuiz generating web page for {}'.format(quiz_file))
-
-                # If the pst2podf option is used then we need to preprocess
-                # the latex file BEFORE passing it to MakeWebQuiz. Set
-                # options.pst2pdf = True if pst2pdf is given as an option to
-                # the webquiz documentclass
-                with codecs.open(quiz_file, 'r', encoding='utf8') as q_file:
-                    doc = q_file.read()
-
-                options.pst2pdf = False
-                try:
-                    brac = doc.index(r'\documentclass[') + 15  # start of class options
-                    if 'pst2pdf' in [
-                            opt.strip()
-                            for opt in doc[brac:brac+doc[brac:].index(']')].split(',')
-                    ]:
-                        preprocess_with_pst2pdf(options, quiz_file[:-4])
-                        options.pst2pdf = True
-                        # now run webquiz on the modified tex file
-                        quiz_file = quiz_file[:-4] + '-pdf-fixed.tex'
-                except ValueError:
-                    pass
-
-                # the file exists and is readable so make the quiz
-                webquiz_makequiz.MakeWebQuiz(quiz_name, quiz_file, options, settings, metadata)
-
-                quiz_name = quiz_name[:quiz_name.index('.')]  # remove the extension
-
-                # move the css file into the directory for the quiz
-                css_file = os.path.join(quiz_name, quiz_name + '.css')
-                if os.path.isfile(quiz_name + '.css'):
-                    if os.path.isfile(css_file):
-                        os.remove(css_file)
-                    shutil.move(quiz_name + '.css', css_file)
-
-                # now clean up unless debugging
-                if not options.debugging:
-                    for ext in ['4ct', '4tc', 'dvi', 'idv', 'lg', 'log',
-                        'ps', 'pdf', 'tmp', 'xml', 'xref'
-                    ]:
-                        if os.path.isfile(quiz_name + '.' + ext):
-                            os.remove(quiz_name + '.' + ext)
-
-                    # files created when using pst2pdf
-                    if options.pst2pdf:
-                        for file in glob.glob(quiz_name + '-pdf.*'):
-                            os.remove(file)
-                        for file in glob.glob(quiz_name + '-pdf-fixed.*'):
-                            os.remove(file)
-                        for extention in ['.preamble', '.plog', '-tmp.tex',
-                                '-pst.tex', '-fig.tex'
-                        ]:
-                            if os.path.isfile(quiz_name + extention):
-                                os.remove(quiz_name + extention)
-                        if os.path.isdir(os.path.join(quiz_name, quiz_name)):
-                            shutil.rmtree(os.path.join(quiz_name, quiz_name))
+        if options.submit is not None:
+            import webquiz_server
+            all_built = webquiz_server.submit_jobs(options.submit, options.quiz_file, options)
+        else:
+            import webquiz_build
+            all_built = webquiz_build.build_quizzes(options, settings, metadata)
 
         if settings.initialise_warning != '':
             print(webquiz_templates.text_initialise_warning)
 
+        if not all_built:
+            sys.exit(1)
+
     except Exception as err:
 
         # there is a small chance that there is an error before we the
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_build | build one or more quizzes, either one after another
+                     | or in parallel in isolated job directories
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import argparse
+import codecs
+import concurrent.futures
+import contextlib
+import errno
+import io
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+# imports of webquiz code
+import webquiz_cache
+import webquiz_makequiz
+import webquiz_process
+import webquiz_pst2pdf
+import webquiz_timings
+import webquiz_util
+
+#################################################################################
+def preprocess_with_pst2pdf(options, settings, quiz_file):
+    r'''
+    Preprocess the latex file using pst2pdf. As we are preprocessing the file it
+    is not enough to have latex pass us a flag that tells us to use pst2pdf.
+    Instead, we have to extract the class file option from the tex file
+
+    INPUT: quiz_file should be the name of the quiz file, WITHOUT the .tex extension
+    '''
+    options.talk('Preprocessing {} with pst2pdf'.format(quiz_file))
+    try:
+        # pst2pdf converts the pspicture environments to svg images, which
+        # are put in the quiz_file subdirectory, and webquiz_pst2pdf makes a
+        # new latex file quiz_file+'-pdf-fixed' that includes these
+        pst2pdf = webquiz_pst2pdf.Pst2pdf(quiz_file, options, settings)
+        if not pst2pdf.run():
+            webquiz_util.webquiz_error(options.debugging, 'pst2pdf was unable to convert the pictures in {}.tex:\n  {}'.format(
+                quiz_file, '\n  '.join('{}, for the picture on line {}'.format(svg_file, pst2pdf.lines[svg_file])
+                                        for svg_file in pst2pdf.failed)))
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            webquiz_util.webquiz_error(options.debugging, 'pst2pdf not found. You need to install pst2pdf to use the pst2pdf option', err)
+        else:
+            webquiz_util.webquiz_error(options.debugging, 'error running pst2pdf on {}'.format(quiz_file), err)
+
+def set_run_options(options):
+    r'''
+    Add the `run`, `talk` and `write_web_page` short-cuts to `options`:
+      - options.run() executes system commands, which are lists of arguments,
+        and displays their output depending on the quietness
+      - options.talk() lets the user know what is happening
+      - options.write_web_page() is the local page formatter
+    '''
+    # import the local page formatter
+    mod_dir, mod_layout = os.path.split(options.webquiz_layout)
+    if mod_dir != '' and mod_dir not in sys.path:
+        sys.path.insert(0, mod_dir)
+    options.write_web_page = __import__(mod_layout).write_web_page
+
+    options.run = webquiz_process.CommandRunner(quiet=options.quiet, limits=webquiz_process.process_limits(options))
+
+    if options.quiet < 2:
+        options.talk = lambda msg: print(msg)
+    else:
+        options.talk = lambda msg: None
+
+def dependency_hashes(quiz_file, dependencies, options):
+    r'''
+    Return a dictionary of the hashes of `quiz_file` and the files in the list
+    `dependencies`. When the quiz is built in a job directory the quiz file in
+    the job directory is a copy of the original, so the paths of the files in
+    the job directory are replaced with the corresponding paths in the source
+    directory, `options.source_dir`.
+    '''
+    build_dir = os.path.join(os.path.realpath(os.getcwd()), '')
+    source_dir = getattr(options, 'source_dir', None)
+    hashes = {}
+    for file in [os.path.realpath(quiz_file)] + dependencies:
+        sha = webquiz_util.file_hash(file)
+        if source_dir is not None and file.startswith(build_dir):
+            file = os.path.join(source_dir, file[len(build_dir):])
+        hashes.setdefault(file, sha)
+    return hashes
+
+def is_webquiz_document(tex_file):
+    r'''
+    Return `True` if `tex_file` is a latex file that uses the webquiz document class
+    '''
+    try:
+        with codecs.open(tex_file, 'r', encoding='utf8', errors='replace') as tex:
+            return re.search(r'^[^%\n]*\\documentclass\s*(\[[^]]*\])?\s*\{webquiz\}', tex.read(), re.M) is not None
+    except OSError:
+        return False
+
+def make_quiz(quiz_file, options, settings, metadata):
+    r'''
+    Make the web page for `quiz_file`, which must be in the current directory.
+    This is the job directory for the quiz, so the intermediate files are not
+    removed.
+    '''
+    # the quiz name and the quiz_file will be if pst2pdf is used
+    quiz_name = quiz_file
+    if options.quiet < 2:
+        print('WebQuiz generating web page for {}'.format(quiz_file))
+
+    # use the cached xml file if neither the quiz nor its dependencies have changed
+    if options.cache:
+        cache = webquiz_cache.BuildCache(options, settings, metadata)
+        with options.timer.stage('cache'):
+            cached, reason = cache.restore(quiz_file)
+    else:
+        cached, reason = False, 'the build cache is disabled'
+
+    if options.explain:
+        print('{}: {} because {}'.format(quiz_file,
+                  'using the cached build' if cached else 'rebuilding',
+                  reason)
+        )
+
+    options.pst2pdf = False
+    if cached:
+        # MakeWebQuiz goes straight to the xml file when it is not given a tex file
+        quiz_file = quiz_file[:-4] + '.xml'
+
+    else:
+        # If the pst2podf option is used then we need to preprocess
+        # the latex file BEFORE passing it to MakeWebQuiz. Set
+        # options.pst2pdf = True if pst2pdf is given as an option to
+        # the webquiz documentclass
+        with codecs.open(quiz_file, 'r', encoding='utf8') as q_file:
+            doc = q_file.read()
+
+        try:
+            brac = doc.index(r'\documentclass[') + 15  # start of class options
+            if 'pst2pdf' in [
+                    opt.strip()
+                    for opt in doc[brac:brac+doc[brac:].index(']')].split(',')
+            ]:
+                with options.timer.stage('pst2pdf'):
+                    preprocess_with_pst2pdf(options, settings, quiz_file[:-4])
+                options.pst2pdf = True
+                # now run webquiz on the modified tex file
+                quiz_file = quiz_file[:-4] + '-pdf-fixed.tex'
+        except ValueError:
+            pass
+
+    # the file exists and is readable so make the quiz
+    quiz = webquiz_makequiz.MakeWebQuiz(quiz_name, quiz_file, options, settings, metadata)
+
+    # record the dependencies of the quiz - the build is cached only when
+    # we know what these are
+    if not cached and quiz.dependencies is not None:
+        dependencies = dependency_hashes(quiz_name, quiz.dependencies, options)
+        webquiz_cache.write_dependency_file(quiz_name[:-4], dependencies.keys())
+        if options.cache:
+            with options.timer.stage('cache'):
+                cache.store(quiz_name, dependencies)
+
+    quiz_name = quiz_name[:quiz_name.index('.')]  # remove the extension
+
+    # move the css file into the directory for the quiz
+    css_file = os.path.join(quiz_name, quiz_name + '.css')
+    if os.path.isfile(quiz_name + '.css'):
+        if os.path.isfile(css_file):
+            os.remove(css_file)
+        shutil.move(quiz_name + '.css', css_file)
+
+    # the intermediate files are left in the job directory, which is removed
+    # once the web page and the quiz directory have been moved out of it
+
+#################################################################################
+def promote(src, dst):
+    r'''
+    Move the file or directory `src` to `dst`, replacing any existing files
+    but merging directories, so that files in `dst` that are not in `src` are
+    left alone. Each file is replaced in one step, even when `src` and `dst`
+    are on different file systems, so the web server never sees a file that
+    is half written.
+    '''
+    if os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        for file in os.listdir(src):
+            promote(os.path.join(src, file), os.path.join(dst, file))
+    else:
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        try:
+            os.replace(src, dst)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            # copy the file to the file system of dst and then rename it
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix='.promote-')
+            os.close(fd)
+            try:
+                shutil.copy2(src, tmp_file)
+                os.replace(tmp_file, dst)
+            except OSError:
+                os.remove(tmp_file)
+                raise
+
+@contextlib.contextmanager
+def job_directory(quiz_file, options):
+    r'''
+    Context manager that builds `quiz_file` in a private scratch directory.
+
+    The quiz file is copied into a new job directory in `options.scratch_dir`,
+    which is on /dev/shm by default, and this becomes the current directory.
+    The directory containing the quiz file is added to TEXINPUTS so that TeX
+    can still find any files that the quiz inputs. Once the quiz has been
+    built only the web page, the quiz directory, which holds the quiz
+    specifications, the css file and the images, the dependency file and
+    any quizindex.js file are moved back to the directory containing the
+    quiz, so nothing else is written there. The job directory is then
+    removed, unless we are debugging.
+
+    The build is timed, and profiled with --profile, by a
+    webquiz_timings.QuizTimer, which is `options.timer` inside the context.
+    '''
+    src_dir = os.path.dirname(os.path.abspath(quiz_file))
+    quiz_name = os.path.basename(quiz_file)[:-4]
+    scratch_dir = getattr(options, 'scratch_dir', None) or src_dir
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    with webquiz_timings.QuizTimer(quiz_file, options) as timer:
+        job_dir = tempfile.mkdtemp(prefix='.webquiz-{}-'.format(quiz_name), dir=scratch_dir)
+        shutil.copy2(quiz_file, job_dir)
+
+        cwd = os.getcwd()
+        texinputs = os.environ.get('TEXINPUTS')
+        os.environ['TEXINPUTS'] = os.pathsep.join(['.', src_dir, texinputs or ''])
+        options.source_dir = src_dir
+        options.timer = timer
+        os.chdir(job_dir)
+        built = False
+        try:
+            yield os.path.basename(quiz_file)
+
+            with timer.stage('cleanup'):
+                for output in [quiz_name + '.html', quiz_name + '.d', quiz_name, 'quizindex.js']:
+                    if os.path.exists(output):
+                        promote(output, os.path.join(src_dir, output))
+            built = True
+
+        finally:
+            os.chdir(cwd)
+            options.source_dir = None
+            del options.timer
+            if texinputs is None:
+                del os.environ['TEXINPUTS']
+            else:
+                os.environ['TEXINPUTS'] = texinputs
+
+            if options.debugging and built:
+                print('WebQuiz job directory for {} is {}'.format(quiz_file, job_dir))
+            elif options.debugging:
+                print('WebQuiz was unable to build {} so its job directory {} has been kept'.format(quiz_file, job_dir))
+            else:
+                with timer.stage('cleanup'):
+                    shutil.rmtree(job_dir, ignore_errors=True)
+
+def build_quiz(quiz_file, options, settings, metadata):
+    r'''
+    Build `quiz_file` in its own job directory and return `True` if the build
+    was successful. Any errors are printed but, unlike when building quizzes
+    from the command line, they do not stop the program. This is used when
+    webquiz runs for a long time, such as in watch mode. Interrupts are not
+    caught, so they still stop the program.
+    '''
+    try:
+        with job_directory(quiz_file, options) as job_file:
+            make_quiz(job_file, options, settings, metadata)
+        return True
+
+    except webquiz_util.WebQuizError:
+        # webquiz_error() has printed the error message
+        return False
+
+    except Exception:
+        traceback.print_exc()
+        return False
+
+# set when a worker process is terminated, so that it does not build any more quizzes
+worker_stopped = False
+
+def stop_worker(sig, frame):
+    r'''
+    Stop a worker process, and the programs that it is running, when the
+    worker is terminated. The worker then cancels the jobs that it has
+    already been given rather than building them.
+    '''
+    global worker_stopped
+    worker_stopped = True
+    webquiz_process.stop_all_commands()
+    raise webquiz_util.WebQuizCancelled(128 + sig)
+
+def init_worker():
+    r'''
+    Initialise the worker processes so that, when webquiz is interrupted, the
+    main process rather than its workers decides what to do
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_worker)
+
+def build_quiz_job(quiz_file, options, settings, metadata):
+    r'''
+    Build `quiz_file` in its own job directory. This is the function that is
+    run by the worker processes when quizzes are built in parallel, so all of
+    the output is captured and returned, together with a flag for whether the
+    build was successful, so that the output from the different jobs is not
+    interleaved.
+    '''
+    if worker_stopped:
+        raise webquiz_util.WebQuizCancelled(1)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            set_run_options(options)
+            success = build_quiz(quiz_file, options, settings, metadata)
+        except Exception:
+            traceback.print_exc()
+            success = False
+
+    return success, output.getvalue()
+
+def timed_build_quiz_job(quiz_file, options, settings, metadata):
+    r'''
+    Build `quiz_file` in a worker process, using `build_quiz_job`, and return
+    the triple (success, output, seconds).
+    '''
+    start = time.perf_counter()
+    success, output = build_quiz_job(quiz_file, options, settings, metadata)
+    return success, output, time.perf_counter() - start
+
+def picklable_options(options):
+    r'''
+    Return a copy of `options` that can be passed to the worker processes.
+    The short-cuts in options, such as `options.talk`, are not picklable so
+    they are left out and the workers make their own using `set_run_options`.
+    '''
+    return argparse.Namespace(**{
+        key: val for (key, val) in vars(options).items() if not callable(val)
+    })
+
+def build_quizzes(options, settings, metadata):
+    r'''
+    Run through the list of quizzes in `options.quiz_file` and make them.
+
+    If `options.jobs` is bigger than one then the quizzes are built in
+    parallel using a pool of worker processes, with each quiz being built in
+    its own job directory. The output from each job is printed, prefixed by
+    the name of the quiz, when the job finishes. Returns `True` if all of the
+    quizzes were built successfully.
+    '''
+    all_built = True
+    quiz_files = []
+    for quiz_file in options.quiz_file:
+        # quiz_file is assumed to be a tex file if no extension is given
+        if not '.' in quiz_file:
+            quiz_file += '.tex'
+
+        if not os.path.isfile(quiz_file):
+            print('WebQuiz error: cannot read file {}'.format(quiz_file))
+            all_built = False
+        else:
+            quiz_files.append(quiz_file)
+
+    if options.jobs <= 1 or len(quiz_files) <= 1:
+        set_run_options(options)
+        for quiz_file in quiz_files:
+            if len(options.quiz_file) > 1 and options.quiet < 3:
+                print('Making web page for {}'.format(quiz_file))
+            with job_directory(quiz_file, options) as job_file:
+                make_quiz(job_file, options, settings, metadata)
+
+        return all_built
+
+    job_options = picklable_options(options)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs, initializer=init_worker) as pool:
+        jobs = {
+            pool.submit(build_quiz_job, quiz_file, job_options, settings, metadata): quiz_file
+            for quiz_file in quiz_files
+        }
+        for job in concurrent.futures.as_completed(jobs):
+            quiz_name = os.path.basename(jobs[job])[:-4]
+            try:
+                success, output = job.result()
+            except Exception as err:
+                success, output = False, 'worker process failed: {}'.format(err)
+
+            for line in output.splitlines():
+                print('[{}] {}'.format(quiz_name, line))
+
+            if not success:
+                print('[{}] WebQuiz error: unable to build {}'.format(quiz_name, jobs[job]))
+                all_built = False
+
+    return all_built
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_cache | persistent caches for the files generated by make4ht
+                  | and for the images in the quizzes
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # fcntl is not available on windows
+    fcntl = None
+
+# imports of webquiz code
+import webquiz_util
+
+log = webquiz_util.webquiz_logger('cache')
+
+# ---------------------------------------------------------------------------------------
+# directories in the TeX distribution, which are not tracked as dependencies
+_tex_distribution = None
+
+def tex_distribution():
+    r'''
+    Return the list of directories that contain the files in the TeX
+    distribution. These files change only when the TeX distribution is
+    updated so they are not tracked as dependencies of the quizzes.
+    '''
+    global _tex_distribution
+    if _tex_distribution is None:
+        _tex_distribution = []
+        for var in ['TEXMFDIST', 'TEXMFMAIN', 'TEXMFSYSVAR', 'TEXMFSYSCONFIG', 'TEXMFVAR', 'TEXMFCONFIG']:
+            try:
+                texmf = webquiz_util.kpsewhich('-var-value '+var)
+                if texmf != '':
+                    _tex_distribution.append(os.path.join(os.path.realpath(texmf), ''))
+            except subprocess.CalledProcessError:
+                pass
+    return _tex_distribution
+
+def recorded_dependencies(fls_file, exclude=()):
+    r'''
+    Return the list of files that were read by TeX when it wrote the recorder
+    file `fls_file`. Files that TeX also wrote, files in the TeX distribution
+    and files whose paths start with one of the prefixes in `exclude` are
+    omitted. All paths are absolute.
+    '''
+    pwd = os.getcwd()
+    inputs = []
+    outputs = set()
+    with codecs.open(fls_file, 'r', encoding='utf8', errors='replace') as recorder:
+        for line in recorder:
+            kind, _, path = line.rstrip('\r\n').partition(' ')
+            if kind == 'PWD':
+                pwd = path
+            elif kind == 'INPUT':
+                inputs.append(os.path.realpath(os.path.join(pwd, path)))
+            elif kind == 'OUTPUT':
+                outputs.add(os.path.realpath(os.path.join(pwd, path)))
+
+    ignore = tuple(tex_distribution()) + tuple(os.path.realpath(ex) for ex in exclude)
+    dependencies = []
+    for file in inputs:
+        if (file not in outputs and file not in dependencies
+            and not file.startswith(ignore) and os.path.isfile(file)):
+            dependencies.append(file)
+    return dependencies
+
+def write_dependency_file(quiz_name, dependencies):
+    r'''
+    Write the dependencies of the quiz to the file <quiz_name>.d, which uses
+    the same format as the dependency files written by compilers so that it
+    can be included by make. The dependency files are also used by the
+    webquiz watch mode.
+    '''
+    escape = lambda file: file.replace(' ', '\\ ')
+    with codecs.open(quiz_name + '.d', 'w', encoding='utf8') as dfile:
+        dfile.write('# dependencies of {}.tex generated by webquiz\n'.format(quiz_name))
+        dfile.write('{}.html:{}\n'.format(quiz_name,
+            ''.join(' \\\n  ' + escape(file) for file in dependencies))
+        )
+
+def read_dependency_file(dfile):
+    r'''
+    Return the list of dependencies in the dependency file `dfile`, which is
+    written by `write_dependency_file`.
+    '''
+    with codecs.open(dfile, 'r', encoding='utf8') as dependencies:
+        rule = ''.join(line for line in dependencies if not line.startswith('#'))
+    rule = rule.replace('\\\n', ' ')
+    rule = rule[rule.index(':')+1:]
+    return [file.replace('\\ ', ' ') for file in re.split(r'(?<!\\)\s+', rule) if file != '']
+
+# ---------------------------------------------------------------------------------------
+class BuildCache(object):
+    r'''
+    A content addressed cache of the xml, image and css files that make4ht
+    generates for a quiz. Each cache entry is stored in a directory whose name
+    is the hash of:
+        - the name and contents of the quiz file
+        - the engine, draft, shell-escape, make4ht and driver options
+        - the webquiz version
+    Each entry also records the hashes of the files that the quiz depends
+    upon, such as webquiz.cls and webquiz.cfg, and the entry is only used if
+    none of these files have changed.
+
+    Usage:
+        >>> cache = BuildCache(options, settings, metadata)
+        >>> hit, reason = cache.restore('quiz.tex')
+        ... True, 'no changes since last build'
+        >>> cache.store('quiz.tex', dependencies)
+    '''
+
+    def __init__(self, options, settings, metadata):
+        self.options = options
+        self.settings = settings
+        self.metadata = metadata
+        self.cache_dir = webquiz_util.cache_directory(settings, 'build')
+
+        # the webquiz files used by every quiz
+        self.dependencies = {}
+        for file in ['webquiz.cls', 'webquiz.cfg']:
+            try:
+                self.dependencies[file] = webquiz_util.kpsewhich(file)
+            except subprocess.CalledProcessError:
+                pass
+
+    def key(self, quiz_file):
+        r'''
+        Return the key for the cache entry of `quiz_file`
+        '''
+        key = hashlib.sha256()
+        for value in [os.path.basename(quiz_file),
+                      webquiz_util.file_hash(quiz_file),
+                      self.options.engine,
+                      self.options.draft,
+                      self.options.shell_escape,
+                      self.options.make4ht_options,
+                      self.options.tex4ht_driver,
+                      self.options.image_optimisation,
+                      self.options.fast,
+                      self.metadata.version
+        ]:
+            key.update('{}\n'.format(value).encode('utf8'))
+        return key.hexdigest()
+
+    def entry(self, quiz_file):
+        r'''
+        Return the directory for the cache entry of `quiz_file`
+        '''
+        return os.path.join(self.cache_dir, self.key(quiz_file))
+
+    def changed_dependency(self, dependencies):
+        r'''
+        Return the first file in the dictionary `dependencies` of file hashes
+        that has changed, or `None` if none of them have changed.
+        '''
+        for (file, sha) in dependencies.items():
+            try:
+                if webquiz_util.file_hash(file) != sha:
+                    return file
+            except OSError:
+                return file
+        return None
+
+    def restore(self, quiz_file):
+        r'''
+        If there is an up to date cache entry for `quiz_file` then restore the
+        cached <quiz_name>.xml file and the images and css file in the
+        <quiz_name> directory. Return a pair `(hit, reason)` where `hit` is
+        `True` if the files were restored and `reason` explains why.
+        '''
+        entry = self.entry(quiz_file)
+        try:
+            with codecs.open(os.path.join(entry, 'manifest.json'), 'r', encoding='utf8') as manifest:
+                manifest = json.load(manifest)
+        except (OSError, ValueError):
+            return False, 'there is no cached build for this version of the quiz and options'
+
+        changed = self.changed_dependency(manifest['dependencies'])
+        if changed is not None:
+            return False, '{} has changed'.format(changed)
+
+        try:
+            quiz_name = manifest['quiz_name']
+            shutil.copy2(os.path.join(entry, quiz_name + '.xml'), quiz_name + '.xml')
+            for file in manifest['files']:
+                target = os.path.join(quiz_name, file)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(os.path.join(entry, quiz_name, file), target)
+        except OSError as err:
+            log.debug('unable to restore %s: %s', entry, err)
+            return False, 'the cached build is incomplete'
+
+        # touch the entry so that it is recently used
+        os.utime(entry)
+        return True, 'no changes since the last build'
+
+    def store(self, quiz_file, dependencies=None):
+        r'''
+        Save the <quiz_name>.xml file, together with the images and css file
+        in the <quiz_name> directory that it uses, in the cache entry for
+        `quiz_file`. The dictionary `dependencies` maps the names of the files
+        that the quiz depends upon to their hashes.
+        '''
+        quiz_name = os.path.basename(quiz_file)[:-4]
+        entry = self.entry(quiz_file)
+        try:
+            with codecs.open(quiz_name + '.xml', 'r', encoding='utf8') as xml_file:
+                xml = xml_file.read()
+            files = set(re.findall(r'\b(?:data|src|href)="{}/([^"]+)"'.format(re.escape(quiz_name)), xml))
+            for srcset in re.findall(r'\bsrcset="([^"]+)"', xml):
+                files.update(re.findall(r'(?:^|,)\s*{}/(\S+)'.format(re.escape(quiz_name)), srcset))
+            files.add(quiz_name + '.css')
+            files = sorted(file for file in files if os.path.isfile(os.path.join(quiz_name, file)))
+
+            deps = {file: webquiz_util.file_hash(file) for file in self.dependencies.values()}
+            deps.update(dependencies or {})
+
+            # write the entry into a temporary directory and then move it into place
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_entry = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+            shutil.copy2(quiz_name + '.xml', tmp_entry)
+            for file in files:
+                target = os.path.join(tmp_entry, quiz_name, file)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(os.path.join(quiz_name, file), target)
+            with codecs.open(os.path.join(tmp_entry, 'manifest.json'), 'w', encoding='utf8') as manifest:
+                json.dump(dict(quiz_name=quiz_name, dependencies=deps, files=files), manifest, indent=1)
+
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.replace(tmp_entry, entry)
+
+        except OSError as err:
+            # failing to cache the files is not fatal
+            log.debug('unable to cache %s: %s', quiz_file, err)
+
+# ---------------------------------------------------------------------------------------
+# the ioctl request for cloning a file on filesystems with copy-on-write, from <linux/fs.h>
+FICLONE = 0x40049409
+
+def place_file(source, target):
+    r'''
+    Put a copy of `source` at `target`, sharing the data on disk when this is
+    possible. The file is cloned on filesystems that support copy-on-write,
+    such as btrfs and xfs, and otherwise it is hard linked, or copied if that
+    fails. Return the method that was used.
+    '''
+    if os.path.lexists(target):
+        os.remove(target)
+
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return 'clone'
+        except OSError:
+            if os.path.exists(target):
+                os.remove(target)
+
+    try:
+        os.link(source, target)
+        return 'link'
+    except OSError:
+        shutil.copy2(source, target)
+        return 'copy'
+
+class ImageCache(object):
+    r'''
+    A content addressed cache of the images made from the pictures in the
+    quizzes, which is shared by all quizzes and all builds so that each
+    picture is converted only once. The key for an image is a hash of the
+    picture and of the settings used to convert it. Images are put into the
+    quiz directories by `place_file`. The size of the cache is limited by
+    the image-cache-size setting, with the least recently used images being
+    removed first. The number of hits and misses is recorded for
+    `webquiz --cache-stats`.
+
+    Usage:
+        >>> cache = ImageCache(settings)
+        >>> cache.fetch(key, 'quiz0x.svg')
+        ... False
+        >>> cache.store(key, 'quiz0x.svg')
+        >>> cache.finish()
+    '''
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.cache_dir = webquiz_util.cache_directory(settings, 'images')
+        self.hits = 0
+        self.misses = 0
+
+    def size_limit(self):
+        r'''
+        Return the maximum size of the cache in bytes
+        '''
+        try:
+            return int(float(self.settings['image_cache_size']) * 2**20)
+        except ValueError:
+            return int(float(self.settings.settings['image_cache_size']['default']) * 2**20)
+
+    def entry(self, key, image):
+        r'''
+        Return the file in the cache for the image with `key`. The extension
+        of the cached file is the same as that of `image`.
+        '''
+        return os.path.join(self.cache_dir, key[:2], key + os.path.splitext(image)[1])
+
+    def fetch(self, key, image):
+        r'''
+        If the image with `key` is in the cache then put it at `image` and
+        return `True`, and otherwise return `False`.
+        '''
+        entry = self.entry(key, image)
+        try:
+            if not os.path.isfile(entry):
+                raise FileNotFoundError(entry)
+            place_file(entry, image)
+            os.utime(entry)  # the entry is now the most recently used
+            self.hits += 1
+            return True
+        except OSError:
+            self.misses += 1
+            return False
+
+    def store(self, key, image):
+        r'''
+        Add `image` to the cache using `key`. Failing to do this is not fatal.
+        '''
+        entry = self.entry(key, image)
+        tmp_entry = '{}.tmp-{}'.format(entry, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            place_file(image, tmp_entry)
+            os.replace(tmp_entry, entry)
+        except OSError as err:
+            log.debug('unable to cache %s: %s', image, err)
+
+    def entries(self):
+        r'''
+        Return the list of triples (mtime, size, file) for the images in the cache
+        '''
+        entries = []
+        for (directory, dirs, files) in os.walk(self.cache_dir):
+            for file in files:
+                if file != 'statistics':
+                    try:
+                        stat = os.stat(os.path.join(directory, file))
+                        entries.append((stat.st_mtime, stat.st_size, os.path.join(directory, file)))
+                    except OSError:
+                        pass
+        return entries
+
+    def evict(self):
+        r'''
+        Remove the least recently used images until the cache is within its size limit
+        '''
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        limit = self.size_limit()
+        for (mtime, file_size, file) in sorted(entries):
+            if size <= limit:
+                break
+            try:
+                os.remove(file)
+                size -= file_size
+            except OSError:
+                pass
+
+    def finish(self):
+        r'''
+        Record the number of hits and misses and then enforce the size limit
+        '''
+        if self.hits + self.misses > 0:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(os.path.join(self.cache_dir, 'statistics'), 'a') as stats:
+                    stats.write('{} {}\n'.format(self.hits, self.misses))
+            except OSError:
+                pass
+            self.evict()
+
+    def statistics(self):
+        r'''
+        Return a dictionary of statistics about the cache
+        '''
+        hits = misses = 0
+        try:
+            with open(os.path.join(self.cache_dir, 'statistics'), 'r') as stats:
+                for line in stats:
+                    try:
+                        h, m = line.split()
+                        hits += int(h)
+                        misses += int(m)
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+        entries = self.entries()
+        return dict(images=len(entries), size=sum(entry[1] for entry in entries),
+                    limit=self.size_limit(), hits=hits, misses=misses)
+
+def directory_size(directory):
+    r'''
+    Return the pair (number of files, total size) for the files in `directory`
+    '''
+    files = size = 0
+    for (path, dirs, names) in os.walk(directory):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(path, name))
+                files += 1
+            except OSError:
+                pass
+    return files, size
+
+def print_cache_statistics(settings):
+    r'''
+    Print a report on the build and image caches
+    '''
+    megabytes = lambda size: '{:.1f} MB'.format(size / 2**20)
+
+    build_dir = webquiz_util.cache_directory(settings, 'build')
+    entries = [entry for entry in os.listdir(build_dir) if not entry.startswith('.')] if os.path.isdir(build_dir) else []
+    files, size = directory_size(build_dir)
+    print('Build cache: {}\n  quizzes: {}\n  size:    {}'.format(build_dir, len(entries), megabytes(size)))
+
+    images = ImageCache(settings)
+    stats = images.statistics()
+    lookups = stats['hits'] + stats['misses']
+    print('Image cache: {}'.format(images.cache_dir))
+    print('  images:  {} ({} of {})'.format(stats['images'], megabytes(stats['size']), megabytes(stats['limit'])))
+    print('  hits:    {}'.format(stats['hits']))
+    print('  misses:  {}'.format(stats['misses']))
+    if lookups > 0:
+        print('  hit rate {:.0f}%'.format(100 * stats['hits'] / lookups))
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_images | convert the pictures in a quiz to svg and png images
+                   | in parallel
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import concurrent.futures
+import glob
+import hashlib
+import os
+import re
+import time
+
+# imports of webquiz code
+import webquiz_cache
+import webquiz_process
+import webquiz_util
+
+# ---------------------------------------------------------------------------------------
+def read_lg_images(lg_file):
+    r'''
+    Return the list of pairs (page, image) for the pictures that tex4ht has
+    written to the .idv file, as given by the "--- needs --- image ---" lines
+    in the TeX4ht log file `lg_file`. The pictures are written to the .idv
+    file in the order that they are needed, so the n-th image is on page n.
+    '''
+    images = []
+    needs = re.compile(r'^--- needs --- (\S+) ---')
+    with codecs.open(lg_file, 'r', encoding='utf8', errors='replace') as lg:
+        for line in lg:
+            match = needs.match(line)
+            if match is not None:
+                images.append((len(images)+1, match.group(1)))
+    return images
+
+# the number of bytes of parameters for each DVI opcode, except for the
+# specials and font definitions, whose lengths depend on their contents
+dvi_parameters = [0]*128 + [1, 2, 3, 4, 8, 1, 2, 3, 4, 8, 0, 44, 0, 0, 0,  # 128-142
+                            1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4,      # right, w, x
+                            1, 2, 3, 4, 0, 1, 2, 3, 4, 0, 1, 2, 3, 4       # down, y, z
+                           ] + [0]*64 + [1, 2, 3, 4]                     # fnt_num, fnt
+DVI_BOP, DVI_EOP, DVI_FNT_NUM_0, DVI_FNT1, DVI_XXX1, DVI_FNT_DEF1, DVI_PRE, DVI_POST = 139, 140, 171, 235, 239, 243, 247, 248
+
+def picture_hashes(idv_file):
+    r'''
+    Return a dictionary that maps the page numbers in the DVI file `idv_file`
+    to a hash of the contents of the page. The fonts used on a page are
+    hashed using their definitions, rather than their numbers, and any files
+    named in the specials on the page are hashed using their contents, so
+    identical pictures have the same hash even when they are in different
+    quizzes. An empty dictionary is returned if the file cannot be parsed,
+    such as for the extended DVI files written by xelatex.
+    '''
+    with open(idv_file, 'rb') as idv:
+        dvi = idv.read()
+
+    integer = lambda start, length: int.from_bytes(dvi[start:start+length], 'big')
+    file_name = re.compile(rb'[-\w./]+\.(?:eps|ps|pdf|png|jpe?g|svg)\b')
+    fonts = {}
+    hashes = {}
+    page = 0
+    sha = None
+    pos = 0
+    try:
+        if dvi[0] != DVI_PRE:
+            return {}
+        pos = 15 + dvi[14]
+        while pos < len(dvi):
+            opcode = dvi[pos]
+            if opcode == DVI_POST:
+                break
+            elif opcode == DVI_BOP:
+                # the page counters and the pointer to the previous page are not hashed
+                page += 1
+                sha = hashlib.sha256()
+                pos += 45
+                continue
+            elif opcode == DVI_EOP:
+                hashes[page] = sha.hexdigest()
+                sha = None
+                pos += 1
+                continue
+            elif DVI_FNT_DEF1 <= opcode < DVI_FNT_DEF1+4:
+                k = opcode - DVI_FNT_DEF1 + 1
+                end = pos + 1 + k + 12
+                end += 2 + dvi[end] + dvi[end+1]
+                fonts[integer(pos+1, k)] = dvi[pos+1+k:end]
+                pos = end
+                continue
+            elif DVI_XXX1 <= opcode < DVI_XXX1+4:
+                k = opcode - DVI_XXX1 + 1
+                end = pos + 1 + k + integer(pos+1, k)
+                if sha is not None:
+                    sha.update(dvi[pos:end])
+                    for name in file_name.findall(dvi[pos+1+k:end]):
+                        name = name.decode('utf8', errors='replace')
+                        if os.path.isfile(name):
+                            sha.update(webquiz_util.file_hash(name).encode())
+                pos = end
+                continue
+            elif DVI_FNT_NUM_0 <= opcode < DVI_FNT1+4:
+                if opcode < DVI_FNT1:
+                    font, end = opcode - DVI_FNT_NUM_0, pos + 1
+                else:
+                    k = opcode - DVI_FNT1 + 1
+                    font, end = integer(pos+1, k), pos + 1 + k
+                if sha is not None:
+                    sha.update(b'font' + fonts[font])
+                pos = end
+                continue
+            elif opcode >= len(dvi_parameters):
+                return {}
+
+            end = pos + 1 + dvi_parameters[opcode]
+            if sha is not None:
+                sha.update(dvi[pos:end])
+            pos = end
+
+    except (IndexError, KeyError):
+        return {}
+
+    return hashes
+
+class ImageConverter(object):
+    r'''
+    Convert the pictures that tex4ht writes to the <quiz>.idv file into the
+    svg and png images used by the quiz web page. The svg images are made by
+    dvisvgm. For the png images, dvips is run once to write all of the
+    pictures to separate EPS files and these are then converted by gs. The
+    conversions are run in parallel and the time taken for each image is
+    recorded in the `times` dictionary, with the time taken by the shared
+    dvips command in `dvips_time`. When the build cache is enabled, images
+    that are in the image cache are not converted again. The png images are
+    made at `scale` times the usual resolution.
+
+    Usage:
+        >>> converter = ImageConverter('quiz', options, settings)
+        >>> converter.convert(read_lg_images('quiz.lg'))
+        ... True
+        >>> converter.times
+        ... {'quiz0x.svg': 0.21, 'quiz1x.png': 0.35}
+    '''
+    # the gs options are the same as in latex/webquiz.mk4, where the png
+    # images are made at a resolution of 110 dpi
+    resolution = 110
+    gs_options = ['-sDEVICE=pngalpha', '-r{0}x{0}', '-dEPSCrop', '-dBackgroundColor=16#ffffff',
+                  '-dTextAlphaBits=2', '-dGraphicsAlphaBits=2', '-q', '-dBATCH', '-dNOPAUSE']
+
+    def __init__(self, quiz_file, options, settings, scale=1):
+        self.quiz_file = quiz_file  # without an extension
+        self.options = options
+        self.settings = settings
+        self.gs_options = [option.format(self.resolution*scale) for option in self.gs_options]
+        self.idv_file = quiz_file + '.idv'
+        self.times = {}
+        self.dvips_time = 0
+
+        # share the processors with the other quizzes being built
+        self.workers = max(1, (os.cpu_count() or 1) // max(1, getattr(options, 'jobs', 1)))
+
+    def run(self, cmd):
+        r'''
+        Run `cmd` with a new command runner, as several commands run at once
+        '''
+        run = webquiz_process.CommandRunner(quiet=self.options.quiet,
+                                            limits=webquiz_process.process_limits(self.options))
+        return run(cmd)
+
+    def timed(self, image, convert, *args):
+        r'''
+        Call `convert(*args)`, record how long it takes to make `image` and
+        return `True` if the image was made
+        '''
+        start = time.perf_counter()
+        returncode = convert(*args)
+        self.times[image] = time.perf_counter() - start
+        if returncode != 0 and os.path.isfile(image):
+            os.remove(image)  # the image may be incomplete
+        return returncode == 0 and os.path.isfile(image)
+
+    def dvisvgm(self, page, image):
+        return self.run(['dvisvgm', '-n', '-p', str(page), '-o', image, self.idv_file])
+
+    def dvips(self, page, eps_file):
+        return self.run(['dvips', '-E', '-q', '-Ppdf', '-pp', str(page), self.idv_file, '-o', eps_file])
+
+    def gs(self, eps_file, image):
+        return self.run(['gs', '-sOutputFile='+image] + self.gs_options + [eps_file, '-c', 'quit'])
+
+    def dvips_all(self, pages):
+        r'''
+        Write the pictures on `pages` to separate EPS files using a single
+        dvips command and return the list of EPS files, in order, or `None`
+        if this does not work. As each page is its own section, dvips
+        numbers the files zz<quiz>.001, zz<quiz>.002, ...
+        '''
+        prefix = 'zz' + self.quiz_file
+        for eps_file in glob.glob(prefix + '.[0-9][0-9][0-9]'):
+            os.remove(eps_file)
+        start = time.perf_counter()
+        returncode = self.run(['dvips', '-E', '-q', '-Ppdf', '-i', '-S', '1',
+                               '-pp', ','.join(str(page) for page in pages),
+                               self.idv_file, '-o', prefix + '.ps'])
+        eps_files = ['{}.{:03d}'.format(prefix, n) for n in range(1, len(pages)+1)]
+        if returncode != 0 or not all(os.path.isfile(eps_file) for eps_file in eps_files):
+            return None
+        self.dvips_time = time.perf_counter() - start
+        return eps_files
+
+    def convert_png(self, page, image, eps_file=None):
+        r'''
+        Convert the picture on `page` to the png file `image`, using `eps_file`
+        if dvips has already been run
+        '''
+        if eps_file is None:
+            eps_file = 'zz{}.ps'.format(os.path.splitext(image)[0])
+            returncode = self.dvips(page, eps_file)
+            if returncode != 0:
+                return returncode
+        returncode = self.gs(eps_file, image)
+        if not self.options.debugging:
+            os.remove(eps_file)
+        return returncode
+
+    def conversion_key(self, picture_hash, image):
+        r'''
+        Return the image cache key for the picture with hash `picture_hash`
+        when it is converted to `image`
+        '''
+        key = hashlib.sha256(picture_hash.encode())
+        if image.endswith('.svg'):
+            key.update(b'dvisvgm -n')
+        else:
+            key.update(' '.join(['dvips -E -Ppdf'] + self.gs_options).encode())
+        return key.hexdigest()
+
+    def convert(self, images):
+        r'''
+        Convert the list of (page, image) pairs in `images` in parallel and
+        return `True` if all of the images were made.
+        '''
+        # use the cached images whenever we can
+        keys = {}
+        cache = None
+        if getattr(self.options, 'cache', False):
+            cache = webquiz_cache.ImageCache(self.settings)
+            try:
+                hashes = picture_hashes(self.idv_file)
+            except OSError:
+                hashes = {}
+            keys = {image: self.conversion_key(hashes[page], image)
+                      for (page, image) in images if page in hashes}
+            cached = [image for image in keys if cache.fetch(keys[image], image)]
+            images = [(page, image) for (page, image) in images if image not in cached]
+            if self.options.quiet == 0 and cached != []:
+                print('Using {} cached images'.format(len(cached)))
+
+        png_pages = [page for (page, image) in images if image.endswith('.png')]
+        eps_files = self.dvips_all(png_pages) if len(png_pages) > 1 else None
+        if eps_files is not None:
+            eps_files = dict(zip(png_pages, eps_files))
+
+        jobs = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (page, image) in images:
+                if image.endswith('.svg'):
+                    jobs.append((image, pool.submit(self.timed, image, self.dvisvgm, page, image)))
+                elif image.endswith('.png'):
+                    eps_file = None if eps_files is None else eps_files[page]
+                    jobs.append((image, pool.submit(self.timed, image, self.convert_png, page, image, eps_file)))
+                else:
+                    self.options.talk('WebQuiz warning: unable to convert {}'.format(image))
+
+        failed = []
+        for (image, job) in jobs:
+            try:
+                if not job.result():
+                    failed.append(image)
+            except OSError as err:
+                self.options.talk('WebQuiz warning: unable to convert {}: {}'.format(image, err))
+                failed.append(image)
+
+        if cache is not None:
+            for (page, image) in images:
+                if image in keys and image not in failed:
+                    cache.store(keys[image], image)
+            cache.finish()
+
+        # list the images with the slowest first
+        if self.options.quiet == 0:
+            if eps_files is not None:
+                print('dvips wrote {} pictures in {:.2f} seconds'.format(len(eps_files), self.dvips_time))
+            for image in sorted(self.times, key=self.times.get, reverse=True):
+                print('{} {} in {:.2f} seconds'.format('Failed to convert' if image in failed else 'Converted',
+                                                       image, self.times[image]))
+        return failed == []
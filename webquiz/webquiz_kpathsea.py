@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_kpathsea | find files in the TeX distribution without running
+                     | kpsewhich every time
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+# ---------------------------------------------------------------------------------------
+def run_kpsewhich(search):
+    r'''
+    Run kpsewhich and return its output. A `subprocess.CalledProcessError`
+    is raised if kpsewhich fails, such as when a file is not found.
+    '''
+    return subprocess.check_output('kpsewhich ' + search, stderr=subprocess.STDOUT, shell=True).decode('ascii').strip()
+
+def read_ls_r(root):
+    r'''
+    Read the ls-R database in the directory `root` and return a dictionary
+    that maps each file name to the list of directories that contain it.
+    The directories are given in the order that they appear in the database.
+    '''
+    database = {}
+    directory = root
+    with codecs.open(os.path.join(root, 'ls-R'), 'r', encoding='utf8', errors='replace') as ls_r:
+        for line in ls_r:
+            line = line.rstrip('\r\n')
+            if line == '' or line.startswith('%'):
+                continue
+            if line.endswith(':') and (line.startswith('/') or line.startswith('./')):
+                # start of a new directory, which is relative to root
+                directory = os.path.normpath(os.path.join(root, line[:-1]))
+            else:
+                database.setdefault(line, []).append(directory)
+    return database
+
+class Kpathsea(object):
+    r'''
+    Answer kpsewhich queries in-process. The variables used by webquiz and
+    the TeX search path are read from kpsewhich once, and files are then
+    found using the kpathsea ls-R databases. The answers are saved in the
+    json file `cache_file`, which is discarded whenever an ls-R database, the
+    kpsewhich program or the TEXMF environment variables change, so that
+    kpsewhich is normally only run when the TeX distribution changes.
+    Queries that cannot be answered in-process are passed to kpsewhich.
+
+    Usage:
+        >>> kpathsea = Kpathsea('~/.cache/webquiz/kpathsea.json')
+        >>> kpathsea.kpsewhich('webquiz.cls')
+        ... /usr/local/texlive/2019/texmf-dist/tex/latex/webquiz/webquiz.cls
+        >>> kpathsea.kpsewhich('-var-value TEXMFLOCAL')
+        ... /usr/local/texlive/texmf-local
+    '''
+    # the variables that are read from kpsewhich with a single call
+    variables = ['TEXMFCONFIG', 'TEXMFDIST', 'TEXMFHOME', 'TEXMFLOCAL', 'TEXMFMAIN',
+                 'TEXMFSYSCONFIG', 'TEXMFSYSVAR', 'TEXMFVAR']
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.search_path = []   # directories that are searched before the TeX distribution
+        self.cache = None       # the answers, read from cache_file when first needed
+        self.tex_path = None    # the TeX search path, read from kpsewhich when first needed
+        self.databases = {}     # root directory -> ls-R database
+
+    def signature(self):
+        r'''
+        Return a dictionary that identifies the TeX installation that the
+        cached answers come from.
+        '''
+        kpsewhich = shutil.which('kpsewhich')
+        return dict(
+            kpsewhich=os.path.realpath(kpsewhich) if kpsewhich else '',
+            environment={var: val for (var, val) in os.environ.items() if var.startswith('TEXMF')}
+        )
+
+    def database_mtimes(self):
+        r'''
+        Return a dictionary giving the modification times of the ls-R databases
+        '''
+        mtimes = {}
+        for root in self.cache['databases']:
+            try:
+                mtimes[root] = os.stat(os.path.join(root, 'ls-R')).st_mtime_ns
+            except OSError:
+                mtimes[root] = None
+        return mtimes
+
+    def read_cache(self):
+        r'''
+        Read the cached answers if they are still valid and otherwise start
+        a new cache.
+        '''
+        try:
+            with codecs.open(self.cache_file, 'r', encoding='utf8') as cache_file:
+                self.cache = json.load(cache_file)
+            if (self.cache['signature'] == self.signature()
+                and self.cache['mtimes'] == self.database_mtimes()):
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.cache = dict(signature=self.signature(), databases=None, mtimes={}, variables={}, files={})
+
+    def write_cache(self):
+        r'''
+        Atomically save the cached answers. Failing to do this is not fatal.
+        '''
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.kpathsea-')
+            with codecs.open(fd, 'w', encoding='utf8') as cache_file:
+                json.dump(self.cache, cache_file, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            pass
+
+    def read_kpathsea(self):
+        r'''
+        Use kpsewhich to read the variables, the TeX search path and the
+        location of the ls-R databases. This is done at most once.
+        '''
+        if self.tex_path is not None:
+            return
+
+        # expand all of the variables at once, as lines of the form VAR=value
+        values = run_kpsewhich("-expand-var='{}'".format('\n'.join('{0}=${0}'.format(var) for var in self.variables)))
+        for line in values.split('\n'):
+            var, equals, val = line.partition('=')
+            if var in self.variables and equals == '=' and '$' not in val:
+                self.cache['variables'][var] = val
+
+        self.tex_path = run_kpsewhich('-show-path=tex').split(os.pathsep)
+        if self.cache['databases'] is None:
+            self.cache['databases'] = [
+                root.lstrip('!').rstrip('/') or '/'
+                  for root in run_kpsewhich('-show-path=ls-R').split(os.pathsep) if root != ''
+            ]
+            self.cache['mtimes'] = self.database_mtimes()
+
+    def database(self, directory):
+        r'''
+        Return the ls-R database that covers `directory`, or `None` if there is
+        no such database.
+        '''
+        for root in self.cache['databases']:
+            if (directory == root or directory.startswith(os.path.join(root, ''))) and self.cache['mtimes'][root] is not None:
+                if root not in self.databases:
+                    try:
+                        self.databases[root] = read_ls_r(root)
+                    except OSError:
+                        self.databases[root] = None
+                return self.databases[root]
+        return None
+
+    def search(self, name):
+        r'''
+        Search for the file `name` in the TeX search path in the same way as
+        kpsewhich, using the ls-R database for each part of the path that is
+        covered by one. Return `None` if the file is not found or if the search
+        path cannot be understood.
+        '''
+        for element in self.tex_path:
+            if element == '' or '$' in element or '{' in element:
+                return None
+            database_only = element.startswith('!!')
+            element = element.lstrip('!')
+            recursive = element.endswith('//')
+            directory = os.path.normpath(element)
+            database = self.database(directory)
+            if database is not None:
+                for path in database.get(name, []):
+                    if path == directory or (recursive and path.startswith(os.path.join(directory, ''))):
+                        return os.path.join(path, name)
+            elif not database_only:
+                if recursive:
+                    for (path, dirs, files) in os.walk(directory):
+                        if name in files:
+                            return os.path.join(path, name)
+                elif os.path.isfile(os.path.join(directory, name)):
+                    return os.path.join(element, name) if element == '.' else os.path.join(directory, name)
+        return None
+
+    def find_file(self, name):
+        r'''
+        Return the path to the file `name`, raising `subprocess.CalledProcessError`
+        if it cannot be found.
+        '''
+        # kpsewhich looks in the current directory, and in the directories in
+        # $TEXINPUTS, before the TeX distribution so these are always checked,
+        # as are the directories in the search path
+        for directory in ['.'] + self.search_path + os.environ.get('TEXINPUTS', '').split(os.pathsep):
+            if directory != '' and not directory.endswith('//') and os.path.isfile(os.path.join(directory, name)):
+                return os.path.join(directory, name)
+
+        file = self.cache['files'].get(name)
+        if file is None or not os.path.isfile(file):
+            self.read_kpathsea()
+            file = self.search(name)
+            if file is None:
+                file = run_kpsewhich(name)
+            self.cache['files'][name] = file
+            self.write_cache()
+        return file
+
+    def var_value(self, var):
+        r'''
+        Return the value of the kpathsea variable `var`
+        '''
+        if var not in self.cache['variables']:
+            self.read_kpathsea()
+            if var not in self.cache['variables']:
+                self.cache['variables'][var] = run_kpsewhich('-var-value '+var)
+            self.write_cache()
+        return self.cache['variables'][var]
+
+    def kpsewhich(self, search):
+        r'''
+        Return the answer to the kpsewhich query `search`, which is either the
+        name of a file or has the form '-var-value VAR' or '-var-value=VAR'.
+        Any other query is passed to kpsewhich.
+        '''
+        if self.cache is None:
+            self.read_cache()
+
+        search = search.strip()
+        if search.startswith('-var-value'):
+            var = search[len('-var-value'):].lstrip(' =')
+            if var.isidentifier():
+                return self.var_value(var)
+        elif not search.startswith('-') and os.path.basename(search) == search and ' ' not in search:
+            return self.find_file(search)
+
+        return run_kpsewhich(search)
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_latex | convert quizzes that use only text and mathematics to
+                  | the webquiz xml file without using TeX4ht
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import html
+import re
+
+# ---------------------------------------------------------------------------------------
+class NotInSubset(Exception):
+    r'''
+    Raised when a quiz uses LaTeX that cannot be converted without TeX4ht.
+    The message explains why.
+    '''
+
+# the document class options, and their xml attributes, in webquiz.cls
+class_options = dict(
+    hidesidemenu=('hide_side_menu', 'true'),
+    showsidemenu=('hide_side_menu', 'false'),
+    onepage=('one_page', 'true'),
+    separatepages=('one_page', 'false'),
+    randomorder=('random_order', 'true'),
+    fixedorder=('random_order', 'false'),
+    debugging=('debugging', 'true'),
+)
+article_options = ['10pt', '11pt', '12pt', 'a4paper', 'letterpaper', 'oneside', 'twoside']
+
+# the preamble macros in webquiz.cls, and their default values
+preamble_macros = dict(
+    title='',
+    UnitCode='Unit code?',
+    UnitName='Unit name?',
+    UnitURL='',
+    QuizzesURL='DeFaUlT',
+    BreadCrumb='',
+    BreadCrumbs='DeFaUlT',
+    Department='DeFaUlT',
+    DepartmentURL='DeFaUlT',
+    Institution='DeFaUlT',
+    InstitutionURL='DeFaUlT',
+)
+preamble_aliases = dict(University='Institution', UniversityURL='InstitutionURL')
+math_packages = ['amsfonts', 'amsmath', 'amssymb']
+
+comparisons = ['complex', 'integer', 'lowercase', 'number', 'string']
+
+# the text commands that are converted to html
+text_commands = dict(textbf='strong', textit='em', emph='em', texttt='code')
+text_symbols = {'%': '%', '&': '&amp;', '$': '$', '#': '#', '_': '_', '{': '{', '}': '}', ' ': ' ', ',': '\u2009'}
+text_macros = dict(ldots='\u2026', dots='\u2026', LaTeX='LaTeX', TeX='TeX', noindent='', newline='<br />')
+text_quotes = {'``': '\u201c', "''": '\u201d', '`': '\u2018', "'": '\u2019', '---': '\u2014', '--': '\u2013'}
+lists = dict(itemize='ul', enumerate='ol')
+
+# the tokens in the text of a quiz: mathematics, commands, paragraphs, special characters and quotes
+text_token = re.compile(r'''
+     (?P<math>\$\$.+?\$\$|\$.+?\$|\\\(.+?\\\)|\\\[.+?\\\]
+              |\\begin\{(?P<mathenv>(?:equation|align|gather|multline)\*)\}.*?\\end\{(?P=mathenv)\})
+    |\\(?P<command>[a-zA-Z]+)[ \t]*\n?[ \t]*
+    |\\(?P<symbol>.)
+    |(?P<par>\n[ \t]*\n\s*)
+    |(?P<special>[{}~<>&#^_$])
+    |(?P<quote>``|''|`|'|---|--)
+''', re.S | re.X)
+
+# the commands and environments that give the structure of a quiz
+structure_token = re.compile(r'''\\(?:(?P<env>begin|end)\{(?P<name>question|choice|discussion|quizindex)\}
+                                      |(?P<command>correct|incorrect|feedback|whenRight|whenWrong|answer|quiz|maketitle)(?![a-zA-Z]))''',
+                             re.X)
+
+def strip_comments(latex):
+    r'''
+    Remove the comments from `latex`, together with the newlines that end them
+    '''
+    return re.sub(r'(?<!\\)((?:\\\\)*)%[^\n]*\n?[ \t]*', r'\1', latex)
+
+def read_argument(latex, pos, delimiters='{}'):
+    r'''
+    Return the pair (argument, position) for the argument of a command that
+    starts at `pos`, skipping any white space, where the argument is
+    delimited by `delimiters`. The argument is `None` if there is no argument.
+    The delimiters must be balanced, with square brackets inside braces ignored.
+    '''
+    start = pos
+    while pos < len(latex) and latex[pos] in ' \t\n':
+        pos += 1
+    if pos == len(latex) or latex[pos] != delimiters[0]:
+        return None, start
+
+    depth = 0
+    end = pos
+    while end < len(latex):
+        char = latex[end]
+        if char == '\\':
+            end += 2  # skip the escaped character
+            continue
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth < 0:
+                break
+        if depth == 0 and char == delimiters[1]:
+            return latex[pos+1:end], end+1
+        end += 1
+    raise NotInSubset('of an unbalanced {}'.format(delimiters[0]))
+
+# ---------------------------------------------------------------------------------------
+class QuizConverter(object):
+    r'''
+    Convert a quiz that uses only text, mathematics and the webquiz macros
+    and environments to the same xml file that TeX4ht writes using
+    webquiz.cfg, so that the quiz can be built without TeX4ht. The
+    mathematics is not converted: it is passed, as TeX, to MathJax. A
+    `NotInSubset` exception is raised, explaining why, when the quiz uses
+    anything else.
+
+    Usage:
+        >>> QuizConverter('quiz').write('quiz.xml')
+    '''
+
+    def __init__(self, quiz_file):
+        self.quiz_file = quiz_file  # without the .tex extension
+        with codecs.open(quiz_file + '.tex', 'r', encoding='utf8') as tex_file:
+            latex = strip_comments(tex_file.read())
+
+        begin = latex.find('\\begin{document}')
+        end = latex.find('\\end{document}')
+        if begin < 0 or end < begin:
+            raise NotInSubset('there is no document environment')
+        self.read_preamble(latex[:begin])
+        self.body = latex[begin+len('\\begin{document}'):end]
+
+        self.xml = []
+        self.text_open = False     # true when a <text> tag is open
+        self.open_tag = None       # the item, feedback or when tag that is open
+        self.environment = None    # the question, choice or quizindex environment
+        self.choice_type = 'single'
+        self.choice_columns = '1'
+        self.quiz_number = 0
+
+    # ---- the preamble -------------------------------------------------------
+    def read_preamble(self, preamble):
+        r'''
+        Read the document class options and the webquiz macros from the preamble
+        '''
+        self.options = dict(debugging='false', hide_side_menu='DeFaUlT', language='DeFaUlT',
+                            one_page='DeFaUlT', pst2pdf='false', random_order='DeFaUlT', theme='DeFaUlT')
+        self.macros = dict(preamble_macros)
+
+        match = re.match(r'\s*\\documentclass\s*', preamble)
+        if match is None:
+            raise NotInSubset('the quiz does not start with \\documentclass')
+        options, pos = read_argument(preamble, match.end(), '[]')
+        document_class, pos = read_argument(preamble, pos)
+        if document_class != 'webquiz':
+            raise NotInSubset('the document class is not webquiz')
+        for option in (options or '').split(','):
+            key, equals, value = (part.strip() for part in option.partition('='))
+            if key in class_options and equals == '':
+                attribute, value = class_options[key]
+                self.options[attribute] = value
+            elif key in ['language', 'theme'] and value != '':
+                self.options[key] = value
+            elif key not in article_options + ['']:
+                raise NotInSubset('of the document class option {}'.format(key))
+
+        command = re.compile(r'\\([a-zA-Z]+)\s*')
+        while True:
+            while pos < len(preamble) and preamble[pos] in ' \t\n':
+                pos += 1
+            if pos == len(preamble):
+                break
+            match = command.match(preamble, pos)
+            if match is None:
+                raise NotInSubset('of the text in the preamble')
+            macro = preamble_aliases.get(match.group(1), match.group(1))
+            if macro == 'usepackage':
+                package_options, pos = read_argument(preamble, match.end(), '[]')
+                packages, pos = read_argument(preamble, pos)
+                if package_options is not None or packages is None or any(
+                        package.strip() not in math_packages for package in packages.split(',')):
+                    raise NotInSubset('of \\usepackage{{{}}}'.format(packages))
+            elif macro in self.macros:
+                self.macros[macro], pos = read_argument(preamble, match.end())
+                if self.macros[macro] is None:
+                    raise NotInSubset('\\{} has no argument'.format(macro))
+            else:
+                raise NotInSubset('of \\{} in the preamble'.format(match.group(1)))
+
+    # ---- text ---------------------------------------------------------------
+    def text(self, latex, paragraphs=False):
+        r'''
+        Convert `latex`, which contains only text and mathematics, to html.
+        The paragraphs are put into <p> tags when `paragraphs` is `True` and
+        otherwise, as in webquiz.cfg, they are ignored.
+        '''
+        output = []
+        open_lists = []  # the open itemize and enumerate environments
+        pos = 0
+        while pos < len(latex):
+            match = text_token.search(latex, pos)
+            if match is None:
+                output.append(latex[pos:])
+                break
+            output.append(latex[pos:match.start()])
+            pos = match.end()
+
+            if match.group('math') is not None:
+                math = match.group('math')
+                if math.startswith('$$'):
+                    math = '\\[' + math[2:-2] + '\\]'
+                elif math.startswith('$'):
+                    math = '\\(' + math[1:-1] + '\\)'
+                output.append(html.escape(math, quote=False))
+
+            elif match.group('command') is not None:
+                command = match.group('command')
+                if command in text_commands:
+                    argument, pos = read_argument(latex, pos)
+                    if argument is None:
+                        raise NotInSubset('\\{} has no argument'.format(command))
+                    output.append('<{0}>{1}</{0}>'.format(text_commands[command], self.text(argument)))
+                elif command in text_macros:
+                    output.append(text_macros[command])
+                elif command == 'par':
+                    output.append('</p>\n<p>' if paragraphs else '\n')
+                elif command in ['begin', 'end']:
+                    environment, pos = read_argument(latex, pos)
+                    if environment not in lists:
+                        raise NotInSubset('of the {} environment'.format(environment))
+                    if command == 'begin':
+                        open_lists.append([environment, False])
+                        output.append('<{}>'.format(lists[environment]))
+                    elif open_lists == [] or open_lists[-1][0] != environment:
+                        raise NotInSubset('of an unmatched \\end{{{}}}'.format(environment))
+                    else:
+                        output.append('{}</{}>'.format('</li>' if open_lists[-1][1] else '', lists[environment]))
+                        open_lists.pop()
+                elif command == 'item' and open_lists != []:
+                    output.append('</li><li>' if open_lists[-1][1] else '<li>')
+                    open_lists[-1][1] = True
+                else:
+                    raise NotInSubset('of \\{}'.format(command))
+
+            elif match.group('symbol') is not None:
+                symbol = match.group('symbol')
+                if symbol == '\\':
+                    output.append('<br />')
+                elif symbol in text_symbols:
+                    output.append(text_symbols[symbol])
+                else:
+                    raise NotInSubset('of \\{}'.format(symbol))
+
+            elif match.group('par') is not None:
+                output.append('</p>\n<p>' if paragraphs else '\n')
+
+            elif match.group('special') is not None:
+                special = match.group('special')
+                if special == '{':
+                    group, pos = read_argument(latex, match.start())
+                    output.append(self.text(group, paragraphs))
+                elif special == '~':
+                    output.append('\u00a0')
+                elif special in '<>&':
+                    output.append(html.escape(special))
+                else:
+                    raise NotInSubset('of an unexpected {}'.format(special))
+
+            else:
+                output.append(text_quotes[match.group('quote')])
+
+        if open_lists != []:
+            raise NotInSubset('the {} environment is not closed'.format(open_lists[-1][0]))
+        return ''.join(output)
+
+    def paragraphs(self, latex):
+        r'''
+        Convert `latex` to html paragraphs, as TeX4ht does for discussions
+        '''
+        text = self.text(latex.strip(), paragraphs=True)
+        return '<p>{}</p>\n'.format(text) if text != '' else ''
+
+    # ---- the xml tags ---------------------------------------------------------
+    def emit(self, xml):
+        self.xml.append(xml)
+
+    def open_text(self):
+        self.emit('<text><![CDATA[')
+        self.text_open = True
+
+    def close_text(self):
+        if self.text_open:
+            self.emit(']]></text>\n')
+            self.text_open = False
+
+    def close_tag(self):
+        r'''
+        Close the open item, feedback or when tag, as \WQ@closeTag does
+        '''
+        if self.open_tag in ['item', 'feedback']:
+            self.close_text()
+            self.emit('</{}>\n'.format(self.open_tag))
+        elif self.open_tag == 'when':
+            self.emit('</when>\n')
+        self.open_tag = None
+
+    def require(self, condition, error):
+        if not condition:
+            raise NotInSubset(error)
+
+    # ---- the webquiz macros and environments ---------------------------------------
+    def begin_question(self):
+        self.require(self.environment is None, 'question environments must not be nested')
+        self.environment = 'question'
+        self.question = dict(answer=False, choice=False, when=[])
+        self.emit('\n<question>')
+        self.open_text()
+
+    def end_question(self):
+        self.require(self.environment == 'question', 'of an unmatched \\end{question}')
+        self.require(self.question['answer'] or self.question['choice'],
+                     'each question must contain a choice environment or an \\answer')
+        self.close_text()
+        self.close_tag()
+        self.emit('</question>\n')
+        self.environment = None
+
+    def begin_choice(self, options):
+        self.require(self.environment == 'question' and not self.question['answer'] and not self.question['choice'],
+                     'choice environments must be in a question without an \\answer')
+        self.environment = 'choice'
+        self.items = 0
+        # as in webquiz.cfg, the options are set for each choice environment
+        self.choice_type = 'single'
+        self.choice_columns = '1'
+        for option in (options or '').split(','):
+            key, equals, value = (part.strip() for part in option.partition('='))
+            if key in ['single', 'multiple'] and equals == '':
+                self.choice_type = key
+            elif key == 'columns' and value.isdigit():
+                self.choice_columns = value
+            elif key != '':
+                raise NotInSubset('of the choice option {}'.format(option.strip()))
+        self.close_text()
+        self.emit('<choice type="{}" columns="{}">'.format(self.choice_type, self.choice_columns))
+        self.open_tag = None
+
+    def end_choice(self):
+        self.require(self.environment == 'choice', 'of an unmatched \\end{choice}')
+        self.require(self.items > 0, 'a choice environment has no choices')
+        self.close_tag()
+        self.emit('</choice>')
+        self.environment = 'question'
+        self.question['choice'] = True
+
+    def item(self, correct):
+        self.require(self.environment == 'choice', '\\correct and \\incorrect must be inside a choice environment')
+        self.items += 1
+        self.close_tag()
+        self.emit('<item correct="{}" symbol="({})">'.format(correct, chr(ord('a') + self.items - 1)))
+        self.open_text()
+        self.open_tag = 'item'
+
+    def feedback(self):
+        self.require(self.environment == 'choice' and self.open_tag == 'item', 'of a misplaced \\feedback')
+        self.close_tag()
+        self.emit('<feedback>')
+        self.open_text()
+        self.open_tag = 'feedback'
+
+    def answer(self, prompt, comparison, value):
+        self.require(self.environment == 'question' and not self.question['answer'] and not self.question['choice'],
+                     'each question can contain only one \\answer, and no choice environment')
+        self.require(comparison in comparisons, 'of the answer comparison {}'.format(comparison))
+        self.question['answer'] = True
+        self.close_text()
+        self.emit('<answer prompt="{}" comparison="{}">\n'.format(prompt, comparison))
+        self.open_text()
+        self.emit(self.text(value))
+        self.close_text()
+        self.emit('</answer>\n')
+        self.open_tag = None
+        self.open_text()
+
+    def when(self, when):
+        self.require(self.environment == 'question' and self.question['answer'] and when not in self.question['when'],
+                     'of a misplaced \\when{}'.format(when.capitalize()))
+        self.question['when'].append(when)
+        self.close_text()
+        self.close_tag()
+        self.emit('<when type="{}">'.format(when))
+        self.open_text()
+        self.open_tag = 'when'
+
+    def quiz(self, prompt, url, title):
+        self.require(self.environment == 'quizindex', '\\quiz must appear inside a quizindex environment')
+        self.quiz_number += 1
+        if url is None:
+            url = 'quiz{}.html'.format(self.quiz_number)
+        self.emit('<index_item prompt="{}" url="{}">'.format(prompt, html.escape(url)))
+        self.open_text()
+        self.emit(' {} '.format(self.text(title)))
+        self.close_text()
+        self.emit('</index_item>\n')
+
+    def discussion(self, short_heading, heading, latex):
+        self.require(self.environment is None, 'discussion environments must not be inside other environments')
+        self.require(structure_token.search(latex) is None, 'of the webquiz commands inside a discussion')
+        short_heading = 'Discussion' if short_heading is None else short_heading
+        heading = short_heading if heading is None else heading
+        self.emit('\n<discussion>\n<short_heading>{}</short_heading>\n<heading>{}</heading>\n'.format(
+                  self.text(short_heading), self.text(heading)))
+        self.emit('<text><![CDATA[{}]]></text>\n</discussion>\n'.format(self.paragraphs(latex)))
+
+    # ---- the quiz -------------------------------------------------------------
+    def convert(self):
+        r'''
+        Return the xml file for the quiz
+        '''
+        pos = 0
+        while True:
+            match = structure_token.search(self.body, pos)
+            text = self.body[pos:] if match is None else self.body[pos:match.start()]
+            if self.text_open:
+                self.emit(self.text(text))
+            elif text.strip() != '':
+                raise NotInSubset('of the text outside the questions')
+            if match is None:
+                break
+            pos = match.end()
+
+            env, name, command = match.group('env', 'name', 'command')
+            if env == 'begin' and name == 'question':
+                self.begin_question()
+            elif env == 'end' and name == 'question':
+                self.end_question()
+            elif env == 'begin' and name == 'choice':
+                options, pos = read_argument(self.body, pos, '[]')
+                self.begin_choice(options)
+            elif env == 'end' and name == 'choice':
+                self.end_choice()
+            elif env == 'begin' and name == 'discussion':
+                short_heading, pos = read_argument(self.body, pos, '[]')
+                heading, pos = read_argument(self.body, pos, '[]')
+                end = self.body.find('\\end{discussion}', pos)
+                self.require(end >= 0, 'a discussion environment is not closed')
+                self.discussion(short_heading, heading, self.body[pos:end])
+                pos = end + len('\\end{discussion}')
+            elif env == 'begin' and name == 'quizindex':
+                self.require(self.environment is None, 'quizindex environments must not be inside other environments')
+                self.environment = 'quizindex'
+                self.emit('<quizindex>\n')
+            elif env == 'end' and name == 'quizindex':
+                self.require(self.environment == 'quizindex', 'of an unmatched \\end{quizindex}')
+                self.environment = None
+                self.emit('</quizindex>\n')
+            elif env == 'end':
+                raise NotInSubset('of an unmatched \\end{{{}}}'.format(name))
+            elif command in ['correct', 'incorrect']:
+                self.item('true' if command == 'correct' else 'false')
+            elif command == 'feedback':
+                self.feedback()
+            elif command in ['whenRight', 'whenWrong']:
+                self.when(command[4:].lower())
+            elif command in ['answer', 'quiz']:
+                prompt = 'true'
+                if self.body.startswith('*', pos):
+                    prompt, pos = 'false', pos+1
+                optional, pos = read_argument(self.body, pos, '[]')
+                argument, pos = read_argument(self.body, pos)
+                self.require(argument is not None, '\\{} has no argument'.format(command))
+                if command == 'answer':
+                    self.answer(prompt, optional or 'string', argument)
+                else:
+                    self.quiz(prompt, optional, argument)
+            elif command == 'maketitle':
+                self.require(self.environment is None, 'of a misplaced \\maketitle')
+
+        self.require(self.environment is None, 'the {} environment is not closed'.format(self.environment))
+
+        attribute = lambda value: html.escape(value.strip())
+        return ''.join([
+            '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<!DOCTYPE webquiz SYSTEM "webquiz.dtd">\n',
+            '<webquiz {} math="tex" src="{}.tex">\n'.format(
+                ' '.join('{}="{}"'.format(key, attribute(val)) for (key, val) in sorted(self.options.items())),
+                attribute(self.quiz_file)),
+            '<title>{}</title>\n'.format(self.text(self.macros['title'])),
+            '<breadcrumb breadcrumbs="{}">{}</breadcrumb>\n'.format(attribute(self.macros['BreadCrumbs']),
+                                                                  self.text(self.macros['BreadCrumb'])),
+            '<unit_name url="{}" quizzes_url="{}">{}</unit_name>\n'.format(attribute(self.macros['UnitURL']),
+                                                                         attribute(self.macros['QuizzesURL']),
+                                                                         self.text(self.macros['UnitName'])),
+            '<unit_code>{}</unit_code>\n'.format(self.text(self.macros['UnitCode'])),
+            '<department url="{}">{}</department>\n'.format(attribute(self.macros['DepartmentURL']),
+                                                          self.text(self.macros['Department'])),
+            '<institution url="{}">{}</institution>\n'.format(attribute(self.macros['InstitutionURL']),
+                                                            self.text(self.macros['Institution'])),
+        ] + self.xml + ['</webquiz>\n'])
+
+    def write(self, xml_file):
+        r'''
+        Write the xml file for the quiz to `xml_file`
+        '''
+        xml = self.convert()
+        with codecs.open(xml_file, 'w', encoding='utf8') as xml_out:
+            xml_out.write(xml)
@@ -17,14 +17,22 @@ r'''
 '''
 import subprocess
 import codecs
+import shlex
 import shutil
 import os
 import re
 
+import webquiz_cache
+import webquiz_latex
+import webquiz_optimise
 import webquiz_templates
+import webquiz_tex4ht
+import webquiz_toolchain
 import webquiz_util
 import webquiz_xml
 
+log = webquiz_util.webquiz_logger('makequiz')
+
 #################################################################################
 class MakeWebQuiz(object):
     """
@@ -45,6 +53,9 @@ class MakeWebQuiz(object):
     quiz_questions = ''  # the main quiz page
     side_menu      = ''  # the left hand quiz menu
 
+    # the language files that have been read, which are shared by all quizzes
+    languages = {}
+
     def __init__(self, quiz_name, quiz_file, options, settings, metadata):
         self.options = options
         self.settings = settings
@@ -55,47 +66,62 @@ class MakeWebQuiz(object):
         if  self.webquiz_url[-1] == '/':
             self.webquiz_url =  self.webquiz_url[:len(self.webquiz_url)-1]
 
-        # run htlatex only if quiz_file has a .tex extension
+        # the files that the quiz depends upon, which are read from the
+        # recorder file written by TeX, or None if this file is missing
+        self.dependencies = None
+
+        # run htlatex only if quiz_file has a .tex extension and, with --fast,
+        # only if the quiz uses LaTeX that cannot be converted without TeX4ht
+        timer = self.options.timer
         if extension == 'tex':
-            self.htlatex_quiz_file()
+            if not (self.options.fast and self.convert_latex_subset()):
+                self.htlatex_quiz_file()
 
-        self.read_xml_file()
+        with timer.stage('read_xml_file'):
+            self.read_xml_file()
 
-        # use kpsewhich to fine the webquiz language file
+        # read the webquiz language file
         try:
-            language_file = webquiz_util.kpsewhich('webquiz-{}.lang'.format(self.quiz.language))
+            language_file, self.language = self.read_language_file(self.quiz.language)
         except subprocess.CalledProcessError:
             self.webquiz_error(
                 'kpsewhich is unable to find language file for "{}"'.format(self.quiz.language)
             )
-        # read the language file and store as a dictonary
-        self.language = webquiz_util.MetaData(language_file)
+        if self.dependencies is not None:
+            self.dependencies.append(language_file)
 
         # initialise number of quiz and discussion items
         self.number_discussions = len(self.quiz.discussion_list)
         self.number_questions = len(self.quiz.question_list)
 
         # build the different components of the quiz web page
-        self.add_meta_data()
-        self.add_question_javascript()
-        self.add_side_menu()
-        self.add_quiz_header_and_questions()
-        self.add_breadcrumbs()
+        for add_component in [self.add_meta_data, self.write_quiz_specifications, self.add_question_javascript,
+                              self.add_side_menu, self.add_quiz_header_and_questions, self.add_breadcrumbs]:
+            with timer.stage(add_component.__name__):
+                add_component()
 
         # add the initialisation warning if webquiz has not been initialised
         if self.settings.initialise_warning != '':
             self.breadcrumbs = self.settings.initialise_warning + self.breadcrumbs
 
         # now write the quiz to the html file
-        with codecs.open(self.quiz_name + '.html', 'w', encoding='utf8', errors='replace') as file:
-            # write the quiz in the specified format
-            file.write(self.options.write_web_page(self))
+        with timer.stage('write_web_page'):
+            with codecs.open(self.quiz_name + '.html', 'w', encoding='utf8', errors='replace') as file:
+                # write the quiz in the specified format
+                file.write(self.options.write_web_page(self))
 
-    def webquiz_debug(self, msg):
+    @classmethod
+    def read_language_file(cls, language):
         r'''
-            Customised debugging message for the makequiz module
+        Use kpsewhich to find the webquiz language file for `language` and
+        read it into a dictionary. Return the pair (language file, dictionary).
+        The language files are read only once and then they are shared by all
+        quizzes.
         '''
-        webquiz_util.webquiz_debug(self.settings.debugging, 'makequiz: '+msg)
+        if language not in cls.languages:
+            language_file = webquiz_util.kpsewhich('webquiz-{}.lang'.format(language))
+            cls.languages[language] = (language_file, webquiz_util.MetaData(language_file))
+        return cls.languages[language]
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -180,6 +206,29 @@ class MakeWebQuiz(object):
         return webquiz_templates.breadcrumb_line_url.format(
                     url=url, text=text if text != '' else '?? ' + missing)
 
+    def convert_latex_subset(self):
+        r'''
+        Convert a quiz that uses only text, mathematics and the webquiz macros
+        straight to the xml file, without TeX4ht, and return `True` if this
+        works. The quiz is processed by TeX4ht when this returns `False`.
+        '''
+        try:
+            with self.options.timer.stage('convert_latex_subset'):
+                webquiz_latex.QuizConverter(self.quiz_file).write(self.quiz_name + '.xml')
+        except webquiz_latex.NotInSubset as err:
+            self.options.talk('Processing {}.tex with TeX4ht because {}'.format(self.quiz_name, err))
+            return False
+
+        # the quiz page links to the css file that TeX4ht writes
+        if not os.path.exists(self.quiz_name):
+            os.makedirs(self.quiz_name)
+        with open(os.path.join(self.quiz_name, self.quiz_name + '.css'), 'w') as css_file:
+            css_file.write('/* {}.tex was converted without TeX4ht */\n'.format(self.quiz_name))
+
+        self.options.talk('Converted {}.tex without TeX4ht'.format(self.quiz_name))
+        self.dependencies = []
+        return True
+
     def htlatex_quiz_file(self):
         r'''
         Process the file using htlatex/make4ht. This converts the quiz to an xml
@@ -191,51 +240,118 @@ class MakeWebQuiz(object):
 
         try:
             self.options.talk('Processing {}.tex with TeX4ht'.format(self.quiz_name))
-            # there is a slightly torturous process to convert the engine
-            # settings into a command line option that make4ht understands
-            cmd = 'make4ht --utf8 --config webquiz.cfg {draft} {engine} {escape} {make4ht_options} {quiz_file}.tex'.format(
-                draft='--mode draft' if self.options.draft else '',
-                engine=self.settings.settings['engine']['values'][self.options.engine],
-                escape='--shell-escape' if self.options.shell_escape else '',
-                make4ht_options=self.options.make4ht_options,
-                quiz_file=self.quiz_file
-            )
-            self.options.run(cmd)
-
-            # move the css file into the quiz_file subdirectory
-            if os.path.exists(self.quiz_file + '.css'):
-                shutil.move(
-                    self.quiz_file + '.css',
-                    os.path.join(self.quiz_name, self.quiz_name + '.css'))
-
-            # Now move any images that were created into the quiz_name
-            # subdirectory and update the links in the html file As htlatex
-            # generates an html file, we rename this as an xml file at the same
-            # time - in the cfg file, \Preamable{ext=xml} should lead to an xml
-            # file being created but this doesn't seem to work ??
-            try:
-                fix_img = re.compile(r'^(|.* )\b(data|src)="([-0-9a-zA-Z]*\.(?:png|svg))" (.*)$')
-                with codecs.open(self.quiz_file + '.html', 'r', encoding='utf8', errors='replace') as make4ht_file:
-                    with codecs.open(self.quiz_name + '.xml', 'w', encoding='utf8', errors='replace') as xml_file:
-                        for line in make4ht_file:
-                            match = fix_img.match(line)
-                            if match is None:
-                                xml_file.write(line)
-                            else:
-                                # update html link and move file
-                                start, src, image, rest_of_line = match.groups()
-                                xml_file.write(r'{}{}="{}/{}" {}'.format(
-                                    start, src, self.quiz_name, image, rest_of_line))
-                                shutil.move(image, os.path.join(self.quiz_name, image))
+            with self.options.timer.stage('tex4ht' if self.options.tex4ht_driver == 'webquiz' else 'make4ht'):
+                if self.options.tex4ht_driver == 'webquiz':
+                    # run latex, tex4ht and t4ht ourselves
+                    driver = webquiz_tex4ht.Tex4htDriver(self.quiz_file, self.options, self.settings)
+                    returncode = driver.run()
+                    log.debug('%s LaTeX passes for %s', driver.passes, self.quiz_file)
+                elif self.options.tex4ht_driver == 'fake':
+                    # write the make4ht output from a fixture, without running TeX
+                    returncode = webquiz_toolchain.FakeMake4ht(self.quiz_file, self.options).run()
+                else:
+                    # there is a slightly torturous process to convert the engine
+                    # settings into a command line option that make4ht understands
+                    # the "" arguments are the tex4ht.sty, tex4ht and t4ht options, which
+                    # make4ht must be given before the -recorder option for latex
+                    cmd = ['make4ht', '--utf8', '--config', 'webquiz.cfg']
+                    if self.options.draft:
+                        cmd += ['--mode', 'draft']
+                    engine = self.settings.settings['engine']['values'][self.options.engine]
+                    if engine != '':
+                        cmd.append(engine)
+                    if self.options.shell_escape:
+                        cmd.append('--shell-escape')
+                    cmd += shlex.split(self.options.make4ht_options)
+                    cmd += [self.quiz_file + '.tex', '', '', '', '-recorder']
+                    returncode = self.options.run(cmd)
+
+            if returncode != 0 and not os.path.isfile(self.quiz_file + '.html'):
+                self.webquiz_error('{} was unable to process {}.tex:\n{}'.format(
+                    'TeX4ht' if self.options.tex4ht_driver == 'webquiz' else 'make4ht',
+                    self.quiz_file,
+                    self.options.run.report())
+                )
 
+            # read the files that latex used from the recorder file, ignoring
+            # any files generated by webquiz and pst2pdf
+            try:
+                self.dependencies = webquiz_cache.recorded_dependencies(
+                    self.quiz_file + '.fls',
+                    exclude=[os.path.join(self.quiz_name, ''), self.quiz_name+'-pdf']
+                )
             except OSError as err:
-                self.webquiz_error(
-                    'there was a problem moving the image files for {}'.format(
-                        self.quiz_name), err)
+                log.debug('unable to read the recorder file: %s', err)
+
+            # the images are fixed up and moved into the quiz directory
+            with self.options.timer.stage('images'):
+                # move the css file into the quiz_file subdirectory
+                if os.path.exists(self.quiz_file + '.css'):
+                    shutil.move(
+                        self.quiz_file + '.css',
+                        os.path.join(self.quiz_name, self.quiz_name + '.css'))
+
+                # make the double resolution png images for the srcset attributes
+                if self.options.image_optimisation == 'srcset':
+                    srcset_images = webquiz_optimise.make_srcset_images(self.quiz_file, self.options, self.settings)
+                else:
+                    srcset_images = []
+
+                # Now move any images that were created into the quiz_name
+                # subdirectory and update the links in the html file As htlatex
+                # generates an html file, we rename this as an xml file at the same
+                # time - in the cfg file, \Preamable{ext=xml} should lead to an xml
+                # file being created but this doesn't seem to work ??
+                images = []
+                try:
+                    fix_img = re.compile(r'^(|.* )\b(data|src)="([-0-9a-zA-Z]*\.(?:png|svg))" (.*)$')
+                    with codecs.open(self.quiz_file + '.html', 'r', encoding='utf8', errors='replace') as make4ht_file:
+                        with codecs.open(self.quiz_name + '.xml', 'w', encoding='utf8', errors='replace') as xml_file:
+                            for line in make4ht_file:
+                                match = fix_img.match(line)
+                                if match is None:
+                                    xml_file.write(line)
+                                else:
+                                    # update html link and move file
+                                    start, src, image, rest_of_line = match.groups()
+                                    if src == 'src' and image in srcset_images:
+                                        srcset_image = webquiz_optimise.srcset_image(image)
+                                        xml_file.write(r'{0}src="{1}/{2}" srcset="{1}/{2} 1x, {1}/{3} 2x" {4}'.format(
+                                            start, self.quiz_name, image, srcset_image, rest_of_line))
+                                        shutil.move(srcset_image, os.path.join(self.quiz_name, srcset_image))
+                                        images.append(os.path.join(self.quiz_name, srcset_image))
+                                    else:
+                                        xml_file.write(r'{}{}="{}/{}" {}'.format(
+                                            start, src, self.quiz_name, image, rest_of_line))
+                                    self.collect_image(image)
+                                    images.append(os.path.join(self.quiz_name, image))
+
+                except OSError as err:
+                    self.webquiz_error(
+                        'there was a problem moving the image files for {}'.format(
+                            self.quiz_name), err)
+
+                # minify the svg images and recompress the png images
+                if self.options.image_optimisation != 'none' and images != []:
+                    old_size, new_size = webquiz_optimise.optimise_images(images, self.options)
+                    self.options.talk('Optimised {} images for {}, saving {} bytes ({:.0%})'.format(
+                        len(images), self.quiz_name, old_size-new_size, (old_size-new_size)/max(1, old_size)))
 
         except Exception as err:
             self.webquiz_error( 'something went wrong when running htlatex on {}'.format(self.quiz_file), err)
 
+    def collect_image(self, image):
+        r'''
+        Put `image` into the quiz directory. The images made by make4ht are
+        in the job directory, and they are moved, but the images that the
+        quiz includes from its own directory are copied from there.
+        '''
+        source_dir = getattr(self.options, 'source_dir', None)
+        if os.path.exists(image) or source_dir is None:
+            shutil.move(image, os.path.join(self.quiz_name, image))
+        else:
+            shutil.copy2(os.path.join(source_dir, image), os.path.join(self.quiz_name, image))
+
     def read_xml_file(self):
         r'''
         Read in the webquiz xml file for the quiz and store the xml document
@@ -304,18 +420,16 @@ class MakeWebQuiz(object):
             copyright_years=self.metadata.copyright[:self.metadata.copyright.index(' ')],
             **self.language)
 
-    def add_question_javascript(self):
+    def write_quiz_specifications(self):
         """
-        Add the javascript for the questions to self and write the javascript
-        initialisation file, <quiz>/quiz_specs.js, for the quiz.  When the quiz
-        page is loaded, WebQuizInit reads the quiz_specs initialisation file to
-        load the answers to the questions,  and the headers for the discussion
-        items. We don't explicitly list quiz_specs.js in the meta data for the
-        quiz page because we want to hide this information from the student,
-        although they can easily get this if they open by the javascript
-        console and know what to look for.
+        Write the javascript initialisation file, <quiz>/quiz_specs.js, for
+        the quiz.  When the quiz page is loaded, WebQuizInit reads the
+        quiz_specs initialisation file to load the answers to the questions,
+        and the headers for the discussion items. We don't explicitly list
+        quiz_specs.js in the meta data for the quiz page because we want to
+        hide this information from the student, although they can easily get
+        this if they open by the javascript console and know what to look for.
         """
-
         try:
             os.makedirs(self.quiz_name, exist_ok=True)
             os.chmod(self.quiz_name, mode=0o755)
@@ -358,9 +472,15 @@ class MakeWebQuiz(object):
         except Exception as err:
             self.webquiz_error('error writing quiz specifications', err)
 
+    def add_question_javascript(self):
+        """
+        Add the javascript for the questions to self
+        """
         self.javascript = webquiz_templates.questions_javascript.format(
             webquiz_url=self.webquiz_url,
-            mathjax=self.settings['mathjax']
+            mathjax=self.settings['mathjax'],
+            # quizzes converted without TeX4ht pass their mathematics to MathJax as TeX
+            mathjax_config='TeX-AMS_CHTML' if self.quiz.math == 'tex' else 'MML_CHTML'
         )
         self.webquiz_init = webquiz_templates.webquiz_init.format(
             number_questions=self.number_questions,
@@ -448,7 +568,7 @@ class MakeWebQuiz(object):
             - qnum is the number of the question
         '''
         if question.type == 'input':
-            self.webquiz_debug('Q{}: after_text={}.'.format(qnum, question.after_text))
+            log.debug('Q%s: after_text=%s.', qnum, question.after_text)
             question_options = webquiz_templates.input_answer.format(
                                  size=5+len('{}'.format(question.answer)),
                                  after_text=question.after_text,
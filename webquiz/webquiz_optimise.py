@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_optimise | minify the svg images, recompress the png images and
+                     | make the double resolution png images for srcset
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import concurrent.futures
+import os
+import re
+import struct
+import tempfile
+import zlib
+from xml.etree import ElementTree
+
+# imports of webquiz code
+import webquiz_images
+
+# ---------------------------------------------------------------------------------------
+# the namespace declarations in the svg tag, which are copied to the <defs>
+# so that it can be parsed on its own
+svg_namespaces = re.compile(r'''\sxmlns(?::([\w.-]+))?=(['"])(.*?)\2''')
+
+def remove_unused_definitions(defs, namespaces, used):
+    r'''
+    Return the <defs> element `defs`, as text, without the definitions that
+    do not contain any of the ids in `used`. The <defs> is parsed using
+    ElementTree, with the prefixed (prefix, uri) `namespaces` of the svg tag,
+    and it is returned unchanged if it cannot be parsed. The default
+    namespace is not declared, so the elements are written without a prefix
+    and are in the default namespace of the svg tag.
+    '''
+    namespaces = [(prefix, uri) for (prefix, uri) in namespaces if prefix != '']
+    declarations = ''.join(' xmlns:{}="{}"'.format(prefix, uri) for (prefix, uri) in namespaces)
+    try:
+        root = ElementTree.fromstring('<defs{}>{}'.format(declarations, defs[len('<defs>'):]))
+    except ElementTree.ParseError:
+        return defs
+
+    unused = [definition for definition in root
+              if not any(element.get('id') in used for element in definition.iter())]
+    if unused == []:
+        return defs
+    for definition in unused:
+        root.remove(definition)
+    # keep the prefixes, such as xlink, that are used in the svg file
+    for (prefix, uri) in namespaces:
+        try:
+            ElementTree.register_namespace(prefix, uri)
+        except ValueError:
+            pass
+    defs = ElementTree.tostring(root, encoding='unicode')
+    # the namespaces are already declared in the svg tag
+    for (prefix, uri) in namespaces:
+        defs = defs.replace(' xmlns:{}="{}"'.format(prefix, uri), '', 1)
+    # ElementTree escapes > everywhere else, so this only matches empty tags
+    return defs.replace(' />', '/>')
+
+def minify_svg(svg):
+    r'''
+    Return a minified version of the svg image `svg`. The comments and the
+    unused definitions, such as the glyphs that dvisvgm writes for all of the
+    characters in a font, are removed and, unless the image contains text,
+    so is the white space between the tags. Nothing that changes how the
+    image is drawn is changed.
+    '''
+    svg = re.sub(r'<!--.*?-->', '', svg, flags=re.S)
+
+    # remove the definitions that are never used, which are referenced
+    # either by href="#id" or by url(#id)
+    used = set(re.findall(r'''(?:href=['"]|url\()#([^'")\s]+)''', svg))
+    svg_tag = re.search(r'<svg\b[^>]*>', svg)
+    namespaces = [(m.group(1) or '', m.group(3)) for m in svg_namespaces.finditer(svg_tag.group() if svg_tag else '')]
+    svg = re.sub(r'<defs>.*?</defs>', lambda m: remove_unused_definitions(m.group(), namespaces, used), svg, flags=re.S)
+    svg = re.sub(r'<defs(?:\s[^>]*)?>\s*</defs>\s*|<defs(?:\s[^>]*)?/>\s*', '', svg)
+
+    # white space is significant in text elements
+    if '<text' not in svg:
+        svg = re.sub(r'>\s+<', '><', svg).strip() + '\n'
+    return svg
+
+def is_well_formed(svg):
+    r'''
+    Return True if the svg image `svg`, as bytes, can be parsed
+    '''
+    try:
+        ElementTree.fromstring(svg)
+        return True
+    except ElementTree.ParseError:
+        return False
+
+# ---------------------------------------------------------------------------------------
+# the png chunks that can be dropped without changing the image
+png_signature = b'\x89PNG\r\n\x1a\n'
+png_dispensable = [b'tEXt', b'zTXt', b'iTXt', b'tIME']
+
+def png_chunk(kind, data):
+    r'''
+    Return the png chunk of type `kind` with contents `data`
+    '''
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+def deflate(data, strategy):
+    r'''
+    Return `data` compressed by zlib using the best compression and `strategy`
+    '''
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy)
+    return compressor.compress(data) + compressor.flush()
+
+def recompress_png(png):
+    r'''
+    Return the png image `png` with its image data recompressed using the
+    best zlib compression and with the text and time chunks removed. The
+    pixels are not changed. The original image is returned if it cannot be
+    read, or if recompressing it does not make it smaller.
+    '''
+    if not png.startswith(png_signature):
+        return png
+
+    chunks = []
+    idat = []
+    pos = len(png_signature)
+    try:
+        while pos < len(png):
+            length, kind = struct.unpack('>I4s', png[pos:pos+8])
+            data = png[pos+8:pos+8+length]
+            pos += 12 + length
+            if kind == b'IDAT':
+                if idat == []:
+                    chunks.append((b'IDAT', None))  # where the image data goes
+                idat.append(data)
+            elif kind not in png_dispensable:
+                chunks.append((kind, data))
+            if kind == b'IEND':
+                break
+        pixels = zlib.decompress(b''.join(idat))
+    except (struct.error, zlib.error):
+        return png
+
+    compressed = min((deflate(pixels, strategy) for strategy in [zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED]),
+                     key=len)
+    optimised = png_signature + b''.join(png_chunk(kind, compressed if data is None else data)
+                                         for (kind, data) in chunks)
+    return optimised if len(optimised) < len(png) else png
+
+# ---------------------------------------------------------------------------------------
+def optimise_image(image):
+    r'''
+    Optimise the svg or png file `image` and return the pair (old size, new
+    size). The image is replaced by writing a new file, rather than by
+    changing the old one, because the image may be hard linked to the image
+    cache.
+    '''
+    with open(image, 'rb') as original:
+        data = original.read()
+
+    if image.endswith('.svg'):
+        optimised = minify_svg(data.decode('utf8')).encode('utf8')
+        # never replace an image with one that cannot be read
+        if not is_well_formed(optimised):
+            optimised = data
+    elif image.endswith('.png'):
+        optimised = recompress_png(data)
+    else:
+        optimised = data
+
+    if len(optimised) < len(data):
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(image) or '.', prefix='.optimise-')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(optimised)
+        os.chmod(tmp_file, os.stat(image).st_mode & 0o777)
+        os.replace(tmp_file, image)
+        return len(data), len(optimised)
+
+    return len(data), len(data)
+
+def optimise_images(images, options):
+    r'''
+    Optimise the list of `images` in parallel, using a pool of worker
+    processes, and return the pair (old size, new size) giving their total
+    sizes in bytes. Images that cannot be optimised are left alone.
+    '''
+    # share the processors with the other quizzes being built
+    workers = min(len(images), max(1, (os.cpu_count() or 1) // max(1, getattr(options, 'jobs', 1))))
+
+    # there is no need to start a new process for a single worker
+    if workers > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    with pool:
+        jobs = [(image, pool.submit(optimise_image, image)) for image in images]
+
+    old_size = new_size = 0
+    for (image, job) in jobs:
+        try:
+            old, new = job.result()
+        except (OSError, UnicodeError) as err:
+            options.talk('WebQuiz warning: unable to optimise {}: {}'.format(image, err))
+            continue
+        old_size += old
+        new_size += new
+    return old_size, new_size
+
+# ---------------------------------------------------------------------------------------
+def srcset_image(image):
+    r'''
+    Return the name of the double resolution version of the png `image`
+    '''
+    return image[:-4] + '-2x.png'
+
+def make_srcset_images(quiz_file, options, settings):
+    r'''
+    Make double resolution versions of the png images for `quiz_file`, which
+    has no extension, using the pictures in the .idv file written by tex4ht
+    and return the list of png images that now have one.
+    '''
+    try:
+        images = [(page, image) for (page, image) in webquiz_images.read_lg_images(quiz_file + '.lg')
+                    if image.endswith('.png')]
+    except OSError:
+        return []
+
+    if images == [] or not os.path.isfile(quiz_file + '.idv'):
+        return []
+
+    converter = webquiz_images.ImageConverter(quiz_file, options, settings, scale=2)
+    converter.convert([(page, srcset_image(image)) for (page, image) in images])
+    return [image for (page, image) in images if os.path.isfile(srcset_image(image))]
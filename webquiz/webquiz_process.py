@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_process | run external programs, such as make4ht, and follow
+                    | their progress
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import collections
+import os
+import queue
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# ---------------------------------------------------------------------------------------
+# A progress event parsed from the output of make4ht or TeX4ht. The kind is one of:
+#   pass   - a (La)TeX pass has started; value is the pass number
+#   pages  - a (La)TeX pass has finished; value is the number of pages written
+#   image  - TeX4ht is generating an image; value is the name of the image file
+#   status - a status message from make4ht; value is the message
+#   error  - a (La)TeX or make4ht error; value is the error message
+ProgressEvent = collections.namedtuple('ProgressEvent', ['kind', 'value'])
+
+progress_patterns = [
+    ('pass',   re.compile(r'^This is (?:pdf|e|Lua|Xe)?TeX(?:-\S+)?, Version')),
+    ('pages',  re.compile(r'^Output written on .*? \((\d+) pages?')),
+    ('image',  re.compile(r'^System call: .*?([-\w.]+\.(?:png|svg))\b')),
+    ('status', re.compile(r'^\[STATUS\]\s+(.*)$')),
+    ('error',  re.compile(r'^(?:! (.*)|\[(?:ERROR|FATAL)\]\s+(.*))$')),
+]
+
+# The limits for each command: the wall-clock and CPU time, in seconds, and
+# the memory, in megabytes, where 0 means that there is no limit
+ProcessLimits = collections.namedtuple('ProcessLimits', ['wall_time', 'cpu_time', 'memory'])
+no_limits = ProcessLimits(0, 0, 0)
+
+def process_limits(options):
+    r'''
+    Return the `ProcessLimits` given by the command-line options
+    '''
+    return ProcessLimits(getattr(options, 'time_limit', 0) or 0,
+                         getattr(options, 'cpu_limit', 0) or 0,
+                         getattr(options, 'memory_limit', 0) or 0)
+
+def limit_command(cmd, limits):
+    r'''
+    Return the command `cmd` run by a shell that sets its CPU time and memory
+    `limits` and then executes it, so that the limits are set before the
+    command starts. The limits are not set by `subprocess.Popen` using
+    `preexec_fn` because this is not safe when there are threads, and the
+    commands are run from several threads at once.
+    '''
+    ulimits = []
+    if limits.cpu_time:
+        # the command gets SIGXCPU at the soft limit and SIGKILL at the hard limit
+        ulimits += ['ulimit -S -t {}'.format(limits.cpu_time), 'ulimit -H -t {}'.format(limits.cpu_time+5)]
+    if limits.memory:
+        ulimits.append('ulimit -v {}'.format(limits.memory * 1024))
+    return ['/bin/sh', '-c', '; '.join(ulimits + ['exec "$@"']), 'sh'] + list(cmd)
+
+# the commands that are running, so that they can be stopped by a signal
+running = set()
+running_lock = threading.Lock()
+
+def stop_process_group(proc, grace=2):
+    r'''
+    Stop the command `proc` and all of the programs that it has started, which
+    are in its process group, by terminating them and then, if they are still
+    running after `grace` seconds, killing them
+    '''
+    if os.name != 'posix':
+        if proc.poll() is None:
+            proc.kill()
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        return
+    try:
+        proc.wait(grace)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def stop_all_commands():
+    r'''
+    Stop all of the commands that are running, together with their process
+    groups. This is used when webquiz is interrupted or terminated.
+    '''
+    with running_lock:
+        procs = list(running)
+    for proc in procs:
+        stop_process_group(proc)
+
+class CommandRunner(object):
+    r'''
+    Run external commands, given as lists of arguments, without using a shell.
+    The standard output and error of the command are read line by line as the
+    command runs. Each line is:
+      - parsed for TeX4ht progress, which is saved as a list of `ProgressEvent`s
+        in the `events` attribute
+      - added to `tail`, which keeps the last `tail_length` lines for use in
+        error messages
+      - printed, or not, depending on the quietness:
+          quiet=0 prints everything
+          quiet=1 prints the standard error and any errors
+          quiet=2 prints nothing
+    Output is printed to `sys.stdout`, so it is collected when the quizzes are
+    built in parallel.
+
+    Each command runs in a new process group, so that the command and all of
+    the programs that it starts can be stopped together, with the `limits`
+    on its wall-clock time, CPU time and memory. A command that runs for
+    longer than the wall-clock limit is stopped and `timed_out` is set. A
+    command that is stopped by a signal N has the exit code 128+N.
+
+    Usage:
+        >>> run = CommandRunner(quiet=1, limits=ProcessLimits(600, 0, 0))
+        >>> run(['make4ht', 'quiz.tex'])
+        ... 0
+        >>> run.pages()
+        ... 3
+    '''
+    tail_length = 100
+
+    def __init__(self, quiet=0, limits=no_limits):
+        self.quiet = quiet
+        self.limits = limits
+        self.tail = collections.deque(maxlen=self.tail_length)
+        self.events = []
+        self.returncode = None
+        self.timed_out = False
+
+    def display(self, line, stream, event):
+        r'''
+        Return `True` if `line`, which was written to `stream` and contains
+        `event`, should be printed.
+        '''
+        if self.quiet == 0:
+            return True
+        if self.quiet == 1:
+            return stream == 'stderr' or (event is not None and event.kind == 'error')
+        return False
+
+    def parse_progress(self, line):
+        r'''
+        Return the `ProgressEvent` for `line`, or `None` if the line does not
+        show any progress.
+        '''
+        for (kind, pattern) in progress_patterns:
+            match = pattern.match(line)
+            if match is not None:
+                if kind == 'pass':
+                    return ProgressEvent(kind, len(self.passes())+1)
+                if kind == 'pages':
+                    return ProgressEvent(kind, int(match.group(1)))
+                return ProgressEvent(kind, next((group for group in match.groups() if group), line))
+        return None
+
+    def read_stream(self, name, stream, lines):
+        r'''
+        Read the lines from `stream` and put them into the queue `lines`
+        '''
+        for line in iter(stream.readline, b''):
+            lines.put((name, line.decode('utf8', errors='replace').rstrip('\r\n')))
+        stream.close()
+        lines.put((name, None))
+
+    def __call__(self, cmd, **args):
+        r'''
+        Run the command `cmd`, which is a list of arguments, and return its exit
+        code. The keyword arguments `args` are passed to `subprocess.Popen`.
+        '''
+        self.events = []
+        self.timed_out = False
+        command = cmd
+        if os.name == 'posix':
+            args['start_new_session'] = True
+            if self.limits.cpu_time or self.limits.memory:
+                command = limit_command(cmd, self.limits)
+        else:
+            args['creationflags'] = args.get('creationflags', 0) | subprocess.CREATE_NEW_PROCESS_GROUP
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **args)
+        with running_lock:
+            running.add(proc)
+
+        try:
+            # the two streams are read by separate threads to avoid deadlocks
+            lines = queue.Queue()
+            readers = [threading.Thread(target=self.read_stream, args=(name, stream, lines), daemon=True)
+                         for (name, stream) in [('stdout', proc.stdout), ('stderr', proc.stderr)]]
+            for reader in readers:
+                reader.start()
+
+            deadline = time.monotonic() + self.limits.wall_time if self.limits.wall_time else None
+            open_streams = len(readers)
+            while open_streams > 0:
+                try:
+                    stream, line = lines.get(timeout=None if deadline is None else max(0, deadline-time.monotonic()))
+                except queue.Empty:
+                    self.timed_out = True
+                    stop_process_group(proc)
+                    line = '{} was stopped after {} seconds'.format(cmd[0], self.limits.wall_time)
+                    self.events.append(ProgressEvent('error', line))
+                    self.tail.append(line)
+                    if self.quiet < 2:
+                        print(line)
+                    break
+                if line is None:
+                    open_streams -= 1
+                    continue
+                event = self.parse_progress(line)
+                if event is not None:
+                    self.events.append(event)
+                self.tail.append(line)
+                if self.display(line, stream, event):
+                    print(line)
+
+            # a program that has escaped from the process group could keep the
+            # streams open, so we do not wait for long after a timeout
+            for reader in readers:
+                reader.join(1 if self.timed_out else None)
+            self.returncode = proc.wait()
+
+        finally:
+            if proc.poll() is None:
+                stop_process_group(proc)
+            with running_lock:
+                running.discard(proc)
+
+        if self.returncode < 0:
+            if not self.timed_out:
+                line = '{} was stopped by {}'.format(cmd[0], signal.Signals(-self.returncode).name)
+                self.events.append(ProgressEvent('error', line))
+                self.tail.append(line)
+                if self.quiet < 2:
+                    print(line)
+            self.returncode = 128 - self.returncode
+        sys.stdout.flush()
+        return self.returncode
+
+    def passes(self):
+        r'''
+        Return the list of (La)TeX passes in the last command
+        '''
+        return [event for event in self.events if event.kind == 'pass']
+
+    def pages(self):
+        r'''
+        Return the number of pages written by the last (La)TeX pass, or `None`
+        '''
+        pages = [event.value for event in self.events if event.kind == 'pages']
+        return pages[-1] if pages else None
+
+    def images(self):
+        r'''
+        Return the list of images generated by the last command
+        '''
+        return [event.value for event in self.events if event.kind == 'image']
+
+    def errors(self):
+        r'''
+        Return the list of errors reported by the last command
+        '''
+        return [event.value for event in self.events if event.kind == 'error']
+
+    def report(self, lines=20):
+        r'''
+        Return the last `lines` lines of output, indented for use in error messages
+        '''
+        return '\n'.join('    '+line for line in list(self.tail)[-lines:])
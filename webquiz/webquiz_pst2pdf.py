@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_pst2pdf | convert the pstricks pictures in a quiz to svg images
+                    | using pst2pdf, one picture at a time and in parallel
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import concurrent.futures
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# imports of webquiz code
+import webquiz_cache
+import webquiz_process
+
+# ---------------------------------------------------------------------------------------
+# the environments that pst2pdf converts to images
+pst_environments = re.compile(r'\\begin\{(pspicture\*?|postscript)\}.*?\\end\{\1\}', re.S)
+
+class Pst2pdf(object):
+    r'''
+    Convert the pspicture and postscript environments in a quiz to svg images
+    using pst2pdf and write a new version of the quiz, <quiz>-pdf-fixed.tex,
+    that includes these images instead. Rather than running pst2pdf on the
+    whole quiz, each picture is put in a document of its own, with the
+    preamble of the quiz, and these documents are converted in parallel, in
+    separate scratch directories. When the build cache is enabled, the svg
+    images are kept in the image cache using the hash of the preamble and
+    the picture, so only the pictures that are new, or that have changed,
+    are converted. The time taken for each picture is saved in `times`.
+
+    Usage:
+        >>> pst2pdf = Pst2pdf('quiz', options, settings)
+        >>> pst2pdf.run()
+        ... True
+        >>> pst2pdf.pictures
+        ... ['quiz/quiz-fig-1.svg']
+    '''
+    pst2pdf_options = ['--svg']
+
+    def __init__(self, quiz_file, options, settings):
+        self.quiz_file = quiz_file  # without the .tex extension
+        self.options = options
+        self.settings = settings
+        self.pictures = []
+        self.lines = {}     # svg file -> the line of the quiz file that the picture starts on
+        self.failed = []    # the svg files for the pictures that were not converted
+        self.times = {}
+
+        # share the processors with the other quizzes being built
+        self.workers = max(1, (os.cpu_count() or 1) // max(1, getattr(options, 'jobs', 1)))
+
+    def picture_key(self, preamble, picture):
+        r'''
+        Return the image cache key for `picture` in a document with `preamble`
+        '''
+        key = hashlib.sha256(' '.join(['pst2pdf'] + self.pst2pdf_options).encode())
+        key.update(preamble.encode('utf8'))
+        key.update(picture.encode('utf8'))
+        return key.hexdigest()
+
+    def convert(self, preamble, picture, svg_file):
+        r'''
+        Use pst2pdf to convert `picture` to the svg image `svg_file` and return
+        `True` if this works. The picture is put in a document of its own, with
+        `preamble`, in a scratch directory.
+        '''
+        start = time.perf_counter()
+        scratch_dir = tempfile.mkdtemp(prefix='.pst2pdf-', dir='.')
+        try:
+            with codecs.open(os.path.join(scratch_dir, 'picture.tex'), 'w', encoding='utf8') as tex_file:
+                tex_file.write(preamble + '\\begin{document}\n' + picture + '\n\\end{document}\n')
+
+            # TeX needs to find the files in the directory of the quiz
+            env = dict(os.environ, TEXINPUTS=os.pathsep.join([os.getcwd(), os.environ.get('TEXINPUTS', '')]))
+            run = webquiz_process.CommandRunner(quiet=self.options.quiet,
+                                                limits=webquiz_process.process_limits(self.options))
+            returncode = run(['pst2pdf'] + self.pst2pdf_options + ['--imgdir=images', 'picture.tex'],
+                             cwd=scratch_dir, env=env)
+            svg_files = glob.glob(os.path.join(scratch_dir, 'images', '*.svg'))
+            if returncode != 0 or len(svg_files) != 1:
+                self.options.talk('WebQuiz warning: pst2pdf was unable to convert {}:\n{}'.format(svg_file, run.report()))
+                return False
+            shutil.move(svg_files[0], svg_file)
+            return True
+
+        finally:
+            self.times[svg_file] = time.perf_counter() - start
+            if self.options.debugging:
+                print('WebQuiz pst2pdf directory for {} is {}'.format(svg_file, scratch_dir))
+            else:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def run(self):
+        r'''
+        Convert the pictures in the quiz, write the quiz file with the pictures
+        replaced by the svg images and return `True` if all of the pictures
+        were converted.
+        '''
+        with codecs.open(self.quiz_file + '.tex', 'r', encoding='utf8') as tex_file:
+            quiz = tex_file.read()
+
+        try:
+            begin_document = quiz.index('\\begin{document}')
+        except ValueError:
+            begin_document = len(quiz)
+        preamble = quiz[:begin_document]
+
+        # the svg images are in the quiz_file subdirectory
+        os.makedirs(self.quiz_file, exist_ok=True)
+        pictures = []
+        for picture in pst_environments.finditer(quiz, begin_document):
+            svg_file = '{0}/{0}-fig-{1}.svg'.format(self.quiz_file, len(pictures)+1)
+            pictures.append((picture, svg_file, self.picture_key(preamble, picture.group())))
+            self.lines[svg_file] = quiz.count('\n', 0, picture.start()) + 1
+        self.pictures = [svg_file for (picture, svg_file, key) in pictures]
+
+        # use the cached images whenever we can
+        cache = webquiz_cache.ImageCache(self.settings) if self.options.cache else None
+        if cache is not None:
+            cached = [svg_file for (picture, svg_file, key) in pictures if cache.fetch(key, svg_file)]
+            if self.options.quiet == 0 and cached != []:
+                print('Using {} cached pst2pdf images'.format(len(cached)))
+        else:
+            cached = []
+
+        converted = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for (picture, svg_file, key) in pictures:
+                if svg_file not in cached:
+                    converted[svg_file] = pool.submit(self.convert, preamble, picture.group(), svg_file)
+        failed = self.failed = [svg_file for svg_file in converted if not converted[svg_file].result()]
+
+        if cache is not None:
+            for (picture, svg_file, key) in pictures:
+                if svg_file in converted and svg_file not in failed:
+                    cache.store(key, svg_file)
+            cache.finish()
+
+        # replace the pictures with the images
+        parts = []
+        last = 0
+        for (picture, svg_file, key) in pictures:
+            parts.append(quiz[last:picture.start()])
+            parts.append('\\includegraphics[scale=1]{%s}' % svg_file)
+            last = picture.end()
+        parts.append(quiz[last:])
+        fixed = ''.join(parts).replace('\\begin{document}', '\\usepackage{graphicx}\n\\begin{document}', 1)
+        with codecs.open(self.quiz_file + '-pdf-fixed.tex', 'w', encoding='utf8') as tex_file:
+            tex_file.write(fixed)
+
+        if self.options.quiet == 0:
+            for svg_file in sorted(self.times, key=self.times.get, reverse=True):
+                print('{} {} in {:.2f} seconds'.format('Failed to convert' if svg_file in failed else 'Converted',
+                                                       svg_file, self.times[svg_file]))
+        return failed == []
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_publish | publish the quizzes in a directory tree as releases
+                    | that are switched atomically and can be rolled back
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import datetime
+import os
+import shutil
+import tempfile
+
+# imports of webquiz code
+import webquiz_util
+
+# ---------------------------------------------------------------------------------------
+def publish_directory(options, settings):
+    r'''
+    Return the directory that quizzes are published to, which is given by
+    the --publish-to option or, by default, is the quizzes subdirectory of
+    the webquiz_www directory
+    '''
+    if options.publish_to is not None:
+        return os.path.abspath(os.path.expanduser(options.publish_to))
+    if settings['webquiz_www'] in ['', 'SMS']:
+        webquiz_util.webquiz_error(options.debugging,
+            'publish: the webquiz_www setting is not set, so use --publish-to to give the publish directory')
+    return os.path.join(settings['webquiz_www'], 'quizzes')
+
+class Publisher(object):
+    r'''
+    Publish the web pages and images for a course, which is a directory tree
+    of quizzes, into the publish directory. The files are first added to a
+    content-addressed store, <publish>/.store, where they are named by their
+    sha256 hashes, so only the files that have changed are copied. A new
+    release, <publish>/<course>/releases/<release>, is then made from hard
+    links into the store and the <publish>/<course>/current symbolic link is
+    switched to the new release by renaming a new symbolic link over it, so
+    that the web server always sees either the old release or the new one.
+    The last `keep` releases are kept, so rolling back only changes the
+    current link, and files in the store that are no longer in any release
+    are removed.
+
+    The web server should serve the course from <publish>/<course>/current.
+
+    Usage:
+        >>> publisher = Publisher('unit', options, settings)
+        >>> publisher.publish('unit', manifest)
+        ... '20240101-120000'
+        >>> publisher.rollback()
+        ... '20231231-090000'
+    '''
+
+    def __init__(self, course, options, settings):
+        self.course = course
+        self.options = options
+        self.keep = max(1, options.keep_releases)
+        self.publish_dir = publish_directory(options, settings)
+        self.store_dir = os.path.join(self.publish_dir, '.store')
+        self.course_dir = os.path.join(self.publish_dir, course)
+        self.releases_dir = os.path.join(self.course_dir, 'releases')
+        self.current = os.path.join(self.course_dir, 'current')
+
+    def releases(self):
+        r'''
+        Return the sorted list of releases of the course, oldest first
+        '''
+        try:
+            return sorted(release for release in os.listdir(self.releases_dir) if not release.startswith('.'))
+        except FileNotFoundError:
+            return []
+
+    def current_release(self):
+        r'''
+        Return the release that the current link points to, or `None`
+        '''
+        try:
+            return os.path.basename(os.readlink(self.current))
+        except OSError:
+            return None
+
+    def release_files(self, release):
+        r'''
+        Return a dictionary that maps the files in `release`, relative to the
+        release directory, to their inodes, which are shared with the store
+        '''
+        release_dir = os.path.join(self.releases_dir, release)
+        files = {}
+        for (dirpath, dirnames, filenames) in os.walk(release_dir):
+            for file in filenames:
+                path = os.path.join(dirpath, file)
+                files[os.path.relpath(path, release_dir).replace(os.sep, '/')] = os.stat(path).st_ino
+        return files
+
+    def store(self, source, sha):
+        r'''
+        Add the file `source` to the store, unless a file with hash `sha` is
+        already there, and return the path to the file in the store and
+        whether it was copied
+        '''
+        stored = os.path.join(self.store_dir, sha[:2], sha)
+        if os.path.isfile(stored):
+            return stored, False
+
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(stored), prefix='.publish-')
+        os.close(fd)
+        shutil.copyfile(source, tmp_file)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, stored)
+        return stored, True
+
+    def switch(self, release):
+        r'''
+        Atomically point the current link at `release`
+        '''
+        tmp_link = os.path.join(self.course_dir, '.current-{}'.format(os.getpid()))
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join('releases', release), tmp_link)
+        os.replace(tmp_link, self.current)
+
+    def prune(self):
+        r'''
+        Remove all but the newest `keep` releases, never removing the current
+        release, and then remove the files in the store that are no longer
+        in any release, which are the files that have no other hard links
+        '''
+        current = self.current_release()
+        releases = self.releases()
+        for release in releases[:max(0, len(releases)-self.keep)]:
+            if release != current:
+                shutil.rmtree(os.path.join(self.releases_dir, release))
+
+        for (dirpath, dirnames, filenames) in os.walk(self.store_dir):
+            for file in filenames:
+                path = os.path.join(dirpath, file)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+
+    def publish(self, tree, manifest):
+        r'''
+        Publish the files listed in the build `manifest` for the directory
+        `tree` as a new release and return the name of the release, or
+        `None` if nothing has changed since the current release
+        '''
+        files = {}
+        for quiz in manifest['quizzes']:
+            files.update(quiz['outputs'])
+
+        # nothing to do if the files are the same as in the current release
+        current = self.current_release()
+        if current is not None:
+            stored = {output: os.path.join(self.store_dir, files[output][:2], files[output]) for output in files}
+            if all(os.path.isfile(stored[output]) for output in files):
+                inodes = {output: os.stat(stored[output]).st_ino for output in files}
+                if self.release_files(current) == inodes:
+                    self.options.talk('{} is already published as release {}'.format(tree, current))
+                    return None
+
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d-%H%M%S')
+        release = timestamp
+        number = 1
+        while os.path.exists(os.path.join(self.releases_dir, release)):
+            number += 1
+            release = '{}-{}'.format(timestamp, number)
+
+        # build the release in a hidden directory and then move it into place
+        os.makedirs(self.releases_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=self.releases_dir, prefix='.release-')
+        copied = 0
+        try:
+            for output in sorted(files):
+                stored, new = self.store(os.path.join(tree, output), files[output])
+                copied += new
+                target = os.path.join(staging_dir, *output.split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(stored, target)
+            os.chmod(staging_dir, 0o755)
+            os.rename(staging_dir, os.path.join(self.releases_dir, release))
+        except OSError as err:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            webquiz_util.webquiz_error(self.options.debugging, 'publish: unable to publish {}'.format(tree), err)
+
+        self.switch(release)
+        self.prune()
+        self.options.talk('Published {} files, {} of them new, to {} as release {}'.format(
+                          len(files), copied, self.course_dir, release))
+        return release
+
+    def rollback(self):
+        r'''
+        Point the current link at the release before the current one and
+        return its name
+        '''
+        releases = self.releases()
+        current = self.current_release()
+        if current not in releases or releases.index(current) == 0:
+            webquiz_util.webquiz_error(self.options.debugging,
+                'publish: there is no earlier release of {} in {}'.format(self.course, self.course_dir))
+
+        release = releases[releases.index(current)-1]
+        self.switch(release)
+        if self.options.quiet < 2:
+            print('Rolled {} back from release {} to release {}'.format(self.course, current, release))
+        return release
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_server | build server that accepts jobs over a unix socket,
+                   | together with a client for submitting them
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import time
+
+# imports of webquiz code
+import webquiz_build
+import webquiz_makequiz
+import webquiz_util
+
+# the options that can be changed by build requests, and the types of their values
+job_options = dict(cache=bool, cpu_limit=int, draft=bool, engine=str, explain=bool, fast=bool,
+                   image_optimisation=str, make4ht_options=str, memory_limit=int, profile=bool,
+                   quiet=int, shell_escape=bool, tex4ht_driver=str, time_limit=int, timings=bool)
+
+value_types = {bool: 'true or false', int: 'an integer', str: 'a string'}
+
+# the options whose values must be one of the values of the setting of the same name
+setting_options = ['engine', 'image_optimisation', 'tex4ht_driver']
+
+def check_option(key, val, settings):
+    r'''
+    Raise a `ValueError` unless the option `key` can be set to `val` by a
+    build request, using the same choices as the command-line options
+    '''
+    if key not in job_options:
+        raise ValueError('the {} option cannot be changed'.format(key))
+    if type(val) is not job_options[key]:
+        raise ValueError('the {} option must be {}, not {}'.format(key, value_types[job_options[key]], json.dumps(val)))
+    if key in setting_options and val not in settings.settings[key]['values']:
+        raise ValueError('the {} option must be one of {}, not {}'.format(
+                         key, ', '.join(settings.settings[key]['values']), val))
+
+# ---------------------------------------------------------------------------------------
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+    r'''
+    Handle the build requests from a client. The client sends one request per
+    line, each of which is a json dictionary of the form
+        {"quiz_file": "/path/to/quiz.tex", "options": {"draft": true}}
+    and then closes its end of the connection. The server replies with a json
+    dictionary for each change in the status of each job:
+        {"quiz_file": ..., "status": "queued"}
+        {"quiz_file": ..., "status": "finished", "success": true,
+            "output": ..., "seconds": 2.1, "wait_seconds": 0.3}
+    Invalid requests, including those with options that cannot be changed or
+    that have invalid values, get the status "rejected" and an "error" message.
+    '''
+
+    def reply(self, **message):
+        self.wfile.write((json.dumps(message)+'\n').encode('utf8'))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        jobs = {}
+        for line in self.rfile:
+            # so that a line that is not json is not reported against the previous request
+            request = None
+            try:
+                request = json.loads(line.decode('utf8'))
+                quiz_file = request['quiz_file']
+                if not os.path.isabs(quiz_file) or not os.path.isfile(quiz_file):
+                    raise ValueError('cannot read file {}'.format(quiz_file))
+
+                options = argparse.Namespace(**vars(server.options))
+                overrides = request.get('options', {})
+                if not isinstance(overrides, dict):
+                    raise ValueError('the options must be a json dictionary')
+                for (key, val) in overrides.items():
+                    check_option(key, val, server.settings)
+                    setattr(options, key, val)
+                options.quiz_file = [quiz_file]
+
+            except (KeyError, TypeError, ValueError) as err:
+                self.reply(quiz_file=request.get('quiz_file') if isinstance(request, dict) else None,
+                           status='rejected', error=str(err))
+                continue
+
+            job = server.pool.submit(webquiz_build.timed_build_quiz_job, quiz_file, options, server.settings, server.metadata)
+            jobs[job] = (quiz_file, time.perf_counter())
+            self.reply(quiz_file=quiz_file, status='queued')
+
+        for job in concurrent.futures.as_completed(jobs):
+            quiz_file, submitted = jobs[job]
+            try:
+                success, output, seconds = job.result()
+            except Exception as err:
+                success, output, seconds = False, 'worker process failed: {}'.format(err), 0
+            self.reply(quiz_file=quiz_file,
+                       status='finished',
+                       success=success,
+                       output=output,
+                       seconds=round(seconds, 3),
+                       wait_seconds=round(time.perf_counter()-submitted-seconds, 3)
+            )
+            server.log('{} {} in {:.2f} seconds'.format('built' if success else 'failed to build', quiz_file, seconds))
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    r'''
+    A long-lived build server that listens for build requests on a unix
+    socket. The settings, meta data and language files are read once, when
+    the server starts, and the quizzes are built by a pool of `options.jobs`
+    worker processes, so at most this many quizzes are built concurrently.
+
+    Usage:
+        >>> BuildServer('/tmp/webquiz.socket', options, settings, metadata).serve()
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, options, settings, metadata):
+        self.socket_path = socket_path
+        self.settings = settings
+        self.metadata = metadata
+
+        self.options = webquiz_build.picklable_options(options)
+
+        # remove the socket if it was left behind by a server that has stopped
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                webquiz_util.webquiz_error(settings.debugging,
+                    'a webquiz server is already listening on {}'.format(socket_path))
+            except OSError:
+                os.remove(socket_path)
+            finally:
+                probe.close()
+
+        # read the default language file before the workers are started so
+        # that they inherit it
+        try:
+            webquiz_makequiz.MakeWebQuiz.read_language_file(settings['language'])
+        except subprocess.CalledProcessError:
+            pass
+
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, options.jobs),
+                                                           initializer=webquiz_build.init_worker)
+        super().__init__(socket_path, BuildRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def log(self, msg):
+        print('{} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S'), msg), flush=True)
+
+    def serve(self):
+        r'''
+        Process build requests until the server is interrupted
+        '''
+        # stop cleanly, removing the socket, when interrupted or terminated
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        self.log('webquiz server listening on {} with {} workers'.format(self.socket_path, max(1, self.options.jobs)))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            self.log('webquiz server stopped')
+        finally:
+            self.server_close()
+            self.pool.shutdown(wait=False)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+# ---------------------------------------------------------------------------------------
+def submit_jobs(socket_path, quiz_files, options):
+    r'''
+    Submit the quizzes in `quiz_files` to the webquiz server listening on
+    `socket_path`, print the results as they arrive and return `True` if all
+    of the quizzes were built successfully.
+    '''
+    overrides = {key: getattr(options, key) for key in job_options}
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError as err:
+        webquiz_util.webquiz_error(options.debugging, 'unable to connect to the webquiz server on {}'.format(socket_path), err)
+
+    with client:
+        for quiz_file in quiz_files:
+            # quiz_file is assumed to be a tex file if no extension is given
+            if not '.' in os.path.basename(quiz_file):
+                quiz_file += '.tex'
+            request = dict(quiz_file=os.path.abspath(quiz_file), options=overrides)
+            client.sendall((json.dumps(request)+'\n').encode('utf8'))
+        client.shutdown(socket.SHUT_WR)
+
+        all_built = True
+        for line in client.makefile('r', encoding='utf8'):
+            reply = json.loads(line)
+            quiz_name = os.path.basename(reply['quiz_file'] or '?')
+            if reply['status'] == 'rejected':
+                print('[{}] WebQuiz error: {}'.format(quiz_name, reply['error']))
+                all_built = False
+
+            elif reply['status'] == 'finished':
+                for output in reply['output'].splitlines():
+                    print('[{}] {}'.format(quiz_name, output))
+                print('[{}] {} in {:.2f} seconds (waited {:.2f} seconds)'.format(
+                        quiz_name,
+                        'built' if reply['success'] else 'WebQuiz error: unable to build',
+                        reply['seconds'],
+                        reply['wait_seconds'])
+                )
+                all_built = all_built and reply['success']
+
+            elif options.quiet < 2:
+                print('[{}] {}'.format(quiz_name, reply['status']))
+
+    return all_built
@@ -33,7 +33,7 @@ html_meta = r'''<meta http-equiv="Content-Type" content="text/html; charset=utf-
 
 # javascript for setting up the questions
 questions_javascript = r'''  <script src="{webquiz_url}/js/webquiz.js"></script>
-  <script defer src="{mathjax}?config=MML_CHTML"></script>'''
+  <script defer src="{mathjax}?config={mathjax_config}"></script>'''
 
 mathjs=r'  <script defer src="https://cdnjs.cloudflare.com/ajax/libs/mathjs/5.4.0/math.min.js"></script>'
 
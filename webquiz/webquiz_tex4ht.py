@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_tex4ht | run the LaTeX passes, tex4ht and t4ht for a quiz
+                   | without using make4ht
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import hashlib
+import os
+import shutil
+
+# imports of webquiz code
+import webquiz_images
+import webquiz_util
+
+log = webquiz_util.webquiz_logger('tex4ht')
+
+# ---------------------------------------------------------------------------------------
+# The htlatex incantation that loads tex4ht.sty, with the options TEX4HT_OPTIONS,
+# when the document class is loaded and then inputs the quiz file QUIZ_FILE
+htlatex_input = (
+    r'\makeatletter\def\HCode{\futurelet\HCode\HChar}\def\HChar{\ifx"\HCode'
+    r'\def\HCode"##1"{\Link##1}\expandafter\HCode\else\expandafter\Link\fi}'
+    r'\def\Link#1.a.b.c.{\g@addto@macro\@documentclasshook{\RequirePackage[#1,html]{tex4ht}}'
+    r'\let\HCode\documentstyle\def\documentstyle{\let\documentstyle\HCode'
+    r'\expandafter\def\csname tex4ht\endcsname{#1,html}\def\HCode####1{\documentstyle[tex4ht,}'
+    r'\@ifnextchar[{\HCode}{\documentstyle[tex4ht]}}}\makeatother'
+    r'\HCode TEX4HT_OPTIONS.a.b.c.\input QUIZ_FILE'
+)
+
+class Tex4htDriver(object):
+    r'''
+    Convert a quiz to html by running (La)TeX, tex4ht and t4ht directly, in
+    the same way as htlatex and make4ht. Rather than always running three
+    (La)TeX passes, the .aux, .xref and .4tc files, which hold the cross
+    references, are checksummed after each pass and no more passes are run
+    once they stop changing. These files are saved after each build and are
+    used to seed the next build of the same quiz, so a quiz whose cross
+    references have not changed is rebuilt with a single pass. In draft mode
+    only one pass is run. The pictures are converted to images in parallel,
+    and the time taken for each image is saved in `image_times`.
+
+    Usage:
+        >>> driver = Tex4htDriver('quiz', options, settings)
+        >>> driver.run()
+        ... 0
+        >>> driver.passes
+        ... 1
+    '''
+    max_passes = 5
+    reference_extensions = ['aux', 'xref', '4tc']
+    engines = dict(
+        latex=(['latex'], 'dvi'),
+        lua=(['dvilualatex'], 'dvi'),
+        xelatex=(['xelatex', '-no-pdf'], 'xdv')
+    )
+
+    def __init__(self, quiz_file, options, settings):
+        self.quiz_file = quiz_file  # without the .tex extension
+        self.options = options
+        self.settings = settings
+        self.passes = 0
+        self.image_times = {}
+
+        # the cross references are saved using the full path to the original quiz
+        source_dir = getattr(options, 'source_dir', None) or os.getcwd()
+        key = hashlib.sha256(os.path.realpath(os.path.join(source_dir, quiz_file)).encode('utf8'))
+        self.seed_dir = webquiz_util.cache_directory(settings, 'passes', key.hexdigest())
+
+    def reference_files(self):
+        r'''
+        Return the list of files that hold the cross references
+        '''
+        return [self.quiz_file + '.' + ext for ext in self.reference_extensions]
+
+    def checksums(self):
+        r'''
+        Return the list of checksums of the cross reference files, using
+        `None` for the files that do not exist
+        '''
+        checksums = []
+        for file in self.reference_files():
+            try:
+                checksums.append(webquiz_util.file_hash(file))
+            except OSError:
+                checksums.append(None)
+        return checksums
+
+    def seed(self):
+        r'''
+        Copy the cross reference files from the last build of the quiz into
+        the current directory, unless they are already here
+        '''
+        for file in self.reference_files():
+            saved = os.path.join(self.seed_dir, file)
+            if not os.path.isfile(file) and os.path.isfile(saved):
+                shutil.copy2(saved, file)
+
+    def save(self):
+        r'''
+        Save the cross reference files to seed the next build of the quiz.
+        Failing to do this is not fatal.
+        '''
+        try:
+            os.makedirs(self.seed_dir, exist_ok=True)
+            for file in self.reference_files():
+                if os.path.isfile(file):
+                    shutil.copy2(file, os.path.join(self.seed_dir, file))
+        except OSError as err:
+            log.debug('unable to save %s: %s', file, err)
+
+    def latex(self):
+        r'''
+        Run one (La)TeX pass with tex4ht.sty and return the exit code
+        '''
+        engine, _ = self.engines[self.options.engine]
+        cmd = engine + ['-interaction=nonstopmode', '-recorder']
+        if self.options.shell_escape:
+            cmd.append('-shell-escape')
+        cmd.append(htlatex_input.replace('TEX4HT_OPTIONS', 'webquiz.cfg,charset=utf-8')
+                                .replace('QUIZ_FILE', self.quiz_file + '.tex'))
+        return self.options.run(cmd)
+
+    def run(self):
+        r'''
+        Run the (La)TeX passes, tex4ht and t4ht and return the largest exit
+        code. The passes stop as soon as the cross references are stable.
+        '''
+        self.seed()
+        checksums = self.checksums()
+        returncode = 0
+        for pass_number in range(1, self.max_passes+1):
+            self.passes = pass_number
+            self.options.talk('LaTeX pass {} for {}.tex'.format(self.passes, self.quiz_file))
+            returncode = max(returncode, self.latex())
+            if self.options.draft:
+                break
+            new_checksums = self.checksums()
+            if new_checksums == checksums:
+                break
+            checksums = new_checksums
+
+        _, dvi = self.engines[self.options.engine]
+        if not os.path.isfile(self.quiz_file + '.' + dvi):
+            return returncode or 1
+
+        tex4ht = ['tex4ht', '-f/'+self.quiz_file, '-cmozhtf', '-utf8']
+        if dvi != 'dvi':
+            tex4ht.append('-.'+dvi)
+        returncode = max(returncode, self.options.run(tex4ht))
+        # t4ht -p does not convert the pictures, which we do in parallel
+        returncode = max(returncode, self.options.run(['t4ht', '-p', '-f/'+self.quiz_file]))
+        try:
+            images = webquiz_images.read_lg_images(self.quiz_file + '.lg')
+        except OSError:
+            images = []
+        if images != []:
+            converter = webquiz_images.ImageConverter(self.quiz_file, self.options, self.settings)
+            if not converter.convert(images):
+                returncode = max(returncode, 1)
+            self.image_times = converter.times
+
+        self.save()
+        return returncode
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_timings | time the stages of building a quiz and, optionally,
+                    | profile the python code with cProfile
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import collections
+import contextlib
+import json
+import os
+import time
+
+# the stages that are spent waiting for TeX and the other external programs
+program_stages = ['pst2pdf', 'make4ht', 'tex4ht']
+
+# ---------------------------------------------------------------------------------------
+class QuizTimer(object):
+    r'''
+    Record how long each stage of building `quiz_file` takes. The timer is a
+    context manager that is entered for the whole build, and the stages are
+    timed using `stage()`. Time spent in the same stage more than once is
+    added up and any time that is not in a stage is reported as `other`.
+    When the timer exits:
+      - with --timings, the breakdown is printed and written to the json
+        file <quiz>-timings.json, next to the quiz file
+      - with --profile, the python code run during the build is profiled
+        using cProfile and the statistics are written to <quiz>.prof
+
+    Usage:
+        >>> with QuizTimer('quiz.tex', options) as timer:
+        ...     with timer.stage('make4ht'):
+        ...         run_make4ht()
+        >>> timer.seconds
+        ... {'make4ht': 2.31, 'other': 0.02}
+    '''
+
+    def __init__(self, quiz_file, options):
+        self.quiz_file = quiz_file
+        self.quiz_path = os.path.abspath(quiz_file)[:-4]
+        self.timings = getattr(options, 'timings', False)
+        self.profile = None
+        if getattr(options, 'profile', False):
+            import cProfile
+            self.profile = cProfile.Profile()
+        self.seconds = collections.OrderedDict()
+        self.total = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.total = time.perf_counter() - self.start
+        self.seconds['other'] = max(0, self.total - sum(self.seconds.values()))
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.quiz_path + '.prof')
+            print('Profile for {} written to {}.prof'.format(self.quiz_file, self.quiz_path))
+        if self.timings:
+            self.report(success=exc_type is None)
+        return False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        r'''
+        Context manager that adds the time taken by its body to the stage `name`
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0) + time.perf_counter() - start
+
+    def as_dict(self, success=True):
+        r'''
+        Return the timings as a dictionary that can be written as json
+        '''
+        programs = sum(seconds for (stage, seconds) in self.seconds.items() if stage in program_stages)
+        return dict(
+            quiz=os.path.basename(self.quiz_file),
+            success=success,
+            seconds=round(self.total, 4),
+            programs=round(programs, 4),
+            python=round(self.total - programs, 4),
+            stages=[dict(stage=stage, seconds=round(seconds, 4)) for (stage, seconds) in self.seconds.items()]
+        )
+
+    def report(self, success=True):
+        r'''
+        Print the time taken by each stage and write the timings to the json
+        file <quiz>-timings.json
+        '''
+        timings = self.as_dict(success)
+        print('Timings for {}: {:.3f} seconds, {:.3f} in TeX and pst2pdf and {:.3f} in python'.format(
+              self.quiz_file, timings['seconds'], timings['programs'], timings['python']))
+        for (stage, seconds) in self.seconds.items():
+            print('  {:<36} {:8.3f}s {:4.0%}'.format(stage, seconds, seconds/max(self.total, 1e-9)))
+
+        timings_file = self.quiz_path + '-timings.json'
+        try:
+            with open(timings_file, 'w', encoding='utf8') as json_file:
+                json.dump(timings, json_file, indent=2)
+                json_file.write('\n')
+        except OSError as err:
+            print('WebQuiz warning: unable to write {}: {}'.format(timings_file, err))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_toolchain | a stand-in for make4ht that writes the make4ht output
+                      | for a quiz from a fixture, without running TeX
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import json
+import os
+import random
+import re
+import struct
+import zlib
+
+# imports of webquiz code
+import webquiz_latex
+import webquiz_optimise
+
+# ---------------------------------------------------------------------------------------
+# the fixture, which describes the quiz that the fake make4ht writes, is read
+# from <quiz>.fixture.json and these are its defaults
+fixture_defaults = dict(
+    title='',
+    questions=10,
+    choices=4,
+    discussions=1,
+    index_items=0,
+    images=0,
+    graphics=[],
+    words=30,
+    seed=0,
+)
+
+vocabulary = '''
+    the function is continuous on the closed interval so it attains its maximum
+    and minimum values and by the mean value theorem there is a point where the
+    derivative vanishes hence the integral of the series converges uniformly
+'''.split()
+
+def sentence(rand, length):
+    r'''
+    Return a sentence of `length` words, with some inline mathematics
+    '''
+    text = ' '.join(rand.choice(vocabulary) for word in range(length))
+    return '{} \\(x^{{{}}}+1\\) {}.'.format(text[:len(text)//2], rand.randint(2, 9), text[len(text)//2:])
+
+def cdata(text):
+    r'''
+    Return `text` as the xml text element used by webquiz.cfg
+    '''
+    return '<text><![CDATA[{}]]></text>'.format(text)
+
+def generate_quiz(questions=10, choices=4, discussions=1, index_items=0, words=30, images=(),
+                  seed=0, title='', src='quiz.tex'):
+    r'''
+    Return the xml file for a quiz, in the format that TeX4ht writes using
+    webquiz.cfg, with the given number of `questions`, each of which has
+    `choices` choices, `discussions` discussion items and `index_items` quiz
+    index items, with about `words` words of text in each question and
+    discussion. One question in three is an answer, rather than a choice,
+    question. A quiz with index items has no questions. The list of `images`
+    are put, one per line as TeX4ht does, into the questions.
+    '''
+    rand = random.Random(seed)
+    xml = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n<!DOCTYPE webquiz SYSTEM "webquiz.dtd">\n',
+        '<webquiz debugging="false" hide_side_menu="DeFaUlT" language="DeFaUlT" one_page="DeFaUlT" '
+        'pst2pdf="false" random_order="DeFaUlT" theme="DeFaUlT" src="{}">\n'.format(src),
+        '<title>{}</title>\n'.format(title or 'Quiz with {} questions'.format(questions)),
+        '<breadcrumb breadcrumbs="DeFaUlT"></breadcrumb>\n',
+        '<unit_name url="" quizzes_url="DeFaUlT">Unit name?</unit_name>\n',
+        '<unit_code>Unit code?</unit_code>\n',
+        '<department url="DeFaUlT">DeFaUlT</department>\n',
+        '<institution url="DeFaUlT">DeFaUlT</institution>\n',
+    ]
+
+    for discussion in range(discussions):
+        xml.append('\n<discussion>\n<short_heading>Discussion {0}</short_heading>\n'
+                   '<heading>Discussion {0}</heading>\n'.format(discussion+1))
+        xml.append('{}\n</discussion>\n'.format(cdata(' '.join(sentence(rand, words) for p in range(3)))))
+
+    if index_items > 0:
+        xml.append('<quizindex>\n')
+        for item in range(index_items):
+            xml.append('<index_item prompt="true" url="quiz{}.html">{}\n</index_item>\n'.format(
+                       item+1, cdata(sentence(rand, 6))))
+        xml.append('</quizindex>\n')
+        questions = 0
+
+    images = list(images)
+    for question in range(questions):
+        text = sentence(rand, words)
+        # spread the images out over the questions
+        for image in images[question::max(1, questions)]:
+            text += '\n<img src="{}" alt="{}" class="graphics" />\n'.format(image, image[:-4])
+        xml.append('\n<question>{}\n'.format(cdata(text)))
+        if question % 3 == 2:
+            xml.append('<answer prompt="true" comparison="number">\n{}\n</answer>\n'.format(
+                       cdata(str(rand.randint(1, 100)))))
+            xml.append('<when type="right">{}\n</when>\n'.format(cdata(sentence(rand, words//3))))
+            xml.append('<when type="wrong">{}\n</when>\n'.format(cdata(sentence(rand, words//3))))
+        else:
+            kind = 'single' if question % 3 == 0 else 'multiple'
+            xml.append('<choice type="{}" columns="{}">\n'.format(kind, 1 + question % 2))
+            correct = rand.randrange(max(1, choices))
+            for choice in range(max(1, choices)):
+                right = choice == correct or (kind == 'multiple' and rand.random() < 0.3)
+                xml.append('<item correct="{}" symbol="{}">{}\n<feedback>{}</feedback>\n</item>\n'.format(
+                           'true' if right else 'false', chr(ord('a') + choice % 26),
+                           cdata(sentence(rand, words//3)),
+                           cdata(sentence(rand, words//4))))
+            xml.append('</choice>\n')
+        xml.append('</question>\n')
+
+    xml.append('</webquiz>\n')
+    return ''.join(xml)
+
+def dummy_png():
+    r'''
+    Return a 1x1 white png image
+    '''
+    header = struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)
+    return (webquiz_optimise.png_signature + webquiz_optimise.png_chunk(b'IHDR', header)
+            + webquiz_optimise.png_chunk(b'IDAT', zlib.compress(b'\x00\xff'))
+            + webquiz_optimise.png_chunk(b'IEND', b''))
+
+dummy_svg = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<svg version="1.1" xmlns="http://www.w3.org/2000/svg" width="10.000000pt" height="10.000000pt" '
+             'viewBox="0.000000 0.000000 10.000000 10.000000">\n'
+             '<rect x="1.000000" y="1.000000" width="8.000000" height="8.000000" fill="none" stroke="black"/>\n'
+             '</svg>\n')
+
+# ---------------------------------------------------------------------------------------
+class FakeMake4ht(object):
+    r'''
+    Stand in for make4ht, and for TeX, when the driver is `fake`, so that the
+    python side of the build can be tested and benchmarked without a TeX
+    distribution. The fake writes the files that make4ht writes for
+    <quiz>.tex, using the same names:
+      - <quiz>.html, the quiz in the xml format given by webquiz.cfg, which
+        MakeWebQuiz renames to <quiz>.xml as it moves the images
+      - <quiz>.css
+      - the images <quiz>0x.svg, <quiz>1x.png, ..., as made by tex4ht, and
+        links to the `graphics`, which are the image files that the quiz
+        includes from its own directory
+      - <quiz>.fls, the recorder file, which lists the quiz file and the
+        fixture as the dependencies of the quiz
+    The quiz is described by the fixture <quiz>.fixture.json, which is looked
+    for next to the quiz file and in the source directory of the build. Its
+    keys are given by `fixture_defaults`. When there is no fixture, the
+    numbers of questions, discussions, quiz index items and pictures are
+    counted in the quiz file.
+
+    Usage:
+        >>> FakeMake4ht('quiz', options).run()
+        ... 0
+    '''
+
+    def __init__(self, quiz_file, options):
+        self.quiz_file = quiz_file
+        self.options = options
+        self.fixture_file = None
+        self.fixture = dict(fixture_defaults)
+        self.fixture.update(self.read_fixture())
+
+    def read_fixture(self):
+        r'''
+        Return the fixture for the quiz as a dictionary, counting the quiz
+        components in the quiz file if there is no fixture file
+        '''
+        fixture_name = os.path.basename(self.quiz_file) + '.fixture.json'
+        for directory in ['.', getattr(self.options, 'source_dir', None)]:
+            if directory is not None and os.path.isfile(os.path.join(directory, fixture_name)):
+                self.fixture_file = os.path.abspath(os.path.join(directory, fixture_name))
+                with codecs.open(self.fixture_file, 'r', encoding='utf8') as fixture:
+                    return json.load(fixture)
+
+        with codecs.open(self.quiz_file + '.tex', 'r', encoding='utf8', errors='replace') as tex_file:
+            latex = webquiz_latex.strip_comments(tex_file.read())
+        count = lambda pattern: len(re.findall(pattern, latex))
+        return dict(
+            questions=count(r'\\begin\{question\}'),
+            discussions=count(r'\\begin\{discussion\}'),
+            index_items=count(r'\\quiz(?![a-zA-Z])') if '\\begin{quizindex}' in latex else 0,
+            images=count(r'\\includegraphics|\\begin\{(?:tikzpicture|pspicture)\}'),
+        )
+
+    def run(self):
+        r'''
+        Write the make4ht output for the quiz and return 0, as make4ht would
+        '''
+        quiz_name = os.path.basename(self.quiz_file)
+        images = ['{}{}x.{}'.format(quiz_name, image, 'svg' if image % 2 == 0 else 'png')
+                  for image in range(self.fixture['images'])]
+        for image in images:
+            if image.endswith('.svg'):
+                with open(image, 'w', encoding='utf8') as svg_file:
+                    svg_file.write(dummy_svg)
+            else:
+                with open(image, 'wb') as png_file:
+                    png_file.write(dummy_png())
+
+        with codecs.open(self.quiz_file + '.html', 'w', encoding='utf8') as html_file:
+            html_file.write(generate_quiz(
+                questions=self.fixture['questions'],
+                choices=self.fixture['choices'],
+                discussions=self.fixture['discussions'],
+                index_items=self.fixture['index_items'],
+                words=self.fixture['words'],
+                images=images + list(self.fixture['graphics']),
+                seed=self.fixture['seed'],
+                title=self.fixture['title'],
+                src=quiz_name + '.tex'
+            ))
+
+        with open(self.quiz_file + '.css', 'w', encoding='utf8') as css_file:
+            css_file.write('/* css for {} written by the fake make4ht */\n'.format(quiz_name))
+
+        with open(self.quiz_file + '.fls', 'w', encoding='utf8') as fls_file:
+            fls_file.write('PWD {}\nINPUT {}.tex\n'.format(os.getcwd(), self.quiz_file))
+            if self.fixture_file is not None:
+                fls_file.write('INPUT {}\n'.format(self.fixture_file))
+            fls_file.write('OUTPUT {}.html\n'.format(self.quiz_file))
+
+        self.options.talk('The fake make4ht wrote {}.html with {} questions and {} images'.format(
+                          self.quiz_file, self.fixture['questions'], len(images)))
+        return 0
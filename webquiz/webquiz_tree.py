@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_tree | build all of the quizzes in a directory tree and write
+                 | a manifest of the files that were made
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import codecs
+import concurrent.futures
+import datetime
+import json
+import os
+import re
+import tempfile
+import time
+
+# imports of webquiz code
+import webquiz_build
+import webquiz_latex
+import webquiz_util
+
+# ---------------------------------------------------------------------------------------
+manifest_name = 'webquiz-manifest.json'
+
+# the optional urls of the \quiz commands in a quizindex environment
+quiz_command = re.compile(r'\\quiz(?![a-zA-Z])\s*\*?\s*(?:\[([^\]]*)\])?')
+
+def find_quizzes(tree):
+    r'''
+    Return the sorted list of the webquiz documents in the directory `tree`.
+    Hidden directories, which include the job directories and the release
+    store, are not searched.
+    '''
+    quiz_files = []
+    for (dirpath, dirnames, filenames) in os.walk(tree):
+        dirnames[:] = sorted(directory for directory in dirnames if not directory.startswith('.'))
+        for file in sorted(filenames):
+            quiz_file = os.path.normpath(os.path.join(dirpath, file))
+            if (file.endswith('.tex') and not file.endswith('-pdf-fixed.tex')
+                    and webquiz_build.is_webquiz_document(quiz_file)):
+                quiz_files.append(quiz_file)
+    return quiz_files
+
+def quiz_index_urls(quiz_file):
+    r'''
+    Return the list of urls of the quizzes listed in the quizindex
+    environments of `quiz_file`, or `None` if it has no quiz index. As in
+    webquiz.cls, the quizzes without a url are quiz1.html, quiz2.html, ...
+    '''
+    with codecs.open(quiz_file, 'r', encoding='utf8', errors='replace') as tex_file:
+        latex = webquiz_latex.strip_comments(tex_file.read())
+    if '\\begin{quizindex}' not in latex:
+        return None
+
+    return ['quiz{}.html'.format(number+1) if url == '' else url
+              for (number, url) in enumerate(quiz_command.findall(latex))]
+
+def build_stages(quiz_files):
+    r'''
+    Split `quiz_files` into a list of stages, so that each quiz index page is
+    built in a later stage than the quizzes that it lists, including the
+    index pages of subdirectories. The quizzes in each stage can be built in
+    parallel. Any index pages that list each other are built last.
+    '''
+    listed = {}
+    for quiz_file in quiz_files:
+        listed[quiz_file] = set()
+        for url in quiz_index_urls(quiz_file) or []:
+            url = url.split('#')[0].split('?')[0]
+            if url == '' or '://' in url or url.startswith('/'):
+                continue  # not a page in the tree
+            page = os.path.normpath(os.path.join(os.path.dirname(quiz_file), url))
+            if url.endswith('/') or os.path.isdir(page):
+                page = os.path.join(page, 'index.html')
+            if page.endswith('.html') and page[:-5] + '.tex' in quiz_files and page[:-5] + '.tex' != quiz_file:
+                listed[quiz_file].add(page[:-5] + '.tex')
+
+    stages = []
+    built = set()
+    while len(built) < len(quiz_files):
+        stage = [quiz_file for quiz_file in quiz_files if quiz_file not in built and listed[quiz_file] <= built]
+        if stage == []:
+            stage = [quiz_file for quiz_file in quiz_files if quiz_file not in built]
+        stages.append(stage)
+        built.update(stage)
+    return stages
+
+def quiz_outputs(quiz_file):
+    r'''
+    Return the list of files made when building `quiz_file`: the web page,
+    the files in the quiz directory and, for index pages, quizindex.js
+    '''
+    quiz_dir = os.path.dirname(quiz_file)
+    quiz_name = os.path.basename(quiz_file)[:-4]
+    outputs = [os.path.join(quiz_dir, quiz_name + '.html')]
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(quiz_dir, quiz_name)):
+        dirnames.sort()
+        outputs.extend(os.path.join(dirpath, file) for file in sorted(filenames))
+    if quiz_index_urls(quiz_file) is not None:
+        outputs.append(os.path.join(quiz_dir, 'quizindex.js'))
+    return [output for output in outputs if os.path.isfile(output)]
+
+# ---------------------------------------------------------------------------------------
+class TreeBuilder(object):
+    r'''
+    Build all of the webquiz documents, which are the latex files that use
+    the webquiz document class, in the directory tree `options.tree`. Up to
+    `options.jobs` quizzes are built at once, with each quiz being built in
+    its own job directory, and the quiz index pages are built after the
+    quizzes that they list. Once the quizzes are built, a json manifest is
+    written that gives, for each quiz, the hash of the quiz file, the time
+    taken to build it and the hashes of the files that were made. The
+    manifest also lists the files that have changed since the manifest
+    was last written, and those that have been removed.
+
+    Usage:
+        >>> TreeBuilder(options, settings, metadata).build()
+        ... True
+    '''
+
+    def __init__(self, options, settings, metadata):
+        self.options = options
+        self.settings = settings
+        self.metadata = metadata
+        self.tree = os.path.normpath(options.tree)
+        self.manifest_file = getattr(options, 'manifest', None) or os.path.join(self.tree, manifest_name)
+        self.results = {}   # quiz_file -> (success, seconds)
+        self.manifest = None
+
+    def relative(self, path):
+        r'''
+        Return `path` relative to the top of the tree, using / as the separator
+        '''
+        return os.path.relpath(path, self.tree).replace(os.sep, '/')
+
+    def report(self, quiz_file, success, output):
+        r'''
+        Print the output from building `quiz_file`, prefixed by its path
+        '''
+        name = self.relative(quiz_file)
+        for line in output.splitlines():
+            print('[{}] {}'.format(name, line))
+        if not success:
+            print('[{}] WebQuiz error: unable to build {}'.format(name, quiz_file))
+
+    def build_stage(self, stage, pool):
+        r'''
+        Build the quizzes in `stage`, in parallel when there is a `pool` of
+        worker processes
+        '''
+        if pool is None:
+            for quiz_file in stage:
+                self.options.talk('Making web page for {}'.format(quiz_file))
+                start = time.perf_counter()
+                success = webquiz_build.build_quiz(quiz_file, self.options, self.settings, self.metadata)
+                self.results[quiz_file] = (success, time.perf_counter() - start)
+                if not success:
+                    print('WebQuiz error: unable to build {}'.format(quiz_file))
+            return
+
+        job_options = webquiz_build.picklable_options(self.options)
+        jobs = {
+            pool.submit(webquiz_build.timed_build_quiz_job, quiz_file, job_options, self.settings, self.metadata): quiz_file
+            for quiz_file in stage
+        }
+        for job in concurrent.futures.as_completed(jobs):
+            quiz_file = jobs[job]
+            try:
+                success, output, seconds = job.result()
+            except Exception as err:
+                success, output, seconds = False, 'worker process failed: {}'.format(err), 0
+            self.report(quiz_file, success, output)
+            self.results[quiz_file] = (success, seconds)
+
+    def read_manifest(self):
+        r'''
+        Return the manifest from the last build of the tree, or an empty
+        manifest if there is no readable manifest
+        '''
+        try:
+            with codecs.open(self.manifest_file, 'r', encoding='utf8') as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            return {}
+
+    def write_manifest(self, stages, seconds):
+        r'''
+        Write the json manifest for the build. The manifest is written to a
+        temporary file that then replaces the old manifest, so that it is
+        never left half written.
+        '''
+        old_outputs = {}
+        for quiz in self.read_manifest().get('quizzes', []):
+            old_outputs.update(quiz.get('outputs', {}))
+
+        quizzes = []
+        outputs = {}
+        for (number, stage) in enumerate(stages):
+            for quiz_file in stage:
+                success, quiz_seconds = self.results.get(quiz_file, (False, 0))
+                quiz_outputs_hashes = {self.relative(output): webquiz_util.file_hash(output)
+                                       for output in quiz_outputs(quiz_file)}
+                outputs.update(quiz_outputs_hashes)
+                quizzes.append(dict(
+                    source=self.relative(quiz_file),
+                    source_hash=webquiz_util.file_hash(quiz_file),
+                    index=quiz_index_urls(quiz_file) is not None,
+                    stage=number+1,
+                    success=success,
+                    seconds=round(quiz_seconds, 3),
+                    outputs=quiz_outputs_hashes
+                ))
+
+        manifest = dict(
+            webquiz=self.metadata.version,
+            tree=os.path.abspath(self.tree),
+            built=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            jobs=self.options.jobs,
+            seconds=round(seconds, 3),
+            quizzes=quizzes,
+            changed=sorted(output for output in outputs if old_outputs.get(output) != outputs[output]),
+            removed=sorted(output for output in old_outputs if output not in outputs),
+        )
+
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_file))
+        fd, tmp_file = tempfile.mkstemp(dir=manifest_dir, prefix='.manifest-')
+        with os.fdopen(fd, 'w', encoding='utf8') as tmp:
+            json.dump(manifest, tmp, indent=2, sort_keys=True)
+            tmp.write('\n')
+        os.replace(tmp_file, self.manifest_file)
+        return manifest
+
+    def build(self):
+        r'''
+        Build the quizzes in the tree, write the manifest and return `True`
+        if all of the quizzes were built. When the build is cancelled, by an
+        interrupt, no more quizzes are built and the manifest is not written.
+        '''
+        if not os.path.isdir(self.tree):
+            webquiz_util.webquiz_error(self.options.debugging, 'tree: {} is not a directory'.format(self.tree))
+
+        start = time.perf_counter()
+        quiz_files = find_quizzes(self.tree)
+        if quiz_files == []:
+            self.options.talk('There are no webquiz documents in {}'.format(self.tree))
+        stages = build_stages(quiz_files)
+        webquiz_build.set_run_options(self.options)
+
+        if self.options.jobs > 1 and len(quiz_files) > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.options.jobs,
+                                                          initializer=webquiz_build.init_worker)
+        else:
+            pool = None
+        try:
+            for (number, stage) in enumerate(stages):
+                if len(stages) > 1:
+                    self.options.talk('Building stage {} of {}: {} quizzes'.format(number+1, len(stages), len(stage)))
+                self.build_stage(stage, pool)
+        finally:
+            if pool is not None:
+                # when the build is cancelled the quizzes that are waiting are not built
+                pool.shutdown(cancel_futures=True)
+
+        manifest = self.manifest = self.write_manifest(stages, time.perf_counter() - start)
+        built = [quiz_file for quiz_file in quiz_files if self.results[quiz_file][0]]
+        self.options.talk('Built {} of {} quizzes in {} in {:.2f} seconds, {} files changed, manifest {}'.format(
+                          len(built), len(quiz_files), self.tree, manifest['seconds'],
+                          len(manifest['changed']), self.manifest_file))
+        return len(built) == len(quiz_files)
@@ -14,13 +14,19 @@ r'''
 ------------------------------------------------------------------------------
 '''
 
+import hashlib
+import logging
 import os
 import subprocess
 import shutil
 import stat
 import sys
+import tempfile
 import traceback
 
+# imports of webquiz code
+import webquiz_kpathsea
+
 # ---------------------------------------------------------------------------------------
 # Return the full path for a file in the webquiz directory
 webquiz_file = lambda file: os.path.join(os.path.dirname(os.path.realpath(__file__)), file)
@@ -31,11 +37,75 @@ def shell_command(cmd):
     '''
     return subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True).decode('ascii').strip()
 
+# the in-process kpathsea resolver, which is created when it is first needed
+_kpathsea = None
+
 def kpsewhich(search):
     r'''
     Short-cut to access kpsewhich output. usage: kpsewhich('-var-value=TEXMFLOCAL')
+    Whenever possible the answer is found in-process, using the ls-R
+    databases, and kpsewhich is run only when it is really needed.
+    '''
+    return kpathsea().kpsewhich(search)
+
+def kpathsea():
+    r'''
+    Return the Kpathsea object that answers the kpsewhich queries
+    '''
+    global _kpathsea
+    if _kpathsea is None:
+        _kpathsea = webquiz_kpathsea.Kpathsea(cache_directory(None, 'kpathsea.json'))
+    return _kpathsea
+
+def search_source_tree():
+    r'''
+    Find the webquiz LaTeX files, such as the language files, in the latex
+    directory of the webquiz source tree, when webquiz is run from one,
+    before looking in the TeX distribution. This lets quizzes be built with
+    the fake make4ht on machines without TeX.
+    '''
+    latex_dir = os.path.normpath(webquiz_file(os.path.join('..', 'latex')))
+    if os.path.isdir(latex_dir) and latex_dir not in kpathsea().search_path:
+        kpathsea().search_path.insert(0, latex_dir)
+
+def file_hash(filename):
+    r'''
+    Return the sha256 hash of the contents of `filename`
     '''
-    return subprocess.check_output('kpsewhich ' + search, stderr=subprocess.STDOUT, shell=True).decode('ascii').strip()
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def cache_directory(settings, *subdirectories):
+    r'''
+    Return the path to the webquiz cache directory, or to one of its
+    subdirectories. This is given by the cache_dir setting and otherwise
+    defaults to $XDG_CACHE_HOME/webquiz, or ~/.cache/webquiz. The default is
+    always used when `settings` is `None`, which is needed when the settings
+    have not been read yet.
+    '''
+    cache_dir = '' if settings is None else settings['cache_dir']
+    if cache_dir == '':
+        cache_dir = os.path.join(
+            os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+            'webquiz'
+        )
+    return os.path.join(os.path.expanduser(cache_dir), *subdirectories)
+
+def scratch_directory(scratch_dir):
+    r'''
+    Return the directory for the job directories that quizzes are built in,
+    which is `scratch_dir`, from the --scratch-dir option or the scratch_dir
+    setting, or when this is empty /dev/shm, which is in memory on linux, if
+    it is writable and otherwise the system temporary directory
+    '''
+    if scratch_dir != '':
+        return os.path.abspath(os.path.expanduser(scratch_dir))
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK | os.X_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
 # ---------------------------------------------------------------------------------------
 class MetaData(dict):
@@ -67,21 +137,76 @@ class MetaData(dict):
 
 
 #################################################################################
-def webquiz_debug(debugging, *arg):
-    if debugging:
-        sys.stderr.write(' '.join('{}'.format(a) for a in arg)+'\n')
+# The debugging messages are logged by the loggers webquiz.main, webquiz.xml,
+# webquiz.makequiz, ..., which are children of the webquiz logger, and they
+# are formatted only when debugging is on. Use webquiz_logger() to get them.
+webquiz_logger = lambda module: logging.getLogger('webquiz.' + module)
+
+class StderrHandler(logging.StreamHandler):
+    r'''
+    Log to the current value of sys.stderr, which is redirected when quizzes
+    are built in parallel so that the output of each job can be collected
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+def set_logging(debugging, log_file=None):
+    r'''
+    Log the debugging messages of the webquiz loggers when `debugging` is
+    `True`, and otherwise only warnings and errors. The messages are written
+    to stderr or, if it is given, to `log_file`. The handler is only replaced
+    when a `log_file` is given, or when there is no handler yet, so this can
+    also be used to turn debugging on part way through.
+    '''
+    logger = logging.getLogger('webquiz')
+    if log_file is not None or logger.handlers == []:
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+        handler = StderrHandler() if log_file is None else logging.FileHandler(log_file, encoding='utf8')
+        handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.DEBUG if debugging else logging.WARNING)
 
 
 #################################################################################
-def webquiz_error(debugging, msg, err=None):
+class WebQuizError(SystemExit):
     r'''
-    Consistent handling of errors in magthquiz: print the message `msg` and
-    exist with error code `err.errno` if it is available.abs
+    The exception raised by `webquiz_error`. As this is a `SystemExit`,
+    webquiz exits with its code unless it is caught, which is done by
+    `webquiz_build.build_quiz` so that a failed build does not stop the
+    quizzes that are built in watch mode or in a tree. Interrupts, and the
+    other ways of exiting, are not caught.
+    '''
+
+class WebQuizCancelled(SystemExit):
+    r'''
+    The exception raised when webquiz is interrupted or terminated by a
+    signal. It is never caught, so that the whole run stops: the remaining
+    quizzes are not built and no manifest is written.
+    '''
+
+def print_error(msg):
+    r'''
+    Print the error message `msg`
     '''
     print('{dash}WebQuiz error:\n  {msg}\n{dash}'.format(
            msg=msg, dash='-'*40+'\n')
     )
 
+def webquiz_error(debugging, msg, err=None):
+    r'''
+    Consistent handling of errors in magthquiz: print the message `msg` and
+    exit with error code `err.errno` if it is available, by raising a
+    `WebQuizError`
+    '''
+    print_error(msg)
+
     if err is not None:
         trace = traceback.extract_tb(sys.exc_info()[2])
         filename, lineno, fn, text = trace[-1]
@@ -92,9 +217,9 @@ def webquiz_error(debugging, msg, err=None):
         raise
 
     if hasattr(err, 'errno'):
-        sys.exit(err.errno)
+        raise WebQuizError(err.errno)
 
-    sys.exit(1)
+    raise WebQuizError(1)
 
 
 ###############################################################################
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    webquiz_watch | watch quizzes and their dependencies and rebuild them
+                     | whenever they change
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+'''
+
+import ctypes
+import ctypes.util
+import glob
+import os
+import select
+import struct
+import sys
+import time
+
+# imports of webquiz code
+import webquiz_build
+import webquiz_cache
+
+# ---------------------------------------------------------------------------------------
+class InotifyMonitor(object):
+    r'''
+    Monitor files for changes using the linux inotify interface. As editors
+    often save files by writing a new file and then renaming it, we watch the
+    directories that contain the files rather than the files themselves.
+    '''
+    # inotify event masks from <sys/inotify.h>
+    IN_ATTRIB      = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_NONBLOCK    = os.O_NONBLOCK
+    event_mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}  # watch descriptor -> directory
+        self.files = set()
+
+    def watch(self, files):
+        r'''
+        Set the list of files being monitored
+        '''
+        self.files = set(files)
+        watched = set(self.directories.values())
+        for directory in {os.path.dirname(file) for file in self.files} - watched:
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(), self.event_mask)
+            if wd >= 0:
+                self.directories[wd] = directory
+
+    def changes(self, timeout=None):
+        r'''
+        Wait up to `timeout` seconds, or forever if `timeout` is `None`, for
+        changes to the monitored files and return the set of files that changed.
+        '''
+        changed = set()
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                events = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, length = self.event_header.unpack_from(events, offset)
+                offset += self.event_header.size
+                name = events[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                if wd in self.directories:
+                    file = os.path.join(self.directories[wd], name)
+                    if file in self.files:
+                        changed.add(file)
+        return changed
+
+
+class PollingMonitor(object):
+    r'''
+    Monitor files for changes by periodically checking their modification
+    times. This is used when inotify is not available.
+    '''
+    interval = 1  # seconds between checks
+
+    def __init__(self):
+        self.mtimes = {}
+
+    def mtime(self, file):
+        try:
+            return os.stat(file).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, files):
+        r'''
+        Set the list of files being monitored
+        '''
+        self.mtimes = {file: self.mtimes.get(file, self.mtime(file)) for file in files}
+
+    def changes(self, timeout=None):
+        r'''
+        Wait up to `timeout` seconds, or forever if `timeout` is `None`, for
+        changes to the monitored files and return the set of files that changed.
+        '''
+        start = time.monotonic()
+        while True:
+            changed = set()
+            for (file, mtime) in self.mtimes.items():
+                new_mtime = self.mtime(file)
+                if new_mtime != mtime:
+                    self.mtimes[file] = new_mtime
+                    changed.add(file)
+            if changed or (timeout is not None and time.monotonic()-start >= timeout):
+                return changed
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+
+# ---------------------------------------------------------------------------------------
+class QuizWatcher(object):
+    r'''
+    Watch a list of quizzes, and the files that they depend upon, and rebuild
+    a quiz whenever any of these files change. The dependencies of each quiz
+    are read from the <quiz>.d file that is written when the quiz is built.
+    Bursts of changes, such as when an editor saves several files, are
+    collected together so that each quiz is rebuilt only once.
+
+    Usage:
+        >>> QuizWatcher(options, settings, metadata).watch()
+    '''
+    debounce = 0.5  # wait until there have been no changes for this many seconds
+
+    def __init__(self, options, settings, metadata):
+        self.options = options
+        self.settings = settings
+        self.metadata = metadata
+
+        # quiz_file can be a list of quizzes or directories of quizzes
+        self.quizzes = []
+        for quiz_file in options.quiz_file:
+            if os.path.isdir(quiz_file):
+                self.quizzes.extend(
+                    os.path.realpath(file) for file in sorted(glob.glob(os.path.join(quiz_file, '*.tex')))
+                      if webquiz_build.is_webquiz_document(file)
+                )
+            else:
+                # quiz_file is assumed to be a tex file if no extension is given
+                if not '.' in os.path.basename(quiz_file):
+                    quiz_file += '.tex'
+                if os.path.isfile(quiz_file):
+                    self.quizzes.append(os.path.realpath(quiz_file))
+                else:
+                    print('WebQuiz error: cannot read file {}'.format(quiz_file))
+
+        try:
+            self.monitor = InotifyMonitor()
+        except (AttributeError, OSError):
+            # inotify is only available on linux
+            self.monitor = PollingMonitor()
+
+        self.dependencies = {}
+        for quiz in self.quizzes:
+            self.read_dependencies(quiz)
+
+    def read_dependencies(self, quiz):
+        r'''
+        Read the dependencies of `quiz` from its dependency file, if it exists,
+        and update the list of files being monitored.
+        '''
+        try:
+            self.dependencies[quiz] = webquiz_cache.read_dependency_file(quiz[:-4] + '.d')
+        except (OSError, ValueError):
+            self.dependencies[quiz] = []
+        if quiz not in self.dependencies[quiz]:
+            self.dependencies[quiz].append(quiz)
+        self.monitor.watch({file for deps in self.dependencies.values() for file in deps})
+
+    def out_of_date(self, quiz):
+        r'''
+        Return `True` if the web page for `quiz` is older than the quiz or
+        any of its dependencies.
+        '''
+        try:
+            built = os.path.getmtime(quiz[:-4] + '.html')
+        except OSError:
+            return True
+        return any(not os.path.isfile(file) or os.path.getmtime(file) > built
+                     for file in self.dependencies[quiz])
+
+    def rebuild(self, quiz):
+        r'''
+        Rebuild `quiz`, print how long this took and then reread its dependencies
+        '''
+        start = time.perf_counter()
+        success = webquiz_build.build_quiz(quiz, self.options, self.settings, self.metadata)
+        print('{} {} in {:.2f} seconds'.format(
+                'Rebuilt' if success else 'Failed to rebuild',
+                os.path.relpath(quiz),
+                time.perf_counter()-start)
+        )
+        self.read_dependencies(quiz)
+
+    def watch(self):
+        r'''
+        Rebuild the quizzes that are out of date and then wait for changes,
+        rebuilding the affected quizzes whenever their dependencies change.
+        This runs until webquiz is interrupted.
+        '''
+        webquiz_build.set_run_options(self.options)
+        for quiz in self.quizzes:
+            if self.out_of_date(quiz):
+                self.rebuild(quiz)
+
+        print('Watching {} quizzes for changes. Press Control-C to stop.'.format(len(self.quizzes)))
+        while True:
+            changed = self.monitor.changes()
+            # wait for a burst of changes to finish
+            while True:
+                more = self.monitor.changes(timeout=self.debounce)
+                if not more:
+                    break
+                changed |= more
+
+            for quiz in self.quizzes:
+                if changed.intersection(self.dependencies[quiz]):
+                    self.rebuild(quiz)
+            sys.stdout.flush()
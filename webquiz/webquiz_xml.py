@@ -17,16 +17,31 @@ r'''
 
 # -*- encoding: utf-8 -*-
 
+import functools
+import logging
+import xml.parsers.expat
 import xml.sax
 
 # imports of webquiz code
 import webquiz_util
 
+log = webquiz_util.webquiz_logger('xml')
+
 # ---------------------------------------------------------------------------------------
 def ReadWebQuizXmlFile(quizfile, defaults):
     r'''
     Set up, call and then return the xml parser
-    for the quiz web page
+    for the quiz web page, using the parser given by the
+    xml_parser setting
+    '''
+    if defaults['xml_parser'] not in xml_parsers:
+        webquiz_util.webquiz_error(defaults.debugging, 'xml: the xml_parser setting must be {}, not {}'.format(
+                                   ' or '.join(sorted(xml_parsers)), defaults['xml_parser']))
+    return xml_parsers[defaults['xml_parser']](quizfile, defaults)
+
+def read_with_sax(quizfile, defaults):
+    r'''
+    Read the quiz file using the xml.sax parser
     '''
     parser = xml.sax.make_parser()
     quiz = QuizHandler(defaults)
@@ -37,6 +52,38 @@ def ReadWebQuizXmlFile(quizfile, defaults):
     parser.close()
     return quiz
 
+# the size of the blocks that are given to expat
+expat_block_size = 1 << 16
+
+def read_with_expat(quizfile, defaults):
+    r'''
+    Read the quiz file using pyexpat directly, which is the parser that
+    xml.sax uses, without the sax layer in between. The file is given to
+    expat in large blocks and, with buffer_text, expat gives the handler
+    the text between two tags in one piece, rather than line by line.
+    '''
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = expat_block_size
+    quiz = QuizHandler(defaults)
+    parser.StartElementHandler = quiz.startElement
+    parser.EndElementHandler = quiz.endElement
+    parser.CharacterDataHandler = quiz.characters
+    with open(quizfile, 'rb') as xml_file:
+        try:
+            for block in iter(functools.partial(xml_file.read, expat_block_size), b''):
+                parser.Parse(block, False)
+            parser.Parse(b'', True)
+        except xml.parsers.expat.ExpatError as err:
+            quiz.fatalError(err)
+    return quiz
+
+# the parsers that can be chosen using the xml_parser setting
+xml_parsers = dict(
+    expat=read_with_expat,
+    sax=read_with_sax,
+)
+
 
 # ---------------------------------------------------------------------------------------
 class Data(object):
@@ -63,6 +110,22 @@ class QuizHandler(xml.sax.ContentHandler):
         default using the `defaults` dictionary.
     """
 
+    # the following tags have defaults set by `defaults`
+    setting_tags = [
+           'department',
+           'department_url',
+           'institution',
+           'institution_url',
+           'language',
+           'theme',
+    ]
+    # the attributes of these tags are set using set_default_attribute
+    attribute_tags = ['department', 'institution', 'uni']
+    # the text of these tags is given to the last discussion
+    heading_tags = ['heading', 'short_heading']
+    # the text of these tags is given to the quiz
+    metadata_tags = ['breadcrumb', 'title', 'unit_code', 'unit_name']
+
     def __init__(self, defaults):
         self.defaults = defaults
 
@@ -79,33 +142,80 @@ class QuizHandler(xml.sax.ContentHandler):
         # to add mathjs when an eval comparison is used
         self.mathjs = False
 
-        # the following tags have defaults set by `defaults`
-        self.setting_tags = [
-               'department',
-               'department_url',
-               'institution',
-               'institution_url',
-               'language',
-               'theme',
-        ]
         # quiz data
         for tag in self.setting_tags:
             setattr(self, tag, defaults[tag])
         self.breadcrumb = ''
-        self.text = ''
+        self.text_chunks = []  # the chunks of text since self.text was last reset
         self.after_text = ''
         self.title = ''
+        self.math = 'mathml'  # or tex, when the quiz was converted without TeX4ht
         self.unit_code = ''
         self.unit_name = ''
 
         # keep track of current tags for debugging...
         self.current_tags=[]
 
-    def webquiz_debug(self, msg):
+        # the debugging messages are only formatted when they are logged
+        self.debug = log.isEnabledFor(logging.DEBUG)
+
+        # the handlers for the start and end of each webquiz tag, bound to self
+        start_tags, end_tags = self.dispatch_tables()
+        self.start_handlers = self.bind_handlers(start_tags)
+        self.end_handlers = self.bind_handlers(end_tags)
+
+    @classmethod
+    def dispatch_tables(cls):
+        r'''
+        Return the dispatch tables for the start and end tags, which map each
+        webquiz tag to its category and the name of the method that handles
+        it. The category of a tag is `handler`, when there is a start_<tag> or
+        end_<tag> method, or `attribute`, `setting`, `heading` or `metadata`.
+        Every other tag is passed through, with its text kept for the
+        enclosing webquiz tag, so it is not in the tables. The tables are
+        built once for each class, so subclasses can add their own start_<tag>
+        and end_<tag> methods.
+        '''
+        if '_dispatch_tables' not in cls.__dict__:
+            start_tags = {tag: ('attribute', 'set_attribute_tag') for tag in cls.attribute_tags}
+            end_tags = {}
+            for (category, tags) in [('metadata', cls.metadata_tags),
+                                     ('heading', cls.heading_tags),
+                                     ('setting', cls.setting_tags)]:
+                end_tags.update((tag, (category, 'set_{}_tag'.format(category))) for tag in tags)
+            # the start_<tag> and end_<tag> methods take precedence
+            for name in dir(cls):
+                if name.startswith('start_'):
+                    start_tags[name[6:]] = ('handler', name)
+                elif name.startswith('end_'):
+                    end_tags[name[4:]] = ('handler', name)
+            cls._dispatch_tables = (start_tags, end_tags)
+        return cls._dispatch_tables
+
+    def bind_handlers(self, tags):
+        r'''
+        Return a dictionary that maps each tag in the dispatch table `tags` to
+        its handler, bound to self. The start handlers take the attributes of
+        the tag as their argument and the end handlers take no arguments.
+        '''
+        return {tag: getattr(self, name) if category == 'handler' else functools.partial(getattr(self, name), tag)
+                for (tag, (category, name)) in tags.items()}
+
+    @property
+    def text(self):
         r'''
-            Customised debugging message for the xml module
+        The text since the last tag that reset it. The parser gives the text
+        to `characters` in many small chunks, so they are kept in a list,
+        rather than being added to a string, which would take quadratic
+        time, and they are joined only when the text is used.
         '''
-        webquiz_util.webquiz_debug(self.defaults.debugging, 'xml: '+msg)
+        if len(self.text_chunks) > 1:
+            self.text_chunks = [''.join(self.text_chunks)]
+        return self.text_chunks[0] if self.text_chunks else ''
+
+    @text.setter
+    def text(self, text):
+        self.text_chunks = [text] if text else []
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -121,7 +231,8 @@ class QuizHandler(xml.sax.ContentHandler):
             setattr(self, key, self.defaults[key])
         else:
             setattr(self, key, value)
-        self.webquiz_debug('Just set "{}" equal to "{}" from "{}"'.format(key, getattr(self, key), value))
+        if self.debug:
+            log.debug('Just set "%s" equal to "%s" from "%s"', key, getattr(self, key), value)
 
     #---- start of start elements --------------------------------------------
     def startElement(self, tag, attributes):
@@ -129,15 +240,21 @@ class QuizHandler(xml.sax.ContentHandler):
             At the start of each webquiz xml tag we need to pull out the
             attributes and place
         '''
-        self.webquiz_debug('Starting tag for '+tag)
+        if self.debug:
+            log.debug('Starting tag for %s', tag)
         self.current_tags.append(tag)
 
-        if hasattr(self, 'start_'+tag):
-            getattr(self, 'start_'+tag)(attributes)
+        # most tags are passed through, and have no handler
+        handler = self.start_handlers.get(tag)
+        if handler is not None:
+            handler(attributes)
 
-        elif tag in ['department', 'institution', 'uni']:
-            for key in attributes.keys():
-                self.set_default_attribute(tag, attributes.get(key))
+    def set_attribute_tag(self, tag, attributes):
+        r'''
+        Set the `tag` attribute of self using the attributes of the tag
+        '''
+        for key in attributes.keys():
+            self.set_default_attribute(tag, attributes.get(key))
 
     def start_webquiz(self, attributes):
         r'''
@@ -156,6 +273,9 @@ class QuizHandler(xml.sax.ContentHandler):
 
         # set debugging mode from the latex file...from this point on
         self.defaults.debugging = self.defaults.debugging or self.debugging
+        if self.debugging and not self.debug:
+            webquiz_util.set_logging(True)
+            self.debug = True
 
     def start_link(self, attributes):
         r'''
@@ -271,39 +391,44 @@ class QuizHandler(xml.sax.ContentHandler):
         '''
         if self.text.strip() != '':
             self.question_list[-1].after_text += ' '+self.text.strip()
-            self.webquiz_debug('After_text is now {}'.format(self.question_list[-1].after_text))
+            if self.debug:
+                log.debug('After_text is now %s', self.question_list[-1].after_text)
             self.text = ''
         self.current_tags[-1] = 'feedback_'+attributes.get('type')
 
     #---- end of start elements ---------------------------------------------
 
     def endElement(self, tag):
-        self.webquiz_debug('ending tag for {} (should be {})'.format(tag, self.current_tags[-1])) 
-
-        reset_text = True
-        if hasattr(self, 'end_'+tag):
-            getattr(self, 'end_'+tag)()
+        if self.debug:
+            log.debug('ending tag for %s (should be %s)', tag, self.current_tags[-1])
+
+        # most tags are passed through, and have no handler, in which case
+        # self.text lives to be used another day
+        handler = self.end_handlers.get(tag)
+        if handler is not None:
+            handler()
             self.text = ''
 
-        elif tag in self.setting_tags:
-            self.set_default_attribute(tag, self.text)
-            self.text = ''
-
-        elif tag in ['heading', 'short_heading']:
-            setattr(self.discussion_list[-1], tag, self.text.strip())
-
-        elif tag in ['breadcrumb', 'title', 'unit_code', 'unit_name']:
-            setattr(self, tag, self.text.strip())
+        # remove the last tag from the tag list
+        self.current_tags.pop()
 
-        else:
-            # self.text lives to be used another day
-            reset_text = False
+    def set_setting_tag(self, tag):
+        r'''
+        Set the `tag` attribute of self to the text of the tag, or its default
+        '''
+        self.set_default_attribute(tag, self.text)
 
-        if reset_text:
-            self.text = ''
+    def set_heading_tag(self, tag):
+        r'''
+        Set the `tag` attribute of the last discussion to the text of the tag
+        '''
+        setattr(self.discussion_list[-1], tag, self.text.strip())
 
-        # remove the last tag from the tag list
-        self.current_tags.pop()
+    def set_metadata_tag(self, tag):
+        r'''
+        Set the `tag` attribute of self to the text of the tag
+        '''
+        setattr(self, tag, self.text.strip())
 
     #---- start of the end elements ------------------------------------------
 
@@ -368,7 +493,8 @@ class QuizHandler(xml.sax.ContentHandler):
         r'''
         Process end tag when tag="index_item"
         '''
-        self.webquiz_debug('WHEN: Adding text to '+self.current_tags[-1])
+        if self.debug:
+            log.debug('WHEN: Adding text to %s', self.current_tags[-1])
         setattr(self.question_list[-1], self.current_tags[-1], self.text.strip())
 
     #---- end of end elements -----------------------------------------------
@@ -377,7 +503,7 @@ class QuizHandler(xml.sax.ContentHandler):
         r'''
         Append everything to `self.text`
         '''
-        self.text += text
+        self.text_chunks.append(text)
 
     def error(self, e):
         self.webquiz_error('unknown error', e)